@@ -0,0 +1,194 @@
+"""
+Full sync and traffic report cycles against in-process stand-ins of GOST, the panel and Prometheus.
+
+    cd src && python -m benchmarks.bench_sync --sizes 100,1000,10000,50000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+from services.api import GOSTApi, PrometheusApi, TYZApi
+from services.executor import Executor
+from services.spool import TrafficSpool
+from services.state import SyncState
+from services.status import StatusCoalescer
+from services.traffic import PrometheusTrafficSource
+from services.tyz import report_traffic_by_rules, sync_relay_rules
+from tests.fakes import FakeGOST, FakePanel, FakePrometheus, make_rules
+from utils.models import parse_rules
+
+NODE_ID = 1
+
+
+class LagProbe:
+    """
+    Worst event loop lag, as an observer request arriving meanwhile would wait.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.max = max(self.max, loop.time() - started - self.interval)
+
+
+class Measure:
+    """
+    Wall time, requests per upstream, worst loop lag, peak traced memory and net allocated blocks of one phase.
+    """
+
+    def __init__(self, upstreams: dict, lag: LagProbe, trace_memory: bool):
+        self.upstreams = upstreams
+        self.lag = lag
+        self.trace_memory = trace_memory
+        self.result = {}
+
+    async def __aenter__(self):
+        # collect outside the phase and let the lag probe wake up once after it
+        gc.collect()
+        await asyncio.sleep(self.lag.interval * 2)
+        self.lag.max = 0.0
+        self.requests = {k: u.total for k, u in self.upstreams.items()}
+        self.blocks = sys.getallocatedblocks()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc):
+        wall = time.perf_counter() - self.started
+        blocks = sys.getallocatedblocks() - self.blocks
+        peak = tracemalloc.get_traced_memory()[1] / 2**20 if self.trace_memory else None
+        # the probe records a stall when it wakes up after it
+        await asyncio.sleep(self.lag.interval * 2)
+        self.result = {
+            "wall": wall,
+            "requests": {k: u.total - self.requests[k] for k, u in self.upstreams.items()},
+            "max_lag_ms": self.lag.max * 1000,
+            "peak_mb": peak,
+            "blocks": blocks,
+        }
+
+
+def churn(rules: List[dict], ratio: float) -> List[dict]:
+    """
+    Change, delete and add `ratio` of rules each.
+    :param rules:
+    :param ratio:
+    :return:
+    """
+    n = max(1, int(len(rules) * ratio))
+    changed = [{**r, "listen_port": r["listen_port"] + 1} for r in rules[:n]]
+    added = make_rules(n=n, node_id=NODE_ID, start_id=max(r["id"] for r in rules) + 1, seed=None)
+    return changed + rules[2 * n :] + added
+
+
+async def run_size(size: int, latency: float, error_rate: float, trace_memory: bool) -> Dict[str, dict]:
+    rules = make_rules(n=size, node_id=NODE_ID)
+    gost = FakeGOST(latency=latency, error_rate=error_rate)
+    panel = FakePanel(rules=rules, latency=latency, error_rate=error_rate)
+    prom = FakePrometheus(
+        traffic={r.service_name: (2**20, 2**21) for r in parse_rules(rules)}, latency=latency, error_rate=error_rate
+    )
+    gost_api = gost.attach(GOSTApi(endpoint="http://gost"))
+    panel_api = panel.attach(TYZApi(endpoint="http://panel", node_id=NODE_ID, token="t"))
+    prom_api = prom.attach(PrometheusApi(endpoint="http://prometheus"))
+
+    executor = Executor()
+    state = SyncState()
+    status = StatusCoalescer(panel_api=panel_api, executor=executor)
+    source = PrometheusTrafficSource(prom_api=prom_api, executor=executor)
+    upstreams = {"gost": gost, "panel": panel, "prometheus": prom}
+
+    async def sync():
+        await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=executor, state=state, status=status)
+
+    results = {}
+    lag = LagProbe()
+    lag_task = asyncio.create_task(lag.run())
+    with tempfile.TemporaryDirectory() as tmp:
+        spool = TrafficSpool(path=str(Path(tmp) / "spool.jsonl"))
+        phases = (
+            # every object created
+            ("cold", sync),
+            # GOST changed by the last cycle, plans again and finds nothing to do
+            ("verify", sync),
+            # rules and GOST unchanged, skipped on fingerprints
+            ("steady", sync),
+            # forced full sync re-reading GOST, finding nothing to do
+            ("full", sync),
+            # 1% of rules changed, deleted and added each
+            ("churn", sync),
+            ("traffic", lambda: report_traffic_by_rules(panel_api, source, executor, spool)),
+        )
+        for name, phase in phases:
+            if name == "full":
+                state.last_full_sync = 0
+            elif name == "churn":
+                panel.set_rules(churn(rules=rules, ratio=0.01))
+            elif name == "traffic":
+                source.last_end = 0
+            async with Measure(upstreams=upstreams, lag=lag, trace_memory=trace_memory) as m:
+                await phase()
+            results[name] = m.result
+
+    lag_task.cancel()
+    results["cold"]["objects"] = gost.size()
+    for api in (gost_api, panel_api, prom_api):
+        await api.close()
+    return results
+
+
+def print_results(results: Dict[int, Dict[str, dict]]):
+    print(
+        f"{'rules':>7} {'phase':<8} {'wall s':>9} {'gost':>8} {'panel':>6} {'prom':>5} {'lag ms':>8} {'peak MB':>8} "
+        f"{'blocks':>9}"
+    )
+    for size, phases in results.items():
+        for name, r in phases.items():
+            req = r["requests"]
+            peak = "-" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"
+            print(
+                f"{size:>7} {name:<8} {r['wall']:>9.3f} {req['gost']:>8} {req['panel']:>6} {req['prometheus']:>5} "
+                f"{r['max_lag_ms']:>8.1f} {peak:>8} {r['blocks']:>9}"
+            )
+
+
+async def main(args):
+    if args.trace_memory:
+        tracemalloc.start()
+    results = {}
+    for size in (int(s) for s in args.sizes.split(",")):
+        results[size] = await run_size(
+            size=size, latency=args.latency, error_rate=args.error_rate, trace_memory=args.trace_memory
+        )
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="100,1000,10000,50000", help="rule counts, comma separated")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every upstream request")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of upstream requests failing with 500")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false", help="skip tracemalloc")
+    parser.add_argument("--json", type=str, default="", help="write results to this file")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    asyncio.run(main(args))
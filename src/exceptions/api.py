@@ -0,0 +1,10 @@
+class UpstreamException(Exception):
+    pass
+
+
+class CircuitOpenException(UpstreamException):
+    pass
+
+
+class DeadlineExceededException(UpstreamException):
+    pass
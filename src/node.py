@@ -8,7 +8,7 @@ from urllib.parse import urlparse
 import uvicorn
 from fastapi import FastAPI
 
-from routers import index, observer
+from routers import index, observer, sync, metrics, push, stats
 from sched import Scheduler
 from utils.log import fmt_logger
 
@@ -32,6 +32,12 @@ async def lifespan(web_app: FastAPI):
     # start scheduler with fastapi
     web_app.include_router(index.router, prefix="")
     web_app.include_router(observer.router, prefix="/observer")
+    web_app.include_router(sync.router, prefix="/sync")
+    web_app.include_router(metrics.router, prefix="/metrics")
+    web_app.include_router(push.router, prefix="/push")
+    web_app.include_router(stats.router, prefix="/stats")
+    web_app.state.scheduler = scheduler
+    web_app.state.token = cfg.get("mng", {}).get("token", "")
     await scheduler.start()
     yield
     # stop scheduler
@@ -1,5 +1,7 @@
+import hmac
 from typing import Union
 
+from fastapi import Header, HTTPException, Request
 from pydantic import BaseModel
 
 
@@ -7,3 +9,16 @@ class RespModel(BaseModel):
     success: bool = True
     msg: str = "success"
     data: Union[dict, list] = None
+
+
+async def verify_token(request: Request, authorization: str = Header("")):
+    """
+    Check `Authorization: Bearer <token>` against `[mng] token`, requests are refused when no token is configured.
+    :param request:
+    :param authorization:
+    :return:
+    """
+    token = getattr(request.app.state, "token", "")
+    scheme, _, value = authorization.partition(" ")
+    if not token or scheme.lower() != "bearer" or not hmac.compare_digest(value.encode(), token.encode()):
+        raise HTTPException(status_code=401, detail="invalid token")
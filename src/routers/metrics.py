@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from utils.metrics import REGISTRY
+
+router = APIRouter()
+
+
+@router.get("", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """
+    Metrics of gost-node in prometheus text format.
+    :return:
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
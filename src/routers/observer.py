@@ -1,8 +1,6 @@
 import logging
-from typing import List, Optional
 
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, Request
 
 from . import RespModel
 
@@ -10,40 +8,29 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
-class EventStatsModel(BaseModel):
-    totalConns: int
-    currentConns: int
-    inputBytes: int
-    outputBytes: int
-    totalErrs: int
-
-
-class EventStatusModel(BaseModel):
-    msg: str
-    state: str
-
-
-class EventModel(BaseModel):
-    kind: str
-    service: str
-    client: Optional[str] = ""
-    type: str
-    status: Optional[EventStatusModel] = None
-    stats: Optional[EventStatsModel] = None
-
-
-class ObserveModel(BaseModel):
-    events: List[EventModel]
+async def _observe(request: Request, node: str = "") -> RespModel:
+    # GOST is answered at once, events are decoded and accounted by the ingest consumer
+    if not request.app.state.scheduler.observer_ingest.submit(node=node, body=await request.body()):
+        return RespModel(success=False, msg="observer queue full, events dropped")
+    return RespModel()
 
 
 @router.post("")
-async def observer(request: ObserveModel) -> RespModel:
+async def observer(request: Request) -> RespModel:
     """
-    Observer for GOST.
+    Observer for GOST, body is `{"events": [{"kind": "service", "service": "...", "type": "stats", "stats": {...}}]}`.
     :param request:
     :return:
     """
-    for e in request.events:
-        logger.info(e)
+    return await _observe(request=request)
 
-    return RespModel(success=True, message="Hello World!")
+
+@router.post("/{node}")
+async def node_observer(request: Request, node: str) -> RespModel:
+    """
+    Observer for GOST instance of a node.
+    :param request:
+    :param node: node name
+    :return:
+    """
+    return await _observe(request=request, node=node)
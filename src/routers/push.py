@@ -0,0 +1,57 @@
+import logging
+from typing import List
+
+from fastapi import APIRouter, Depends, Request
+from pydantic import BaseModel
+
+from exceptions.gost import GOSTApiException
+from exceptions.tyz import TYZApiException
+from services import tyz as tyz_service
+from . import RespModel, verify_token
+
+logger = logging.getLogger(__name__)
+router = APIRouter(dependencies=[Depends(verify_token)])
+
+
+class PushRulesModel(BaseModel):
+    # changed rule ids
+    rules: List[int] = []
+    # deleted rule ids
+    deleted: List[int] = []
+
+
+@router.post("/rules")
+async def push_rules(request: Request, body: PushRulesModel, node: str = "") -> RespModel:
+    """
+    Sync changed or deleted relay rules now, periodic full sync is kept as a safety net.
+    :param request:
+    :param body:
+    :param node: node name, the first node by default
+    :return:
+    """
+    n = request.app.state.scheduler.get_node(name=node)
+    if n is None:
+        return RespModel(success=False, msg=f"node {node} not found")
+
+    rule_ids = sorted(set(body.rules) | set(body.deleted))
+    if not rule_ids:
+        return RespModel(data={"summary": {}, "failed": []})
+
+    try:
+        async with n.sync_lock:
+            result = await tyz_service.sync_relay_rules_by_ids(
+                panel_api=n.panel_api,
+                gost_api=n.gost_api,
+                executor=n.executor,
+                state=n.sync_state,
+                rule_ids=rule_ids,
+                status=n.status_coalescer,
+                prober=n.prober,
+                accumulator=n.traffic_accumulator,
+            )
+    except (GOSTApiException, TYZApiException) as e:
+        logger.error(f"push sync relay rules {rule_ids} error: {e}")
+        return RespModel(success=False, msg=str(e))
+
+    request.app.state.scheduler.tighten_sync(node=n)
+    return RespModel(success=not result["failed"], data=result)
@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Request
+
+from services.timeseries import TOP_BY
+from . import RespModel
+
+router = APIRouter()
+
+
+@router.get("/services/{service}")
+async def service_stats(request: Request, service: str, window: int = 3600, resolution: int = 0) -> RespModel:
+    """
+    Connections, traffic and errors of a service over time.
+    :param request:
+    :param service: service name, e.g. rule-1-tunnel-node-1
+    :param window: seconds back from now
+    :param resolution: seconds per point, the finest covering window by default
+    :return:
+    """
+    data = request.app.state.scheduler.timeseries.query(service=service, window=window, resolution=resolution)
+    if data is None:
+        return RespModel(success=False, msg=f"no stats of service {service}")
+    return RespModel(data=data)
+
+
+@router.get("/top")
+async def top_services(request: Request, n: int = 10, window: int = 300, by: str = "bytes") -> RespModel:
+    """
+    Busiest services.
+    :param request:
+    :param n:
+    :param window: seconds back from now
+    :param by: bytes, conns or errors
+    :return:
+    """
+    if by not in TOP_BY:
+        return RespModel(success=False, msg=f"unsupported order {by}, one of {', '.join(TOP_BY)}")
+    return RespModel(data=request.app.state.scheduler.timeseries.top(n=n, window=window, by=by))
@@ -0,0 +1,35 @@
+import logging
+
+from fastapi import APIRouter, Depends, Request
+
+from exceptions.gost import GOSTApiException
+from exceptions.tyz import TYZApiException
+from services import tyz as tyz_service
+from . import RespModel, verify_token
+
+router = APIRouter(dependencies=[Depends(verify_token)])
+logger = logging.getLogger(__name__)
+
+
+@router.get("/plan")
+async def sync_plan(request: Request, node: str = "", verbose: bool = False) -> RespModel:
+    """
+    Dry run of relay rules sync, show the changes without applying.
+    :param request:
+    :param node: node name, the first node by default
+    :param verbose: include rendered objects, credentials masked
+    :return:
+    """
+    n = request.app.state.scheduler.get_node(name=node)
+    if n is None:
+        return RespModel(success=False, msg=f"node {node} not found")
+
+    try:
+        # the sync job updates the mirror planned against
+        async with n.sync_lock:
+            plan = await tyz_service.plan_relay_rules(panel_api=n.panel_api, gost_api=n.gost_api, prober=n.prober)
+    except (GOSTApiException, TYZApiException) as e:
+        logger.error(f"plan relay rules error: {e}")
+        return RespModel(success=False, msg=str(e))
+
+    return RespModel(data=plan.to_dict(verbose=verbose))
@@ -1,57 +1,429 @@
+import asyncio
 import datetime
 import logging
+import random
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
 
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobEvent
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from services import tyz as tyz_service
-from services.api import TYZApi, GOSTApi, PrometheusApi
+from services.bulk import build_bulk_backend
+from services.executor import Executor
+from services.ingest import ObserverIngest
+from services.loop import monitor_loop_lag
+from services.prober import TargetProber
+from services.resilience import deadline
+from services.snapshot import Snapshot, restore_snapshot
+from services.spool import TrafficSpool
+from services.state import SyncState
+from services.timeseries import TimeSeriesStore
+from services.status import StatusCoalescer
+from services.traffic import TrafficAccumulator, build_traffic_source
+from utils.gost import parse_rule_info_from_service
+from utils.metrics import REGISTRY
+from services.api import TYZApi, GOSTApi, PrometheusApi, GOSTMetricsApi, ClientPool, pool_options
 
 logger = logging.getLogger(__name__)
 
+NODE_SECTIONS = ("gost", "tyz", "traffic", "schedule")
+
+JOB_SECONDS = REGISTRY.histogram("gost_node_job_seconds", "Duration of scheduled job runs", ("job",))
+JOB_FAILURES = REGISTRY.counter("gost_node_job_failures_total", "Scheduled job runs raising an error", ("job",))
+JOB_LAST_SUCCESS = REGISTRY.gauge(
+    "gost_node_job_last_success_timestamp_seconds", "Time the last run of a job finished without error", ("job",)
+)
+JOB_MISFIRES = REGISTRY.counter(
+    "gost_node_job_misfires_total", "Scheduled runs not started, late or still running", ("job", "reason")
+)
+
+
+def node_configs(cfg: dict) -> List[Tuple[str, dict]]:
+    """
+    Node definitions from config. `[[nodes]]` entries inherit top-level `[gost]`, `[tyz]`, `[traffic]` as defaults,
+    without `[[nodes]]` the top-level sections define a single node.
+    :param cfg:
+    :return: (name, config) pairs
+    """
+    nodes = cfg.get("nodes")
+    if not nodes:
+        return [("default", cfg)]
+
+    res = []
+    for n in nodes:
+        merged = {sec: {**cfg.get(sec, {}), **n.get(sec, {})} for sec in NODE_SECTIONS}
+        name = n.get("name") or f"node-{merged['tyz'].get('node_id', len(res))}"
+        res.append((name, merged))
+    return res
+
+
+class AdaptiveInterval(object):
+    """
+    Interval backing off while cycles find nothing to do, back to the minimum after changes or push notifications.
+    """
+
+    def __init__(self, minimum: float = 30, maximum: float = 300, factor: float = 2):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.current = minimum
+
+    def idle(self) -> float:
+        self.current = min(self.maximum, self.current * self.factor)
+        return self.current
+
+    def busy(self) -> float:
+        self.current = self.minimum
+        return self.current
+
+
+class Node(object):
+    """
+    One GOST instance served for one panel node ID, with its own APIs, state and jobs.
+    """
+
+    def __init__(
+        self, name: str, cfg: dict, executor: Executor, client_pool: ClientPool, prober: TargetProber = None
+    ) -> None:
+        self.name = name
+        gost_cfg = cfg.get("gost", {})
+        tyz_cfg = cfg.get("tyz", {})
+        traffic_cfg = cfg.get("traffic", {})
+        self.node_id = tyz_cfg.get("node_id", 0)
+        self.panel_api = TYZApi(
+            endpoint=tyz_cfg.get("endpoint", ""),
+            node_id=self.node_id,
+            token=tyz_cfg.get("token", ""),
+            client_pool=client_pool,
+            **pool_options(tyz_cfg.get("pool", {})),
+        )
+        self.gost_api = GOSTApi(
+            endpoint=gost_cfg.get("endpoint", ""),
+            mirror_refresh_interval=gost_cfg.get("mirror_refresh_interval", 300),
+            client_pool=client_pool,
+            **pool_options(gost_cfg.get("pool", {})),
+        )
+        self.prometheus_api = PrometheusApi(
+            endpoint=gost_cfg.get("prometheus", ""),
+            client_pool=client_pool,
+            **pool_options(gost_cfg.get("prometheus_pool", {})),
+        )
+        self.gost_metrics_api = None
+        if gost_cfg.get("metrics"):
+            self.gost_metrics_api = GOSTMetricsApi(
+                endpoint=gost_cfg["metrics"], path=gost_cfg.get("metrics_path", "/metrics"), client_pool=client_pool
+            )
+        self.executor = executor
+        self.prober = prober
+        self.bulk = build_bulk_backend(cfg=gost_cfg.get("bulk", {}))
+        self.schedule_cfg = cfg.get("schedule", {})
+        self.sync_interval = AdaptiveInterval(
+            minimum=self.schedule_cfg.get("sync_interval", 30),
+            maximum=self.schedule_cfg.get("sync_max_interval", 300),
+            factor=self.schedule_cfg.get("sync_backoff", 2),
+        )
+        self.status_coalescer = StatusCoalescer(
+            panel_api=self.panel_api, executor=self.executor, batch=tyz_cfg.get("batch_status", True)
+        )
+        # full and pushed syncs of a node must not interleave
+        self.sync_lock = asyncio.Lock()
+        self.sync_state = SyncState(full_sync_interval=tyz_cfg.get("full_sync_interval", 600))
+        self.traffic_accumulator = TrafficAccumulator(reset_traffic=traffic_cfg.get("reset_traffic", False))
+        self.traffic_source = build_traffic_source(
+            cfg=traffic_cfg,
+            prom_api=self.prometheus_api,
+            executor=self.executor,
+            accumulator=self.traffic_accumulator,
+            metrics_api=self.gost_metrics_api,
+            step=self.schedule_cfg.get("traffic_interval", 30),
+        )
+        self.traffic_spool = TrafficSpool(
+            path=self._node_path(traffic_cfg.get("spool_path", "traffic-spool.jsonl")),
+            max_bytes=traffic_cfg.get("spool_max_bytes", 16 * 1024 * 1024),
+        )
+        # off unless a path is configured, the file holds relay credentials
+        self.snapshot = None
+        if gost_cfg.get("snapshot_path") and gost_cfg.get("snapshot", True):
+            self.snapshot = Snapshot(path=self._node_path(gost_cfg["snapshot_path"]), node_id=self.panel_api.node_id)
+
+    def _node_path(self, path: str) -> str:
+        # nodes inherit file paths, keep one file per node
+        p = Path(path)
+        if self.name != "default":
+            p = p.with_name(f"{p.stem}-{self.name}{p.suffix}")
+        return str(p)
+
+    @property
+    def apis(self) -> list:
+        return [api for api in (self.panel_api, self.gost_api, self.prometheus_api, self.gost_metrics_api) if api]
+
 
 class Scheduler(object):
     def __init__(self, cfg: dict) -> None:
         # jobstores = {"default": SQLAlchemyJobStore(url="sqlite:///jobs.sqlite")}
         self.scheduler = AsyncIOScheduler()
-        self.gost_endpoint = cfg.get("gost", {}).get("endpoint", "")
-        self.tyz_endpoint = cfg.get("tyz", {}).get("endpoint", "")
-        self.prom = cfg.get("gost", {}).get("prometheus", "")
-        self.node_id = cfg.get("tyz", {}).get("node_id", 0)
-        self.token = cfg.get("tyz", {}).get("token", "")
-        self.panel_api = TYZApi(endpoint=self.tyz_endpoint, node_id=self.node_id, token=self.token)
-        self.gost_api = GOSTApi(endpoint=self.gost_endpoint)
-        self.prometheus_api = PrometheusApi(endpoint=self.prom)
-
-    def _add_schedules(self):
-        # sync rules
+        self.client_pool = ClientPool()
+        self.executor = Executor.from_config(cfg.get("executor", {}))
+        self.prober_cfg = cfg.get("prober", {})
+        self.prober = None
+        if self.prober_cfg.get("enabled", False):
+            self.prober = TargetProber(
+                timeout=self.prober_cfg.get("timeout", 3),
+                concurrency=self.prober_cfg.get("concurrency", 64),
+                max_fails=self.prober_cfg.get("max_fails", 2),
+                tolerance=self.prober_cfg.get("tolerance", 0.2),
+                fail_timeout=self.prober_cfg.get("fail_timeout", "30s"),
+            )
+        self.nodes = [
+            Node(name=name, cfg=c, executor=self.executor, client_pool=self.client_pool, prober=self.prober)
+            for name, c in node_configs(cfg)
+        ]
+        series_cfg = cfg.get("timeseries", {})
+        self.timeseries = TimeSeriesStore(
+            resolutions=series_cfg.get("resolutions", [[60, 60], [900, 96]]),
+            max_services=series_cfg.get("max_services", 10000),
+        )
+        observer_cfg = cfg.get("observer", {})
+        self.observer_ingest = ObserverIngest(
+            route=self._observer_accumulator,
+            queue_size=observer_cfg.get("queue_size", 1024),
+            batch_size=observer_cfg.get("batch_size", 64),
+            series=self.timeseries if series_cfg.get("enabled", True) else None,
+            offload_bytes=observer_cfg.get("offload_bytes", 64 * 1024),
+        )
+        self._ingest_task = None
+        self._loop_lag_task = None
+
+    def get_node(self, name: str = "") -> Optional[Node]:
+        """
+        Node by name, the first node when name is empty.
+        :param name:
+        :return:
+        """
+        if not name:
+            return self.nodes[0] if self.nodes else None
+        for n in self.nodes:
+            if n.name == name:
+                return n
+        return None
+
+    def get_node_by_id(self, node_id: int) -> Optional[Node]:
+        for n in self.nodes:
+            if n.node_id == node_id:
+                return n
+        return None
+
+    def route_service(self, node: str, service: str) -> Optional[Node]:
+        """
+        Node of a GOST service, by node name when GOST is configured per node, otherwise by node id in service name.
+        :param node:
+        :param service:
+        :return:
+        """
+        if node or len(self.nodes) == 1:
+            return self.get_node(name=node)
+
+        try:
+            _, _, node_id = parse_rule_info_from_service(service=service)
+        except (IndexError, ValueError):
+            return None
+        return self.get_node_by_id(node_id=node_id)
+
+    def _observer_accumulator(self, node: str, service: str) -> Optional[TrafficAccumulator]:
+        n = self.route_service(node=node, service=service)
+        return n.traffic_accumulator if n else None
+
+    @staticmethod
+    def _start_time(node: Node) -> datetime.datetime:
+        # spread nodes restarted together by a deploy
+        jitter = random.uniform(0, node.schedule_cfg.get("startup_jitter", 10))
+        return datetime.datetime.now() + datetime.timedelta(seconds=jitter)
+
+    @staticmethod
+    def _jitter(node: Node, seconds: float) -> int:
+        return int(seconds * node.schedule_cfg.get("jitter", 0.1))
+
+    def _reschedule_sync(self, node: Node, seconds: float):
+        self.scheduler.reschedule_job(
+            job_id=f"{node.name}-sync-relay-rules",
+            trigger="interval",
+            seconds=seconds,
+            jitter=self._jitter(node=node, seconds=seconds),
+        )
+        logger.debug(f"next sync of {node.name} in {seconds:.0f}s")
+
+    @staticmethod
+    async def _timed(job: str, func, budget: float = 0, **kwargs):
+        """
+        Run a job and record its duration and outcome.
+        :param job: job id
+        :param func: job coroutine function
+        :param budget: seconds upstream requests of the run may take in total, unbounded when 0
+        :param kwargs: arguments of func
+        :return:
+        """
+        started = time.monotonic()
+        try:
+            with deadline(budget):
+                await func(**kwargs)
+        except Exception:
+            JOB_FAILURES.inc(job=job)
+            raise
+        else:
+            JOB_LAST_SUCCESS.set(time.time(), job=job)
+        finally:
+            JOB_SECONDS.observe(time.monotonic() - started, job=job)
+
+    @staticmethod
+    def _on_job_missed(event: JobEvent):
+        reason = "missed" if event.code == EVENT_JOB_MISSED else "max_instances"
+        logger.warning(f"job {event.job_id} not run: {reason}")
+        JOB_MISFIRES.inc(job=event.job_id, reason=reason)
+
+    async def _sync_job(self, node: Node):
+        wait = node.panel_api.retry_after()
+        if wait > 0:
+            logger.info(f"panel asked {node.name} to retry after {wait:.0f}s, skip sync")
+            self._reschedule_sync(node=node, seconds=max(wait, node.sync_interval.current))
+            return
+
+        # None when the cycle failed, the interval is kept so recovery is not slowed down
+        changed = None
+        try:
+            async with node.sync_lock:
+                changed = await tyz_service.sync_relay_rules(
+                    panel_api=node.panel_api,
+                    gost_api=node.gost_api,
+                    executor=node.executor,
+                    state=node.sync_state,
+                    status=node.status_coalescer,
+                    prober=node.prober,
+                    bulk=node.bulk,
+                    accumulator=node.traffic_accumulator,
+                )
+                if node.snapshot:
+                    await node.snapshot.save(state=node.sync_state, gost_api=node.gost_api)
+        finally:
+            if changed is None:
+                interval = node.sync_interval.current
+            else:
+                interval = node.sync_interval.busy() if changed else node.sync_interval.idle()
+            self._reschedule_sync(node=node, seconds=max(interval, node.panel_api.retry_after()))
+
+    def tighten_sync(self, node: Node):
+        """
+        Bring the sync interval of node back to its minimum, e.g. after push notifications, so the next cycle
+        verifies pushed changes soon.
+        :param node:
+        :return:
+        """
+        seconds = node.sync_interval.busy()
+        if self.scheduler.get_job(job_id=f"{node.name}-sync-relay-rules"):
+            self._reschedule_sync(node=node, seconds=seconds)
+
+    def _add_schedules(self, node: Node):
+        # sync rules, rescheduled after every run
         self.scheduler.add_job(
-            func=tyz_service.sync_relay_rules,
+            func=self._timed,
             trigger="interval",
-            seconds=30,
+            id=f"{node.name}-sync-relay-rules",
+            seconds=node.sync_interval.current,
+            jitter=self._jitter(node=node, seconds=node.sync_interval.current),
             misfire_grace_time=60,
-            next_run_time=datetime.datetime.now(),
+            coalesce=True,
+            max_instances=1,
+            next_run_time=self._start_time(node=node),
             kwargs={
-                "panel_api": self.panel_api,
-                "gost_api": self.gost_api,
+                "job": f"{node.name}-sync-relay-rules",
+                "func": self._sync_job,
+                "budget": node.schedule_cfg.get("sync_deadline", 120),
+                "node": node,
             },
         )
 
         # report traffic used
+        traffic_interval = node.schedule_cfg.get("traffic_interval", 30)
         self.scheduler.add_job(
-            func=tyz_service.report_traffic_by_rules,
+            func=self._timed,
             trigger="interval",
-            seconds=30,
+            id=f"{node.name}-report-traffic",
+            seconds=traffic_interval,
+            jitter=self._jitter(node=node, seconds=traffic_interval),
             misfire_grace_time=60,
-            next_run_time=datetime.datetime.now(),
-            kwargs={"panel_api": self.panel_api, "prom_api": self.prometheus_api},
+            coalesce=True,
+            max_instances=1,
+            next_run_time=self._start_time(node=node),
+            kwargs={
+                "job": f"{node.name}-report-traffic",
+                "func": tyz_service.report_traffic_by_rules,
+                "budget": node.schedule_cfg.get("traffic_deadline", traffic_interval),
+                "panel_api": node.panel_api,
+                "source": node.traffic_source,
+                "executor": node.executor,
+                "spool": node.traffic_spool,
+            },
         )
 
+    async def _probe_job(self):
+        # targets of all nodes, probed once each
+        groups = set()
+        for node in self.nodes:
+            groups |= tyz_service.raw_targets(rules=node.sync_state.rule_models)
+        self.prober.update_targets(groups=groups)
+        if await self.prober.probe_all():
+            for node in self.nodes:
+                node.sync_state.mark_dirty()
+
     def run_scheduler(self):
-        self._add_schedules()
+        for node in self.nodes:
+            self._add_schedules(node=node)
+        if self.prober:
+            self.scheduler.add_job(
+                func=self._timed,
+                trigger="interval",
+                id="probe-targets",
+                seconds=self.prober_cfg.get("interval", 60),
+                misfire_grace_time=60,
+                coalesce=True,
+                max_instances=1,
+                kwargs={"job": "probe-targets", "func": self._probe_job},
+            )
+        self.scheduler.add_listener(self._on_job_missed, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
         self.scheduler.start()
 
+    async def _restore(self, node: Node):
+        try:
+            async with node.sync_lock:
+                await restore_snapshot(
+                    snapshot=node.snapshot,
+                    panel_api=node.panel_api,
+                    gost_api=node.gost_api,
+                    executor=node.executor,
+                    state=node.sync_state,
+                )
+        except Exception as e:
+            logger.error(f"restore snapshot of {node.name} error: {e}")
+
     async def start(self):
+        for node in self.nodes:
+            for api in node.apis:
+                await api.open()
+        # bring forwarding back before the panel is reachable
+        await asyncio.gather(*[self._restore(node=node) for node in self.nodes if node.snapshot])
+        self._ingest_task = asyncio.create_task(self.observer_ingest.run())
+        self._loop_lag_task = asyncio.create_task(monitor_loop_lag())
         self.run_scheduler()
 
     async def stop(self):
         self.scheduler.shutdown()
+        if self._loop_lag_task:
+            self._loop_lag_task.cancel()
+        if self._ingest_task:
+            self._ingest_task.cancel()
+            self.observer_ingest.drain()
+        for node in self.nodes:
+            for api in node.apis:
+                await api.close()
+        await self.client_pool.close()
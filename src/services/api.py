@@ -1,33 +1,290 @@
+import asyncio
+import importlib.util
 import logging
+import time
+from email.utils import parsedate_to_datetime
 from json import JSONDecodeError
 from typing import Tuple, Optional
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 
 import httpx
 from httpx import Response
 
+from exceptions.api import CircuitOpenException, DeadlineExceededException
 from exceptions.gost import GOSTApiException
 from exceptions.tyz import TYZApiException
+from services.mirror import GOSTMirror
+from services.resilience import UPSTREAM_RETRIES, CircuitBreaker, backoff_delay, bounded_timeout, remaining
+from utils.metrics import REGISTRY
+from utils.prom import ServiceTransferParser
 
 logger = logging.getLogger(__name__)
 
+# retried on transport errors and gateway responses
+IDEMPOTENT_METHODS = ("GET", "PUT")
+RETRY_STATUS = (502, 503, 504)
+# bodies at least this large are decoded in a worker thread, e.g. full GOST config or panel rules
+OFFLOAD_JSON_BYTES = 64 * 1024
+
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "gost_node_upstream_request_seconds", "Latency of requests to upstream APIs", ("upstream", "method")
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "gost_node_upstream_request_errors_total", "Failed requests to upstream APIs", ("upstream", "reason")
+)
+
+
+class ClientPool:
+    """
+    httpx clients shared by all APIs talking to the same origin, e.g. one panel serving several node IDs.
+    The first API asking for an origin decides its pool options.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.breakers = {}
+
+    def get(self, api: "BasicApi") -> httpx.AsyncClient:
+        p = urlparse(api.endpoint)
+        key = (p.scheme, p.netloc)
+        client = self.clients.get(key)
+        if client is None or client.is_closed:
+            client = self.clients[key] = api.new_client()
+        return client
+
+    def breaker(self, api: "BasicApi") -> CircuitBreaker:
+        """
+        Circuit breaker shared by all APIs of the same upstream.
+        :param api:
+        :return:
+        """
+        breaker = self.breakers.get(api.upstream)
+        if breaker is None:
+            breaker = self.breakers[api.upstream] = api.new_breaker()
+        return breaker
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
 
 class BasicApi:
-    def __init__(self, endpoint: str):
+    # upstream name used by executor limits
+    kind = ""
+
+    def __init__(
+        self,
+        endpoint: str,
+        timeout: float = 10,
+        connect_timeout: float = 3,
+        read_timeout: float = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30,
+        http2: bool = False,
+        retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30,
+        client_pool: ClientPool = None,
+    ):
         self.endpoint = endpoint
+        # one executor queue per upstream instance, limits are configured per kind
+        self.upstream = f"{self.kind}@{urlparse(endpoint).netloc}" if self.kind else endpoint
+        self.client_pool = client_pool
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout, read=read_timeout or timeout)
+        # retries of idempotent requests
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.breaker = client_pool.breaker(self) if client_pool is not None else self.new_breaker()
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning(f"http2 for {endpoint} requires the h2 package, fallback to http1.1")
+            http2 = False
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Long-lived client, connections are pooled and reused across requests.
+        :return:
+        """
+        if self.client_pool is not None and self._client is None:
+            return self.client_pool.get(self)
+        if self._client is None or self._client.is_closed:
+            self._client = self.new_client()
+        return self._client
+
+    def new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(timeout=self.timeout, limits=self.limits, http2=self.http2)
+
+    def new_breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(name=self.upstream, failures=self.breaker_failures, reset_timeout=self.breaker_reset)
+
+    async def open(self):
+        """
+        Create the pooled client.
+        :return:
+        """
+        _ = self.client
 
-    async def req(self, url: str, method: str, params: dict = None, data: dict = None) -> Response:
-        async with httpx.AsyncClient(timeout=10) as client:
-            return await client.request(
-                method=method.upper(), url=urljoin(self.endpoint, url), params=params, json=data
+    async def close(self):
+        """
+        Close the pooled client and all its connections.
+        :return:
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    async def decode(response: Response):
+        """
+        Decode JSON body, large bodies off the event loop so observer requests are served meanwhile.
+        :param response:
+        :return:
+        """
+        if len(response.content) >= OFFLOAD_JSON_BYTES:
+            return await asyncio.to_thread(response.json)
+        return response.json()
+
+    async def _send(
+        self, url: str, method: str, params: dict = None, data: dict = None, headers: dict = None, stream: bool = False
+    ) -> Response:
+        left = remaining()
+        if left is not None and left <= 0:
+            UPSTREAM_ERRORS.inc(upstream=self.upstream, reason="deadline")
+            raise DeadlineExceededException(f"deadline exceeded before {method} {url}")
+        if not self.breaker.allow():
+            UPSTREAM_ERRORS.inc(upstream=self.upstream, reason="circuit_open")
+            raise CircuitOpenException(f"circuit of {self.upstream} open")
+
+        started = time.monotonic()
+        try:
+            request = self.client.build_request(
+                method=method,
+                url=urljoin(self.endpoint, url),
+                params=params,
+                json=data,
+                headers=headers,
+                timeout=bounded_timeout(self.timeout, left),
             )
+            # a streamed response is timed until its headers arrived
+            response = await self.client.send(request, stream=stream)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream=self.upstream, reason=type(e).__name__)
+            self.breaker.record(ok=False)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.monotonic() - started, upstream=self.upstream, method=method)
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(upstream=self.upstream, reason=f"http_{response.status_code // 100}xx")
+        # client errors, e.g. GOST object duplicated, say nothing about upstream health
+        self.breaker.record(ok=response.status_code < 500)
+        return response
+
+    async def req(
+        self, url: str, method: str, params: dict = None, data: dict = None, headers: dict = None, stream: bool = False
+    ) -> Response:
+        """
+        Request upstream through its circuit breaker within the current deadline.
+        GET and PUT are retried with jittered exponential backoff on transport errors and gateway responses.
+        :param stream: leave the body unread, the caller reads and closes the response
+        :return:
+        """
+        method = method.upper()
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            try:
+                response = await self._send(
+                    url=url, method=method, params=params, data=data, headers=headers, stream=stream
+                )
+                if response.status_code not in RETRY_STATUS or "Retry-After" in response.headers:
+                    return response
+                error = None
+            except httpx.TransportError as e:
+                error = e
+
+            delay = backoff_delay(attempt=attempt, base=self.backoff_base, cap=self.backoff_max)
+            left = remaining()
+            if attempt >= retries or (left is not None and left <= delay):
+                if error is not None:
+                    raise error
+                return response
+            if error is None:
+                await response.aclose()
+            attempt += 1
+            UPSTREAM_RETRIES.inc(upstream=self.upstream)
+            await asyncio.sleep(delay)
+
+
+def pool_options(cfg: dict) -> dict:
+    """
+    Extract connection pool options from a config section.
+    :param cfg:
+    :return:
+    """
+    keys = (
+        "timeout",
+        "connect_timeout",
+        "read_timeout",
+        "max_connections",
+        "max_keepalive_connections",
+        "keepalive_expiry",
+        "http2",
+        "retries",
+        "backoff_base",
+        "backoff_max",
+        "breaker_failures",
+        "breaker_reset",
+    )
+    return {k: cfg[k] for k in keys if k in cfg}
 
 
 class TYZApi(BasicApi):
-    def __init__(self, endpoint: str, node_id: int, token: str):
-        super().__init__(endpoint)
+    kind = "panel"
+
+    def __init__(self, endpoint: str, node_id: int, token: str, **kwargs):
+        super().__init__(endpoint, **kwargs)
         self.node_id = node_id
         self.token = token
+        # monotonic time before which panel asked us not to call it
+        self.retry_after_until = 0
+
+    def retry_after(self) -> float:
+        """
+        Seconds left of panel's Retry-After.
+        :return:
+        """
+        return max(0.0, self.retry_after_until - time.monotonic())
+
+    def _throttled(self, response: Response) -> bool:
+        if response.status_code not in (429, 503):
+            return False
+
+        value = response.headers.get("Retry-After", "")
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = 60 if response.status_code == 429 else 0
+        if seconds > 0:
+            self.retry_after_until = max(self.retry_after_until, time.monotonic() + seconds)
+            logger.warning(f"panel throttled with http {response.status_code}, retry after {seconds:.0f}s")
+        return True
 
     async def request(
         self, url: str, method: str, params: dict = None, data: dict = None
@@ -37,7 +294,9 @@ class TYZApi(BasicApi):
                 raise TYZApiException(f"unsupported method: {method}")
 
             response = await self.req(method=method, url=url, params=params, data=data)
-            result = response.json()
+            if self._throttled(response):
+                return False, f"throttled: http {response.status_code}", None
+            result = await self.decode(response)
             msg = result.get("msg", "")
             return response.status_code == 200, msg, result
         except JSONDecodeError:
@@ -54,19 +313,77 @@ class TYZApi(BasicApi):
             data={"node_id": self.node_id, "token": self.token, "id": rule_id, "type": rule_type, "status": status},
         )
 
+    async def update_relay_rule_status_batch(self, statuses: list) -> Tuple[Optional[bool], str, Optional[dict]]:
+        """
+        Update status of many relay rules in one call.
+        :param statuses: [{"id": 1, "type": "Tunnel", "status": 3}, ...]
+        :return: success, None when panel has no batch endpoint, msg, result
+        """
+        try:
+            response = await self.req(
+                url="/api/relay-rule-sync/batch/",
+                method="PUT",
+                data={"node_id": self.node_id, "token": self.token, "rules": statuses},
+            )
+            if response.status_code in (404, 405, 501):
+                return None, f"batch status unsupported: http {response.status_code}", None
+            if self._throttled(response):
+                return False, f"throttled: http {response.status_code}", None
+            result = await self.decode(response)
+            return response.status_code == 200, result.get("msg", ""), result
+        except JSONDecodeError:
+            logger.error(f"json decode error:\n{response.text}")
+            return False, "json decode error", None
+        except Exception as e:
+            logger.error(f"panel req error: {e}")
+            return False, f"req error: {e}", None
+
     async def fetch_relay_rules(self):
         return await self.request(
             url="/api/relay-rule-sync/", method="GET", params={"node_id": self.node_id, "token": self.token}
         )
 
+    async def fetch_relay_rules_if_changed(
+        self, etag: str = "", version: str = ""
+    ) -> Tuple[bool, str, Optional[dict], str]:
+        """
+        Fetch relay rules conditionally, result is None when rules not modified since etag or version.
+        :param etag: ETag of last fetch
+        :param version: rule set version of last fetch, for panels without ETag support
+        :return: success, msg, result, new etag
+        """
+        params = {"node_id": self.node_id, "token": self.token}
+        if version:
+            params["version"] = version
+        headers = {"If-None-Match": etag} if etag else None
+        try:
+            response = await self.req(url="/api/relay-rule-sync/", method="GET", params=params, headers=headers)
+            if response.status_code == 304:
+                return True, "not modified", None, etag
+            if self._throttled(response):
+                return False, f"throttled: http {response.status_code}", None, ""
+
+            result = await self.decode(response)
+            msg = result.get("msg", "")
+            return response.status_code == 200, msg, result, response.headers.get("ETag", "")
+        except JSONDecodeError:
+            logger.error(f"json decode error:\n{response.text}")
+            return False, "json decode error", None, ""
+        except Exception as e:
+            logger.error(f"panel req error: {e}")
+            return False, f"req error: {e}", None, ""
+
     async def traffic_report(self, data: dict):
         post_data = {"node_id": self.node_id, "token": self.token, "data": data}
         return await self.request(url="/api/relay-rule-traffic/", method="POST", data=post_data)
 
 
 class GOSTApi(BasicApi):
-    def __init__(self, endpoint: str):
-        super().__init__(endpoint)
+    kind = "gost"
+
+    def __init__(self, endpoint: str, mirror_refresh_interval: int = 300, **kwargs):
+        super().__init__(endpoint, **kwargs)
+        self.mirror = GOSTMirror(refresh_interval=mirror_refresh_interval)
 
     async def request(self, url: str, method: str, data: dict = None) -> Tuple[bool, str, Optional[dict]]:
         try:
@@ -74,7 +391,7 @@ class GOSTApi(BasicApi):
                 raise GOSTApiException(f"unsupported method: {method}")
 
             response = await self.req(method=method, url=url, data=data)
-            result = response.json()
+            result = await self.decode(response)
             msg = result.get("msg", "")
             return response.status_code == 200, msg, result
         except JSONDecodeError:
@@ -86,13 +403,15 @@ class GOSTApi(BasicApi):
 
 
 class PrometheusApi(BasicApi):
-    def __init__(self, endpoint: str):
-        super().__init__(endpoint=endpoint)
+    kind = "prometheus"
+
+    def __init__(self, endpoint: str, **kwargs):
+        super().__init__(endpoint=endpoint, **kwargs)
 
     async def request(self, url: str, method: str, params: dict = None) -> Tuple[bool, Optional[dict]]:
         try:
             response = await self.req(method=method.upper(), url=urljoin(self.endpoint, url), params=params)
-            result = response.json()
+            result = await self.decode(response)
             success = result.get("status", "") == "success"
             return success, result
         except JSONDecodeError:
@@ -101,3 +420,32 @@ class PrometheusApi(BasicApi):
         except Exception as e:
             logger.error(f"prometheus req error: {e}")
             return False, None
+
+
+class GOSTMetricsApi(BasicApi):
+    kind = "gost"
+
+    def __init__(self, endpoint: str, path: str = "/metrics", **kwargs):
+        super().__init__(endpoint=endpoint, **kwargs)
+        self.path = path
+
+    async def scrape(self, parser: ServiceTransferParser) -> bool:
+        """
+        Scrape GOST metrics endpoint, lines are fed to parser as they arrive.
+        :param parser:
+        :return:
+        """
+        try:
+            response = await self.req(url=self.path, method="GET", stream=True)
+            try:
+                if response.status_code != 200:
+                    logger.error(f"gost metrics scrape error: http {response.status_code}")
+                    return False
+                async for line in response.aiter_lines():
+                    parser.feed(line)
+            finally:
+                await response.aclose()
+            return True
+        except Exception as e:
+            logger.error(f"gost metrics scrape error: {e}")
+            return False
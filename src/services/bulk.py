@@ -0,0 +1,206 @@
+import abc
+import asyncio
+import copy
+import json
+import logging
+import os
+import signal
+from pathlib import Path
+from typing import Optional
+
+from utils import consts
+from utils.gost import live_digest, spec_digest
+from .api import TYZApi, GOSTApi
+from .executor import Executor, LANE_WRITE
+from .gost import fetch_all_config, render_observer
+from .plan import OBJECTS_APPLIED, PlanAction, SyncPlan
+from .status import StatusCoalescer
+
+logger = logging.getLogger(__name__)
+
+KIND = consts.GOSTObjectKind
+OP = consts.PlanOp
+
+OBSERVER_NAME = "node-observer"
+
+
+def render_full_config(base: dict, plan: SyncPlan, observer_addr: str = "") -> dict:
+    """
+    Render complete GOST config: the current one with plan applied, other top-level sections are kept as is.
+    :param base: current full GOST config
+    :param plan:
+    :param observer_addr: url of node observer, the observer is ensured when set
+    :return:
+    """
+    cfg = copy.deepcopy(base)
+    objects = {k.value: {o.get("name"): o for o in cfg.get(k.value) or []} for k in KIND}
+    for a in plan.actions:
+        if a.op == OP.DELETE.value:
+            objects[a.kind].pop(a.name, None)
+        else:
+            objects[a.kind][a.name] = a.data
+    for kind, objs in objects.items():
+        cfg[kind] = list(objs.values())
+
+    if observer_addr:
+        observers = [o for o in cfg.get("observers") or [] if o.get("name") != OBSERVER_NAME]
+        cfg["observers"] = observers + [render_observer(name=OBSERVER_NAME, addr=observer_addr)]
+    return cfg
+
+
+class BulkBackend(abc.ABC):
+    """
+    Apply a complete GOST config in one operation, used instead of per-object calls for large plans.
+    """
+
+    def __init__(self, threshold: int = 200, observer_addr: str = ""):
+        # minimum plan size applied in bulk
+        self.threshold = threshold
+        self.observer_addr = observer_addr
+
+    def wanted(self, plan: SyncPlan) -> bool:
+        return 0 < self.threshold <= len(plan)
+
+    @abc.abstractmethod
+    async def replace(self, gost_api: GOSTApi, cfg: dict) -> bool:
+        """
+        Make GOST run the complete config.
+        :param gost_api:
+        :param cfg:
+        :return: whether GOST took the config
+        """
+
+    async def settle(self):
+        """
+        Wait for GOST to run the replaced config, called outside the executor slot of `replace`.
+        :return:
+        """
+
+
+class FileBulkBackend(BulkBackend):
+    """
+    Write GOST config file atomically, then make GOST reload it by signal or command.
+    """
+
+    def __init__(self, path: str, pid_file: str = "", reload_command: str = "", reload_wait: float = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.pid_file = pid_file
+        self.reload_command = reload_command
+        # seconds for GOST to load the file before the API is read again
+        self.reload_wait = reload_wait
+
+    def _write(self, cfg: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cfg, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def _reload(self) -> bool:
+        if self.reload_command:
+            proc = await asyncio.create_subprocess_shell(self.reload_command)
+            if await proc.wait() != 0:
+                logger.error(f"gost reload command exited with {proc.returncode}")
+                return False
+            return True
+
+        pid = int(Path(self.pid_file).read_text().strip())
+        os.kill(pid, signal.SIGHUP)
+        return True
+
+    async def replace(self, gost_api: GOSTApi, cfg: dict) -> bool:
+        try:
+            await asyncio.to_thread(self._write, cfg)
+            if not await self._reload():
+                return False
+        except (OSError, ValueError) as e:
+            logger.error(f"write gost config file {self.path} error: {e}")
+            return False
+        return True
+
+    async def settle(self):
+        await asyncio.sleep(self.reload_wait)
+
+
+def build_bulk_backend(cfg: dict) -> Optional[BulkBackend]:
+    """
+    Build bulk backend from `[gost.bulk]` config section, None when not configured.
+    :param cfg:
+    :return:
+    """
+    # GOST web API has no endpoint replacing the running config, it is reloaded from file
+    mode = cfg.get("mode", "")
+    options = {"threshold": cfg.get("threshold", 200), "observer_addr": cfg.get("observer_addr", "")}
+    if mode == "file":
+        return FileBulkBackend(
+            path=cfg.get("path", "gost.json"),
+            pid_file=cfg.get("pid_file", ""),
+            reload_command=cfg.get("reload_command", ""),
+            reload_wait=cfg.get("reload_wait", 1),
+            **options,
+        )
+    elif mode:
+        logger.warning(f"unsupported bulk mode {mode}, bulk apply disabled")
+    return None
+
+
+def _applied(action: PlanAction, live: dict) -> bool:
+    """
+    Whether GOST runs the result of an action, written objects are compared by content hash.
+    :param action:
+    :param live: live GOST objects by kind
+    :return:
+    """
+    old = live[action.kind].get(action.name)
+    if action.op == OP.DELETE.value:
+        return old is None
+    return old is not None and live_digest(live=old, desired=action.data) == spec_digest(desired=action.data)
+
+
+async def apply_bulk(
+    plan: SyncPlan,
+    panel_api: TYZApi,
+    gost_api: GOSTApi,
+    executor: Executor,
+    backend: BulkBackend,
+    status: StatusCoalescer = None,
+) -> Optional[dict]:
+    """
+    Apply whole plan as one GOST config replacement.
+    :param plan:
+    :param panel_api:
+    :param gost_api:
+    :param executor:
+    :param backend:
+    :param status: rule status coalescer
+    :return: applied plan summary, None when bulk apply failed and nothing is known to be applied
+    """
+    base = await fetch_all_config(gost_api=gost_api)
+    cfg = await asyncio.to_thread(render_full_config, base=base, plan=plan, observer_addr=backend.observer_addr)
+    if not await executor.run(gost_api.upstream, LANE_WRITE, backend.replace, gost_api=gost_api, cfg=cfg):
+        return None
+    await backend.settle()
+
+    # read back what GOST runs, the next cycle replans anything that did not stick
+    gost_cfg = await fetch_all_config(gost_api=gost_api)
+    await asyncio.to_thread(gost_api.mirror.load, gost_cfg=gost_cfg)
+    live = gost_api.mirror.objects
+    missing = set()
+    for a in plan.actions:
+        ok = _applied(action=a, live=live)
+        OBJECTS_APPLIED.inc(kind=a.kind, op=a.op, result="ok" if ok else "failed")
+        if not ok and a.rule:
+            missing.add(a.rule.service_name)
+    writes = [a for a in plan.select(kinds=tuple(live), ops=(OP.CREATE.value, OP.UPDATE.value)) if a.rule]
+    if status is None:
+        status = StatusCoalescer(panel_api=panel_api, executor=executor)
+    for a in writes:
+        if a.rule.service_name not in missing:
+            status.mark(rule=a.rule, status=3)
+    await status.flush()
+
+    logger.info(f"bulk apply sync plan {plan.summary()}")
+    return {"summary": plan.summary(), "failed": []}
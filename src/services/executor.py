@@ -0,0 +1,176 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Awaitable, Dict
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LANE_WRITE = "write"
+LANE_DELETE = "delete"
+LANE_STATUS = "status"
+LANE_READ = "read"
+
+DEFAULT_LANE_WEIGHTS = {LANE_WRITE: 4, LANE_DELETE: 2, LANE_STATUS: 2, LANE_READ: 2}
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "gost_node_executor_queue_depth", "Queued calls per upstream and lane", ("upstream", "lane")
+)
+IN_FLIGHT = REGISTRY.gauge("gost_node_executor_in_flight", "Running calls per upstream", ("upstream",))
+WAIT_SECONDS = REGISTRY.histogram("gost_node_executor_wait_seconds", "Time calls spent queued", ("upstream", "lane"))
+RUN_SECONDS = REGISTRY.histogram("gost_node_executor_run_seconds", "Time calls spent running", ("upstream", "lane"))
+
+
+@dataclass
+class UpstreamLimit:
+    # max calls running at once
+    concurrency: int = 16
+    # max calls started per second, 0 means unlimited
+    rate: float = 0
+    lane_weights: Dict[str, int] = field(default_factory=lambda: dict(DEFAULT_LANE_WEIGHTS))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Upstream:
+    def __init__(self, name: str, limit: UpstreamLimit):
+        self.name = name
+        self.limit = limit
+        self.queues = {lane: deque() for lane in limit.lane_weights}
+        # weighted round-robin order, a lane appears as many times as its weight
+        self.order = [lane for lane, w in limit.lane_weights.items() for _ in range(max(w, 1))]
+        self.cursor = 0
+        self.running = 0
+        self.bucket = TokenBucket(rate=limit.rate) if limit.rate > 0 else None
+
+    def next_item(self):
+        for _ in range(len(self.order)):
+            lane = self.order[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.order)
+            queue = self.queues[lane]
+            while queue:
+                item = queue.popleft()
+                QUEUE_DEPTH.set(len(queue), upstream=self.name, lane=lane)
+                if not item[0].done():
+                    return lane, item
+        return None
+
+
+class Executor:
+    """
+    Run upstream calls with bounded concurrency and rate per upstream.
+    Each upstream has lanes served by weighted round-robin, so one kind of call cannot starve the others.
+    """
+
+    def __init__(self, limits: Dict[str, UpstreamLimit] = None):
+        self.limits = limits or {}
+        self.upstreams: Dict[str, _Upstream] = {}
+        self._tasks = set()
+
+    @classmethod
+    def from_config(cls, cfg: dict) -> "Executor":
+        """
+        Build executor from `[executor.<upstream>]` config sections.
+        :param cfg:
+        :return:
+        """
+        limits = {}
+        for name, c in cfg.items():
+            weights = dict(DEFAULT_LANE_WEIGHTS)
+            weights.update(c.get("lanes", {}))
+            limits[name] = UpstreamLimit(
+                concurrency=c.get("concurrency", 16), rate=c.get("rate", 0), lane_weights=weights
+            )
+        return cls(limits=limits)
+
+    def _upstream(self, name: str) -> _Upstream:
+        upstream = self.upstreams.get(name)
+        if upstream is None:
+            # `gost@127.0.0.1:18080` uses limits of `gost` unless configured exactly
+            limit = self.limits.get(name) or self.limits.get(name.split("@")[0], UpstreamLimit())
+            upstream = self.upstreams[name] = _Upstream(name=name, limit=limit)
+        return upstream
+
+    async def run(self, upstream: str, lane: str, func: Callable[..., Awaitable], *args, **kwargs):
+        """
+        Queue a call and wait for its result.
+        :param upstream: upstream name, `<gost|panel|prometheus>@<host:port>`
+        :param lane: write, delete, status or read
+        :param func: coroutine function
+        :return: result of func
+        """
+        u = self._upstream(upstream)
+        if lane not in u.queues:
+            raise ValueError(f"unknown lane {lane} of upstream {upstream}")
+
+        future = asyncio.get_running_loop().create_future()
+        # calls run in the context of the caller, e.g. with its deadline
+        u.queues[lane].append((future, func, args, kwargs, time.monotonic(), contextvars.copy_context()))
+        QUEUE_DEPTH.set(len(u.queues[lane]), upstream=upstream, lane=lane)
+        self._dispatch(u)
+        return await future
+
+    def _dispatch(self, u: _Upstream):
+        while u.running < u.limit.concurrency:
+            picked = u.next_item()
+            if picked is None:
+                return
+            u.running += 1
+            IN_FLIGHT.set(u.running, upstream=u.name)
+            task = asyncio.create_task(self._execute(u, *picked), context=picked[1][-1])
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, u: _Upstream, lane: str, item: tuple):
+        future, func, args, kwargs, enqueued, _ = item
+        try:
+            if u.bucket:
+                await u.bucket.acquire()
+            started = time.monotonic()
+            WAIT_SECONDS.observe(started - enqueued, upstream=u.name, lane=lane)
+            result = await func(*args, **kwargs)
+            RUN_SECONDS.observe(time.monotonic() - started, upstream=u.name, lane=lane)
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            u.running -= 1
+            IN_FLIGHT.set(u.running, upstream=u.name)
+            self._dispatch(u)
+
+    def stats(self) -> dict:
+        """
+        Queue depth and running calls per upstream.
+        :return:
+        """
+        return {
+            name: {"running": u.running, "queued": {lane: len(q) for lane, q in u.queues.items()}}
+            for name, u in self.upstreams.items()
+        }
@@ -1,9 +1,11 @@
+import asyncio
 import logging
-from typing import List
+from typing import List, Dict, Optional
 
 from exceptions.gost import GOSTApiException
 from services.api import GOSTApi, PrometheusApi
-from utils.gost import GOSTAuth, RelayRuleLimit
+from utils import consts
+from utils.models import ChainSpec, ServiceSpec
 
 logger = logging.getLogger(__name__)
 
@@ -16,305 +18,205 @@ async def fetch_all_config(gost_api: GOSTApi) -> dict:
         raise GOSTApiException(f"fetch all config error: {msg}")
 
 
-async def del_service(gost_api: GOSTApi, name: str):
+async def load_gost_objects(gost_api: GOSTApi, force: bool = False) -> dict:
     """
-    Delete service.
+    Load GOST objects by kind and name from the mirror, full config is fetched only when refresh is due.
     :param gost_api:
-    :param name:
+    :param force: refresh the mirror from GOST
     :return:
     """
-    await gost_api.request(url=f"/config/services/{name}", method="DELETE")
+    if force or gost_api.mirror.refresh_due():
+        gost_cfg = await fetch_all_config(gost_api=gost_api)
+        await asyncio.to_thread(gost_api.mirror.load, gost_cfg=gost_cfg)
+    return gost_api.mirror.objects
 
 
-async def del_chain(gost_api: GOSTApi, name: str):
+async def add_object(gost_api: GOSTApi, kind: str, data: dict, fallback: bool = True) -> bool:
     """
-    Delete chain.
+    Create GOST object, update it if GOST already has it.
     :param gost_api:
-    :param name:
+    :param kind: object kind, services/chains/limiters/climiters
+    :param data: rendered object
+    :param fallback: update when the object is duplicated
     :return:
     """
-    await gost_api.request(url=f"/config/chains/{name}", method="DELETE")
+    success, msg, result = await gost_api.request(url=f"/config/{kind}", method="post", data=data)
+    if success and msg == "OK":
+        gost_api.mirror.put(kind=kind, data=data)
+        return True
+    elif fallback and msg == "object duplicated":
+        # mirror missed an object GOST has
+        gost_api.mirror.invalidate()
+        return await update_object(gost_api=gost_api, kind=kind, name=data.get("name"), data=data, fallback=False)
+    else:
+        logger.error(f"add {kind} {data.get('name')} error: {msg}")
+        return False
 
 
-async def update_ws_chain(gost_api: GOSTApi, name: str, relay: str, auth: GOSTAuth) -> bool:
-    data = {
-        "hops": [
-            {
-                "name": f"{name}-hop",
-                "nodes": [
-                    {
-                        "name": f"{name}-relay-node",
-                        "addr": relay,
-                        "connector": {"type": "relay", "auth": {"username": auth.username, "password": auth.password}},
-                        "dialer": {"type": "ws"},
-                    }
-                ],
-            }
-        ],
-    }
-    success, msg, result = await gost_api.request(url=f"/config/chains/{name}", method="put", data=data)
+async def update_object(gost_api: GOSTApi, kind: str, name: str, data: dict, fallback: bool = True) -> bool:
+    """
+    Update GOST object, create it if GOST does not have it.
+    :param gost_api:
+    :param kind: object kind, services/chains/limiters/climiters
+    :param name: object name
+    :param data: rendered object
+    :param fallback: create when the object is not found
+    :return:
+    """
+    success, msg, result = await gost_api.request(url=f"/config/{kind}/{name}", method="put", data=data)
     if success and msg == "OK":
+        gost_api.mirror.put(kind=kind, data={**data, "name": name})
         return True
+    elif fallback and msg == "object not found":
+        # mirror has an object GOST lost
+        gost_api.mirror.invalidate()
+        return await add_object(gost_api=gost_api, kind=kind, data={**data, "name": name}, fallback=False)
     else:
-        logger.error(f"update ws chain error: {msg}")
+        logger.error(f"update {kind} {name} error: {msg}")
         return False
 
 
-async def add_ws_chain(gost_api: GOSTApi, name: str, relay: str, auth: GOSTAuth) -> bool:
-    data = {
-        "name": name,
+async def del_object(gost_api: GOSTApi, kind: str, name: str) -> bool:
+    """
+    Delete GOST object.
+    :param gost_api:
+    :param kind: object kind, services/chains/limiters/climiters
+    :param name: object name
+    :return:
+    """
+    success, msg, result = await gost_api.request(url=f"/config/{kind}/{name}", method="DELETE")
+    if success and msg == "OK":
+        gost_api.mirror.remove(kind=kind, name=name)
+        return True
+    else:
+        logger.error(f"delete {kind} {name} error: {msg}")
+        return False
+
+
+def render_chain(chain: ChainSpec) -> dict:
+    """
+    Render websocket relay chain.
+    :param chain:
+    :return:
+    """
+    return {
+        "name": chain.name,
         "hops": [
             {
-                "name": f"{name}-hop",
+                "name": f"{chain.name}-hop",
                 "nodes": [
                     {
-                        "name": f"{name}-relay-node",
-                        "addr": relay,
-                        "connector": {"type": "relay", "auth": {"username": auth.username, "password": auth.password}},
+                        "name": f"{chain.name}-relay-node",
+                        "addr": chain.relay,
+                        "connector": {
+                            "type": "relay",
+                            "auth": {"username": chain.auth.username, "password": chain.auth.password},
+                        },
                         "dialer": {"type": "ws"},
                     }
                 ],
             }
         ],
     }
-    success, msg, result = await gost_api.request(url="/config/chains", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif msg == "object duplicated":
-        return await update_ws_chain(gost_api=gost_api, name=name, relay=relay, auth=auth)
-    else:
-        logger.error(f"add ws chain error: {msg}")
-        return False
 
 
-async def update_ws_ingress_service(
-    gost_api: GOSTApi, name: str, addr: str, targets: List[str], limit: RelayRuleLimit = None
-) -> bool:
-    chain_name = f"{name}-chain"
-    data = {
-        "addr": addr,
-        "handler": {"type": "tcp", "chain": chain_name},
-        "listener": {"type": "tcp"},
-        "forwarder": {
-            "nodes": [{"name": f"{name}-target-{index}", "addr": target}] for index, target in enumerate(targets)
-        },
-        "observer": "node-observer",
-    }
-    if limit:
-        speed_limiter_name = f"{name}-speed-limiter"
-        conn_limiter_name = f"{name}-conn-limiter"
-        data["limiter"] = speed_limiter_name
-        data["climiter"] = conn_limiter_name
-
-    success, msg, result = await gost_api.request(url=f"/config/services/{name}", method="put", data=data)
-    if success and msg == "OK":
-        return True
-    else:
-        logger.error(f"update ws ingress service error: {msg}")
-        return False
-
-
-async def add_ws_ingress_service(
-    gost_api: GOSTApi,
-    name: str,
-    addr: str,
-    relay: str,
-    targets: List[str],
-    auth: GOSTAuth,
-    limit: RelayRuleLimit = None,
-):
+def render_service(service: ServiceSpec) -> dict:
     """
-
-    :param gost_api: gost endpoint
-    :param name: service name
-    :param addr: listen address
-    :param relay: relay address
-    :param targets: relay targets
-    :param auth:
-    :param limit:
+    Render service of a rule: websocket egress, tcp ingress through chain, or raw tcp redirect.
+    :param service:
     :return:
     """
-    chain_name = f"{name}-chain"
-    await add_ws_chain(gost_api=gost_api, name=chain_name, relay=relay, auth=auth)
+    if service.type == consts.RuleType.EGRESS.value:
+        return {
+            "name": service.name,
+            "addr": service.addr,
+            "handler": {
+                "type": "relay",
+                "auth": {"username": service.auth.username, "password": service.auth.password},
+            },
+            "listener": {"type": "ws"},
+            "observer": "node-observer",
+        }
+
+    node_prefix = "target" if service.chain else "node"
     data = {
-        "name": name,
-        "addr": addr,
-        "handler": {"type": "tcp", "chain": chain_name},
+        "name": service.name,
+        "addr": service.addr,
+        "handler": {"type": "tcp", "chain": service.chain} if service.chain else {"type": "tcp"},
         "listener": {"type": "tcp"},
         "forwarder": {
-            "nodes": [{"name": f"{name}-target-{index}", "addr": target}] for index, target in enumerate(targets)
+            "nodes": [
+                {"name": f"{service.name}-{node_prefix}-{index}", "addr": t} for index, t in enumerate(service.targets)
+            ]
         },
         "observer": "node-observer",
     }
-
-    if limit:
-        speed_limiter_name = f"{name}-speed-limiter"
-        conn_limiter_name = f"{name}-conn-limiter"
-        data["limiter"] = speed_limiter_name
-        data["climiter"] = conn_limiter_name
-
-    success, msg, result = await gost_api.request(url="/config/services", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif "object duplicated" == msg:
-        return await update_ws_ingress_service(gost_api=gost_api, name=name, addr=addr, targets=targets)
-    else:
-        logger.error(f"add ws ingress service error: {msg}")
-        return False
+    if service.selector:
+        data["forwarder"]["selector"] = service.selector
+    if service.limiter:
+        data["limiter"] = service.limiter
+    if service.climiter:
+        data["climiter"] = service.climiter
+    return data
 
 
-async def update_ws_egress_service(gost_api: GOSTApi, name: str, addr: str, auth: GOSTAuth) -> bool:
-    data = {
-        "addr": addr,
-        "handler": {"type": "relay", "auth": {"username": auth.username, "password": auth.password}},
-        "listener": {"type": "ws"},
-        "observer": "node-observer",
-    }
-    success, msg, result = await gost_api.request(url=f"/config/services/{name}", method="put", data=data)
-    if success and msg == "OK":
-        return True
-    else:
-        logger.error(f"update ws egress service error: {msg}")
-        return False
-
-
-async def add_ws_egress_service(gost_api: GOSTApi, name: str, addr: str, auth: GOSTAuth) -> bool:
-    data = {
-        "name": name,
-        "addr": addr,
-        "handler": {"type": "relay", "auth": {"username": auth.username, "password": auth.password}},
-        "listener": {"type": "ws"},
-        "observer": "node-observer",
-    }
-    success, msg, result = await gost_api.request(url="/config/services", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif "object duplicated" == msg:
-        return await update_ws_egress_service(gost_api=gost_api, name=name, addr=addr, auth=auth)
-    else:
-        logger.error(f"add ws egress service error: {msg}")
-        return False
-
-
-async def update_raw_redir_service(
-    gost_api: GOSTApi, name: str, addr: str, targets: List[str], limit: RelayRuleLimit = None
-) -> bool:
-    data = {
-        "addr": addr,
-        "handler": {"type": "tcp"},
-        "listener": {"type": "tcp"},
-        "forwarder": {"nodes": [{"name": f"{name}-node-{index}", "addr": t} for index, t in enumerate(targets)]},
-    }
-    if limit:
-        speed_limiter_name = f"{name}-speed-limiter"
-        conn_limiter_name = f"{name}-conn-limiter"
-        data["limiter"] = speed_limiter_name
-        data["climiter"] = conn_limiter_name
-    success, msg, result = await gost_api.request(url=f"/config/services/{name}", method="put", data=data)
-    if success and msg == "OK":
-        return True
-    else:
-        logger.error(f"update raw redirect service error: {msg}")
-        return False
-
-
-async def add_raw_redir_service(
-    gost_api: GOSTApi, name: str, addr: str, targets: List[str], limit: RelayRuleLimit = None
-) -> bool:
-    data = {
-        "name": name,
-        "addr": addr,
-        "handler": {"type": "tcp"},
-        "listener": {"type": "tcp"},
-        "forwarder": {"nodes": [{"name": f"{name}-node-{index}", "addr": t} for index, t in enumerate(targets)]},
-    }
-
-    if limit:
-        speed_limiter_name = f"{name}-speed-limiter"
-        conn_limiter_name = f"{name}-conn-limiter"
-        data["limiter"] = speed_limiter_name
-        data["climiter"] = conn_limiter_name
-
-    success, msg, result = await gost_api.request(url="/config/services", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif msg == "object duplicated":
-        return await update_raw_redir_service(gost_api=gost_api, name=name, addr=addr, targets=targets, limit=limit)
-    else:
-        logger.error(f"add raw redirect service error: {msg}")
-        return False
-
-
-async def update_speed_limiter(gost_api: GOSTApi, name: str, values: List = None) -> bool:
-    data = {"limits": values}
-    success, msg, result = await gost_api.request(url=f"/config/limiters/{name}", method="put", data=data)
-    if success and msg == "OK":
-        return True
-    else:
-        logger.error(f"update speed limiter error: {msg}")
-        return False
-
+def render_observer(name: str, addr: str) -> dict:
+    """
+    Render http observer plugin, GOST posts service events to it.
+    :param name:
+    :param addr: observer url, e.g. http://127.0.0.1:8080/observer
+    :return:
+    """
+    return {"name": name, "plugin": {"type": "http", "addr": addr}}
 
-async def add_speed_limiter(gost_api: GOSTApi, name: str, values: List = None) -> bool:
-    if not values:
-        return True
 
-    data = {"name": name, "limits": values}
-    success, msg, result = await gost_api.request(url="/config/limiters", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif msg == "object duplicated":
-        return await update_speed_limiter(gost_api=gost_api, name=name, values=values)
-    else:
-        logger.error(f"add speed limiter error: {msg}")
-        return False
+def render_limiter(name: str, values: List[str]) -> dict:
+    """
+    Render speed or conn limiter.
+    :param name:
+    :param values:
+    :return:
+    """
+    return {"name": name, "limits": values}
 
 
-async def update_conn_limiter(gost_api: GOSTApi, name: str, values: List = None) -> bool:
-    data = {"limits": values}
-    success, msg, result = await gost_api.request(url=f"/config/climiters/{name}", method="put", data=data)
-    if success and msg == "OK":
-        return True
-    else:
-        logger.error(f"update speed limiter error: {msg}")
-        return False
+TRAFFIC_METRICS = {
+    "input": "gost_service_transfer_input_bytes_total",
+    "output": "gost_service_transfer_output_bytes_total",
+}
 
 
-async def add_conn_limiter(gost_api: GOSTApi, name: str, values: List = None) -> bool:
-    if not values:
-        return True
+async def query_traffic_by_service(prom_api: PrometheusApi, start: float, end: float) -> Optional[Dict[str, dict]]:
+    """
+    Query traffic of both directions by service in (start, end], with one query evaluated at end.
+    :param prom_api:
+    :param start: unix timestamp, last reported boundary
+    :param end: unix timestamp
+    :return: {service: {"input": bytes, "output": bytes}}, None on error
+    """
+    window = int(end - start)
+    pql = " or ".join(
+        f'label_replace(sum by (service) (increase({metric}[{window}s])), "direction", "{direction}", "", "")'
+        for direction, metric in TRAFFIC_METRICS.items()
+    )
+    success, result = await prom_api.request(url="/api/v1/query", method="get", params={"query": pql, "time": end})
+    if not success:
+        logger.error("prom query error")
+        return None
 
-    data = {"name": name, "limits": values}
-    success, msg, result = await gost_api.request(url="/config/climiters", method="post", data=data)
-    if success and msg == "OK":
-        return True
-    elif msg == "object duplicated":
-        return await update_conn_limiter(gost_api=gost_api, name=name, values=values)
-    else:
-        logger.error(f"add speed limiter error: {msg}")
-        return False
+    return await asyncio.to_thread(parse_traffic_result, result=result)
 
 
-async def calc_traffic_by_service(prom_api: PrometheusApi, seconds: int, direction: str) -> dict:
+def parse_traffic_result(result: dict) -> Dict[str, dict]:
     """
-    Calculate traffic by service during seconds.
-    :param prom_api:
-    :param seconds:
-    :param direction:
+    Traffic by service and direction from a prometheus query result.
+    :param result:
     :return:
     """
     traffics = {}
-    metrics = {"input": "gost_service_transfer_input_bytes_total", "output": "gost_service_transfer_output_bytes_total"}
-    pql = f"sum by (service) (increase({metrics[direction]}[{seconds}s]))"
-    success, result = await prom_api.request(url="/api/v1/query", method="get", params={"query": pql})
-    if not success:
-        logger.error(f"prom query error")
-        return traffics
-
-    data = result.get("data", {}).get("result", [])
-    for d in data:
-        service_name = d.get("metric", {}).get("service", "")
-        value = float(d.get("value", [])[1])
-        traffics[service_name] = value
+    for d in result.get("data", {}).get("result", []):
+        metric = d.get("metric", {})
+        value = float(d.get("value", [0, 0])[1])
+        traffics.setdefault(metric.get("service", ""), {})[metric.get("direction", "")] = value
 
     return traffics
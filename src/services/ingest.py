@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import REGISTRY
+from .timeseries import TimeSeriesStore
+from .traffic import TrafficAccumulator
+
+logger = logging.getLogger(__name__)
+
+EVENTS_RECEIVED = REGISTRY.counter("gost_node_observer_events_total", "Observer stats events ingested")
+EVENTS_DROPPED = REGISTRY.counter("gost_node_observer_events_dropped_total", "Observer events dropped", ("reason",))
+QUEUE_DEPTH = REGISTRY.gauge("gost_node_observer_queue_depth", "Observer requests waiting in ingest queue")
+BATCH_SIZE = REGISTRY.histogram(
+    "gost_node_observer_batch_size", "Observer requests processed per batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+# observer stats fields, in the order aggregated
+STATS_KEYS = ("inputBytes", "outputBytes", "currentConns", "totalConns", "totalErrs")
+
+# (node name from path, service) -> accumulator of the owning node
+Router = Callable[[str, str], Optional[TrafficAccumulator]]
+
+
+class ObserverIngest:
+    """
+    Ingest GOST observer requests off the request path. Raw bodies are queued as received and returned to GOST at
+    once, a consumer decodes them in batches and feeds the latest counters per service and client.
+    A full queue drops requests rather than holding GOST, drops are counted.
+    """
+
+    def __init__(
+        self,
+        route: Router,
+        queue_size: int = 1024,
+        batch_size: int = 64,
+        series: TimeSeriesStore = None,
+        offload_bytes: int = 64 * 1024,
+    ) -> None:
+        self.route = route
+        # batches at least this large are decoded off the event loop
+        self.offload_bytes = offload_bytes
+        # per-service history, optional
+        self.series = series
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+
+    def submit(self, node: str, body: bytes) -> bool:
+        """
+        Queue a raw observer request body.
+        :param node: node name from path, empty when routed by service name
+        :param body:
+        :return: False if the queue is full and the body dropped
+        """
+        try:
+            self.queue.put_nowait((node, body))
+        except asyncio.QueueFull:
+            EVENTS_DROPPED.inc(reason="queue_full")
+            return False
+        QUEUE_DEPTH.set(self.queue.qsize())
+        return True
+
+    @staticmethod
+    def _decode(body: bytes) -> Optional[list]:
+        try:
+            events = json.loads(body).get("events")
+        except (ValueError, AttributeError):
+            return None
+        return events if isinstance(events, list) else []
+
+    @classmethod
+    def decode(cls, batch: List[Tuple[str, bytes]]) -> List[Tuple[str, Optional[list]]]:
+        """
+        Decode a batch of requests, pure so it can run in a worker thread.
+        :param batch: (node, body) pairs
+        :return: (node, events) pairs, events None for invalid bodies
+        """
+        return [(node, cls._decode(body)) for node, body in batch]
+
+    def process(self, batch: List[Tuple[str, bytes]], decoded: List[Tuple[str, Optional[list]]] = None) -> int:
+        """
+        Decode a batch of requests and feed traffic, counters are aggregated per service and client first.
+        :param batch: (node, body) pairs in arrival order
+        :param decoded: batch decoded already
+        :return: stats events ingested
+        """
+        # (node, service, client) -> [accumulator, input bytes, output bytes, current conns, total conns, total errs]
+        stats: Dict[Tuple[str, str, str], list] = {}
+        events = 0
+        for node, decoded_events in decoded if decoded is not None else self.decode(batch):
+            if decoded_events is None:
+                EVENTS_DROPPED.inc(reason="invalid")
+                continue
+            for e in decoded_events:
+                if not isinstance(e, dict) or e.get("kind") != "service":
+                    continue
+                if e.get("type") == "status":
+                    logger.info(f"service {e.get('service')} status: {e.get('status')}")
+                    continue
+                if e.get("type") != "stats" or not isinstance(e.get("stats"), dict):
+                    continue
+
+                service, client = e.get("service", ""), e.get("client") or ""
+                key = (node, service, client)
+                try:
+                    values = [int(e["stats"].get(k, 0)) for k in STATS_KEYS]
+                except (TypeError, ValueError):
+                    EVENTS_DROPPED.inc(reason="invalid")
+                    continue
+
+                events += 1
+                agg = stats.get(key)
+                if agg is None:
+                    accumulator = self.route(node, service)
+                    if accumulator is None:
+                        logger.warning(f"no node for observer event of {service}")
+                        EVENTS_DROPPED.inc(reason="unrouted")
+                        continue
+                    stats[key] = [accumulator, *values]
+                elif agg[0].reset_traffic:
+                    # traffic reset after each report, every event is a delta
+                    agg[1:] = [agg[1] + values[0], agg[2] + values[1], *values[2:]]
+                else:
+                    # cumulative counters, the latest event carries all
+                    agg[1:] = values
+
+        for (_, service, client), (accumulator, input_bytes, output_bytes, current, total, errs) in stats.items():
+            accumulator.feed(service=service, input_bytes=input_bytes, output_bytes=output_bytes, client=client)
+            if self.series is not None:
+                self.series.feed(
+                    service=service,
+                    current_conns=current,
+                    total_conns=total,
+                    input_bytes=input_bytes,
+                    output_bytes=output_bytes,
+                    total_errs=errs,
+                    client=client,
+                    reset_traffic=accumulator.reset_traffic,
+                )
+        EVENTS_RECEIVED.inc(events)
+        BATCH_SIZE.observe(len(batch))
+        return events
+
+    def _take(self, first: Tuple[str, bytes] = None) -> List[Tuple[str, bytes]]:
+        batch = [first] if first else []
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        QUEUE_DEPTH.set(self.queue.qsize())
+        return batch
+
+    async def run(self):
+        """
+        Consume queued requests until cancelled.
+        :return:
+        """
+        while True:
+            batch = self._take(first=await self.queue.get())
+            try:
+                decoded = None
+                if sum(len(body) for _, body in batch) >= self.offload_bytes:
+                    # large batches are decoded in a worker thread, the loop keeps accepting requests
+                    decoded = await asyncio.to_thread(self.decode, batch)
+                self.process(batch=batch, decoded=decoded)
+            except Exception as e:
+                logger.error(f"process observer events error: {e}")
+
+    def drain(self):
+        """
+        Process everything still queued, on shutdown.
+        :return:
+        """
+        while not self.queue.empty():
+            self.process(batch=self._take())
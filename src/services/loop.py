@@ -0,0 +1,22 @@
+import asyncio
+
+from utils.metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram(
+    "gost_node_event_loop_lag_seconds",
+    "Delay of event loop wakeups past their schedule, observer requests wait as long",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+async def monitor_loop_lag(interval: float = 0.25):
+    """
+    Sleep `interval` repeatedly and record how late each wakeup is, until cancelled.
+    :param interval:
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
@@ -0,0 +1,57 @@
+import logging
+import time
+from typing import Dict
+
+from utils import consts
+from utils.gost import extract_key_from_dict_list
+
+logger = logging.getLogger(__name__)
+
+
+class GOSTMirror:
+    """
+    In-process copy of the GOST objects managed by node, indexed by kind and name.
+    Kept up to date from our own successful writes, and fully refreshed from GOST periodically to catch external edits.
+    """
+
+    def __init__(self, refresh_interval: int = 300):
+        self.refresh_interval = refresh_interval
+        self.objects: Dict[str, Dict[str, dict]] = {k.value: {} for k in consts.GOSTObjectKind}
+        self.last_refresh = 0
+        # bumped on every change, cheap way to tell whether GOST state moved
+        self.revision = 0
+
+    def refresh_due(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return not self.last_refresh or now - self.last_refresh >= self.refresh_interval
+
+    def load(self, gost_cfg: dict):
+        """
+        Replace mirror with full GOST config.
+        :param gost_cfg:
+        :return:
+        """
+        self.objects = {
+            k.value: extract_key_from_dict_list(_list=gost_cfg.get(k.value), key="name") for k in consts.GOSTObjectKind
+        }
+        self.last_refresh = time.monotonic()
+        self.revision += 1
+        logger.debug(f"gost mirror refreshed, {self.size()} objects")
+
+    def invalidate(self):
+        """
+        Mark mirror stale, next load refreshes it from GOST.
+        :return:
+        """
+        self.last_refresh = 0
+
+    def put(self, kind: str, data: dict):
+        self.objects.setdefault(kind, {})[data.get("name")] = data
+        self.revision += 1
+
+    def remove(self, kind: str, name: str):
+        if self.objects.setdefault(kind, {}).pop(name, None) is not None:
+            self.revision += 1
+
+    def size(self) -> int:
+        return sum(len(v) for v in self.objects.values())
@@ -0,0 +1,423 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from utils import consts
+from utils.gost import (
+    collect_key_from_dict_list,
+    gen_limiter_name,
+    live_digest,
+    parse_object_owner,
+    parse_rule_info_from_service,
+    redact,
+    spec_digest,
+)
+from utils.metrics import REGISTRY
+from utils.models import RelayRule
+from .api import TYZApi, GOSTApi
+from .executor import Executor, LANE_WRITE, LANE_DELETE
+from .prober import TargetProber
+from .status import StatusCoalescer
+from .gost import (
+    add_object,
+    update_object,
+    del_object,
+    render_chain,
+    render_service,
+    render_limiter,
+)
+
+logger = logging.getLogger(__name__)
+
+KIND = consts.GOSTObjectKind
+OP = consts.PlanOp
+
+OBJECTS_APPLIED = REGISTRY.counter(
+    "gost_node_gost_objects_applied_total", "GOST objects created, updated and deleted", ("kind", "op", "result")
+)
+
+# deletes are queued this many at a time, a large GC does not flood the executor queues
+DELETE_BATCH = 200
+
+
+@dataclass
+class PlanAction:
+    kind: str
+    op: str
+    name: str
+    data: Optional[dict] = None
+    # panel rule to mark as synced once the object is live
+    rule: Optional[RelayRule] = None
+    # names of objects in the same plan this one depends on
+    requires: List[str] = field(default_factory=list)
+
+    def to_dict(self, verbose: bool = False) -> dict:
+        d = {"kind": self.kind, "op": self.op, "name": self.name}
+        if verbose:
+            d["data"] = redact(self.data)
+            d["requires"] = self.requires
+        return d
+
+
+@dataclass
+class SyncPlan:
+    actions: List[PlanAction] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def add(
+        self, kind: str, op: str, name: str, data: dict = None, rule: RelayRule = None, requires: list = None
+    ):
+        self.actions.append(PlanAction(kind=kind, op=op, name=name, data=data, rule=rule, requires=requires or []))
+
+    def select(self, kinds: Tuple[str, ...], ops: Tuple[str, ...]) -> List[PlanAction]:
+        """
+        Select actions by object kinds and operations.
+        :param kinds:
+        :param ops:
+        :return:
+        """
+        return [a for a in self.actions if a.kind in kinds and a.op in ops]
+
+    def summary(self) -> dict:
+        """
+        Count actions by kind and operation.
+        :return:
+        """
+        res = {}
+        for a in self.actions:
+            res.setdefault(a.kind, {}).setdefault(a.op, 0)
+            res[a.kind][a.op] += 1
+        return res
+
+    def to_dict(self, verbose: bool = False) -> dict:
+        return {"summary": self.summary(), "actions": [a.to_dict(verbose=verbose) for a in self.actions]}
+
+
+def _plan_object(
+    plan: SyncPlan, kind: str, desired: dict, live_map: dict, rule: RelayRule = None, requires: list = None
+) -> bool:
+    """
+    Plan writing an object unless GOST already has it, live and desired objects are compared by content hash.
+    :param plan:
+    :param kind:
+    :param desired:
+    :param live_map: live GOST objects of the kind by name
+    :param rule:
+    :param requires:
+    :return: whether the object is written
+    """
+    name = desired.get("name")
+    old = live_map.get(name)
+    if old is None:
+        op = OP.CREATE.value
+    elif live_digest(live=old, desired=desired) == spec_digest(desired=desired):
+        return False
+    else:
+        op = OP.UPDATE.value
+    plan.add(kind=kind, op=op, name=name, data=desired, rule=rule, requires=requires)
+    return True
+
+
+def _plan_limiters(plan: SyncPlan, rule: RelayRule, live: dict) -> List[str]:
+    """
+    Plan speed and conn limiters of a rule, only missing or changed limiters are written.
+    :param plan:
+    :param rule:
+    :param live: live GOST objects by kind
+    :return: names of limiters written by this plan
+    """
+    return [
+        spec.name
+        for spec in rule.limiter_specs()
+        if _plan_object(
+            plan=plan,
+            kind=spec.kind,
+            desired=render_limiter(name=spec.name, values=spec.limits),
+            live_map=live[spec.kind],
+            rule=rule,
+        )
+    ]
+
+
+def _live_targets(service: dict) -> List[str]:
+    return collect_key_from_dict_list(_list=service.get("forwarder", {}).get("nodes", []), key="addr")
+
+
+def _plan_service(plan: SyncPlan, rule: RelayRule, live: dict, desired: dict, requires: list = None) -> str:
+    if not _plan_object(
+        plan=plan,
+        kind=KIND.SERVICE.value,
+        desired=desired,
+        live_map=live[KIND.SERVICE.value],
+        rule=rule,
+        requires=requires,
+    ):
+        logger.debug(f"{rule.service_name} already exists")
+    return rule.service_name
+
+
+def plan_ingress_rule(plan: SyncPlan, rule: RelayRule, live: dict) -> str:
+    """
+    Plan ingress rule.
+    :param plan:
+    :param rule:
+    :param live: live GOST objects by kind
+    :return: service name
+    """
+    requires = _plan_limiters(plan=plan, rule=rule, live=live)
+    if _plan_object(
+        plan=plan,
+        kind=KIND.CHAIN.value,
+        desired=render_chain(rule.chain_spec()),
+        live_map=live[KIND.CHAIN.value],
+        rule=rule,
+    ):
+        requires.append(rule.chain_name)
+    return _plan_service(
+        plan=plan, rule=rule, live=live, desired=render_service(rule.service_spec()), requires=requires
+    )
+
+
+def plan_egress_rule(plan: SyncPlan, rule: RelayRule, live: dict) -> str:
+    """
+    Plan egress rule.
+    :param plan:
+    :param rule:
+    :param live: live GOST objects by kind
+    :return: service name
+    """
+    return _plan_service(plan=plan, rule=rule, live=live, desired=render_service(rule.service_spec()))
+
+
+def plan_raw_redirect_rule(plan: SyncPlan, rule: RelayRule, live: dict, prober: TargetProber = None) -> str:
+    """
+    Plan raw redirect rule.
+    :param plan:
+    :param rule:
+    :param live: live GOST objects by kind
+    :param prober: target prober, orders targets fastest first
+    :return: service name
+    """
+    requires = _plan_limiters(plan=plan, rule=rule, live=live)
+
+    targets, selector = rule.targets, None
+    # a single target has nothing to fail over to
+    if prober and len(targets) > 1:
+        old_service = live[KIND.SERVICE.value].get(rule.service_name)
+        current = _live_targets(old_service) if old_service else None
+        targets = tuple(prober.order(targets=list(targets), current=current))
+        selector = prober.selector
+
+    desired = render_service(rule.service_spec(targets=targets, selector=selector))
+    return _plan_service(plan=plan, rule=rule, live=live, desired=desired, requires=requires)
+
+
+def plan_rule(plan: SyncPlan, rule: RelayRule, live: dict, prober: TargetProber = None) -> Optional[str]:
+    """
+    Plan one relay rule by its type.
+    :param plan:
+    :param rule:
+    :param live: live GOST objects by kind
+    :param prober: target prober, orders targets fastest first
+    :return: service name, None for unsupported rule types
+    """
+    if rule.type == consts.RuleType.EGRESS.value:
+        return plan_egress_rule(plan=plan, rule=rule, live=live)
+    elif rule.type == consts.RuleType.TUNNEL.value:
+        return plan_ingress_rule(plan=plan, rule=rule, live=live)
+    elif rule.type == consts.RuleType.RAW.value:
+        return plan_raw_redirect_rule(plan=plan, rule=rule, live=live, prober=prober)
+    else:
+        logger.warning(f"unsupported rule type of rule-{rule.id}: {rule.type}")
+        return None
+
+
+def plan_service_delete(plan: SyncPlan, service_name: str, live: dict):
+    """
+    Plan deleting a service with its chain and limiters.
+    :param plan:
+    :param service_name:
+    :param live: live GOST objects by kind
+    :return:
+    """
+    plan.add(kind=KIND.SERVICE.value, op=OP.DELETE.value, name=service_name)
+    for kind, name in (
+        (KIND.CHAIN.value, f"{service_name}-chain"),
+        (KIND.LIMITER.value, gen_limiter_name(service=service_name, _type="speed")),
+        (KIND.CLIMITER.value, gen_limiter_name(service=service_name, _type="conn")),
+    ):
+        if name in live[kind]:
+            plan.add(kind=kind, op=OP.DELETE.value, name=name)
+
+
+def build_targeted_plan(
+    rules: List[RelayRule], live: dict, rule_ids: Iterable[int], prober: TargetProber = None, node_id: int = None
+) -> SyncPlan:
+    """
+    Plan the changes of some rules only, live services of those rules not in `rules` are deleted.
+    Other rules and objects are left to the full sync.
+    :param rules: current panel rules among `rule_ids`
+    :param live: live GOST objects by kind and name
+    :param rule_ids: changed or deleted rule ids
+    :param prober: target prober, orders targets fastest first
+    :param node_id: panel node id, only services of this node are deleted
+    :return:
+    """
+    rule_ids = set(rule_ids)
+    plan = SyncPlan()
+    new_service_names = {
+        name
+        for name in (plan_rule(plan=plan, rule=r, live=live, prober=prober) for r in rules if r.id in rule_ids)
+        if name
+    }
+    for name in live[KIND.SERVICE.value]:
+        owner = parse_object_owner(name=name)
+        if owner is None or owner[0] != name or (node_id is not None and owner[1] != node_id):
+            continue
+        rule_id, _, _ = parse_rule_info_from_service(service=name)
+        if rule_id in rule_ids and name not in new_service_names:
+            plan_service_delete(plan=plan, service_name=name, live=live)
+
+    return plan
+
+
+def plan_gc(plan: SyncPlan, live: dict, keep: Dict[str, Set[str]], node_id: int = None) -> int:
+    """
+    Plan deleting objects of the node no rule needs any more, of every managed kind.
+    Only objects named after a rule of this node are touched, anything else in GOST is left alone.
+    :param plan:
+    :param live: live GOST objects by kind and name
+    :param keep: names of objects still needed, by kind
+    :param node_id: panel node id, objects of any node are collected if None
+    :return: number of objects to delete
+    """
+    deleted = 0
+    for kind in KIND:
+        wanted = keep.get(kind.value, set())
+        for name in live[kind.value]:
+            if name in wanted:
+                continue
+            owner = parse_object_owner(name=name)
+            if owner is None or (node_id is not None and owner[1] != node_id):
+                continue
+            plan.add(kind=kind.value, op=OP.DELETE.value, name=name)
+            deleted += 1
+    return deleted
+
+
+def build_sync_plan(
+    rules: List[RelayRule], live: dict, prober: TargetProber = None, node_id: int = None
+) -> SyncPlan:
+    """
+    Compare panel rules with live GOST objects and plan the changes, nothing is written here.
+    :param rules: relay rules from panel
+    :param live: live GOST objects by kind and name
+    :param prober: target prober, orders targets fastest first
+    :param node_id: panel node id, only objects of this node are deleted
+    :return:
+    """
+    plan = SyncPlan()
+    keep: Dict[str, Set[str]] = {k.value: set() for k in KIND}
+    for r in rules:
+        if plan_rule(plan=plan, rule=r, live=live, prober=prober):
+            for kind, name in r.object_names():
+                keep[kind].add(name)
+
+    plan_gc(plan=plan, live=live, keep=keep, node_id=node_id)
+    return plan
+
+
+async def _apply_action(gost_api: GOSTApi, action: PlanAction) -> bool:
+    if action.op == OP.CREATE.value:
+        ok = await add_object(gost_api=gost_api, kind=action.kind, data=action.data)
+    elif action.op == OP.UPDATE.value:
+        ok = await update_object(gost_api=gost_api, kind=action.kind, name=action.name, data=action.data)
+    else:
+        ok = await del_object(gost_api=gost_api, kind=action.kind, name=action.name)
+    OBJECTS_APPLIED.inc(kind=action.kind, op=action.op, result="ok" if ok else "failed")
+    return ok
+
+
+def _lane_of(action: PlanAction) -> str:
+    return LANE_DELETE if action.op == OP.DELETE.value else LANE_WRITE
+
+
+async def _apply_stage(
+    gost_api: GOSTApi, executor: Executor, actions: List[PlanAction], failed: set
+) -> List[PlanAction]:
+    """
+    Apply one stage of plan through the executor, actions depending on failed objects are skipped.
+    :param gost_api:
+    :param executor:
+    :param actions:
+    :param failed: names of failed objects, updated in place
+    :return: succeeded actions
+    """
+    runnable = []
+    for a in actions:
+        if failed.intersection(a.requires):
+            logger.warning(f"skip {a.op} {a.kind} {a.name}, dependency failed")
+            failed.add(a.name)
+        else:
+            runnable.append(a)
+
+    results = await asyncio.gather(
+        *[executor.run(gost_api.upstream, _lane_of(a), _apply_action, gost_api=gost_api, action=a) for a in runnable]
+    )
+    succeeded = []
+    for a, ok in zip(runnable, results):
+        if ok:
+            succeeded.append(a)
+        else:
+            failed.add(a.name)
+    return succeeded
+
+
+async def apply_sync_plan(
+    plan: SyncPlan, panel_api: TYZApi, gost_api: GOSTApi, executor: Executor, status: StatusCoalescer = None
+) -> dict:
+    """
+    Apply sync plan in dependency order: limiters and chains, then services, then deletes.
+    :param plan:
+    :param panel_api:
+    :param gost_api:
+    :param executor:
+    :param status: rule status coalescer kept between cycles
+    :return: failed object names
+    """
+    failed = set()
+    writes = (OP.CREATE.value, OP.UPDATE.value)
+    written = await _apply_stage(
+        gost_api=gost_api,
+        executor=executor,
+        actions=plan.select(kinds=(KIND.LIMITER.value, KIND.CLIMITER.value, KIND.CHAIN.value), ops=writes),
+        failed=failed,
+    )
+    services = await _apply_stage(
+        gost_api=gost_api,
+        executor=executor,
+        actions=plan.select(kinds=(KIND.SERVICE.value,), ops=writes),
+        failed=failed,
+    )
+    # a rule is synced once all objects written for it are live
+    if status is None:
+        status = StatusCoalescer(panel_api=panel_api, executor=executor)
+    failed_rules = {a.rule.service_name for a in plan.actions if a.rule and a.name in failed}
+    for a in written + services:
+        if a.rule and a.rule.service_name not in failed_rules:
+            status.mark(rule=a.rule, status=3)
+    await status.flush()
+
+    # deletes run after the new objects are live, services first as they reference chains
+    for kinds in ((KIND.SERVICE.value,), (KIND.CHAIN.value, KIND.LIMITER.value, KIND.CLIMITER.value)):
+        deletes = plan.select(kinds=kinds, ops=(OP.DELETE.value,))
+        for i in range(0, len(deletes), DELETE_BATCH):
+            await _apply_stage(
+                gost_api=gost_api, executor=executor, actions=deletes[i : i + DELETE_BATCH], failed=failed
+            )
+
+    logger.info(f"apply sync plan {plan.summary()}, {len(failed)} failed")
+    return {"summary": plan.summary(), "failed": sorted(failed)}
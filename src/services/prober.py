@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PROBE_LATENCY = REGISTRY.histogram(
+    "gost_node_target_probe_seconds", "TCP connect latency of forward targets", buckets=(0.01, 0.05, 0.1, 0.25, 1, 3)
+)
+PROBE_FAILURES = REGISTRY.counter("gost_node_target_probe_failures_total", "Failed TCP connects to forward targets")
+PROBE_TARGETS = REGISTRY.gauge("gost_node_target_probe_targets", "Distinct forward targets probed")
+
+
+@dataclass
+class TargetHealth:
+    # smoothed connect latency in seconds, None until a probe succeeded
+    latency: Optional[float] = None
+    # consecutive failed probes
+    failures: int = 0
+    last_probe: float = 0
+
+
+def _split_addr(target: str):
+    host, _, port = target.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+class TargetProber:
+    """
+    Probe TCP connect latency of forward targets, every distinct target once per round with bounded concurrency.
+    Targets are ordered fastest first for GOST `fifo` selector, the order only changes when the leader is down or
+    clearly slower than the best target, so services are not rewritten on jitter.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 3,
+        concurrency: int = 64,
+        alpha: float = 0.3,
+        max_fails: int = 2,
+        tolerance: float = 0.2,
+        min_gain: float = 0.005,
+        fail_timeout: str = "30s",
+    ):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # weight of the newest sample in smoothed latency
+        self.alpha = alpha
+        # consecutive failures before a target is ranked down
+        self.max_fails = max_fails
+        # the best target must beat the leader by this ratio and by min_gain seconds to take over
+        self.tolerance = tolerance
+        self.min_gain = min_gain
+        self.fail_timeout = fail_timeout
+        self.health: Dict[str, TargetHealth] = {}
+        # target list of a rule -> order last planned for it
+        self.orders: Dict[Tuple[str, ...], List[str]] = {}
+
+    @property
+    def selector(self) -> dict:
+        """
+        GOST forwarder selector, first healthy node in order, failed nodes are skipped for fail_timeout.
+        :return:
+        """
+        return {"strategy": "fifo", "maxFails": self.max_fails, "failTimeout": self.fail_timeout}
+
+    def update_targets(self, groups: Iterable[Tuple[str, ...]]):
+        """
+        Set target lists of rules to probe, single targets have nothing to be ordered against and are skipped.
+        Results of targets no longer used are dropped.
+        :param groups: targets of each rule
+        :return:
+        """
+        groups = {tuple(g) for g in groups if len(g) > 1}
+        self.health = {t: self.health.get(t) or TargetHealth() for g in groups for t in g}
+        self.orders = {g: self.orders.get(g) or list(g) for g in groups}
+        PROBE_TARGETS.set(len(self.health))
+
+    async def probe(self, target: str) -> Optional[float]:
+        """
+        Connect to a target once.
+        :param target: host:port
+        :return: connect latency in seconds, None on failure
+        """
+        started = time.monotonic()
+        try:
+            host, port = _split_addr(target)
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=self.timeout)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return None
+
+        latency = time.monotonic() - started
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return latency
+
+    def _alive(self, h: TargetHealth) -> bool:
+        return h.failures < self.max_fails
+
+    def _record(self, target: str, latency: Optional[float]) -> bool:
+        """
+        :return: whether the target went up or down
+        """
+        h = self.health[target]
+        was_alive = self._alive(h)
+        h.last_probe = time.time()
+        if latency is None:
+            h.failures += 1
+            PROBE_FAILURES.inc()
+        else:
+            h.failures = 0
+            h.latency = latency if h.latency is None else self.alpha * latency + (1 - self.alpha) * h.latency
+            PROBE_LATENCY.observe(latency)
+        return was_alive != self._alive(h)
+
+    async def probe_all(self) -> bool:
+        """
+        Probe all targets once.
+        :return: whether any target went up or down, or the order of any rule's targets changed
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def run(target: str):
+            async with sem:
+                return target, await self.probe(target=target)
+
+        results = await asyncio.gather(*[run(t) for t in self.health])
+        flipped = [t for t, latency in results if self._record(target=t, latency=latency)]
+        if flipped:
+            logger.info(f"targets up or down: {flipped}")
+        reordered = 0
+        for group, current in self.orders.items():
+            ranked = self.order(targets=list(group), current=current)
+            if ranked != current:
+                self.orders[group] = ranked
+                reordered += 1
+        if reordered:
+            logger.info(f"targets of {reordered} rules reordered")
+        return bool(flipped or reordered)
+
+    def _rank_key(self, target: str):
+        h = self.health.get(target)
+        if h is not None and not self._alive(h):
+            return 2, 0
+        if h is None or h.latency is None:
+            # no successful probe yet, neutral
+            return 1, 0
+        return 0, h.latency
+
+    def order(self, targets: List[str], current: List[str] = None) -> List[str]:
+        """
+        Order targets fastest first, the current order is kept unless the ranking changed meaningfully.
+        :param targets: targets of a rule
+        :param current: targets in the order GOST has them
+        :return:
+        """
+        if len(targets) < 2:
+            return list(targets)
+
+        ranked = sorted(targets, key=self._rank_key)
+        current = [t for t in current or [] if t in targets]
+        current += [t for t in targets if t not in current]
+        if current == ranked:
+            return current
+
+        leader, best = self.health.get(current[0]), self.health.get(ranked[0])
+        dead_first = [self._rank_key(t)[0] for t in current] != sorted(self._rank_key(t)[0] for t in current)
+        if dead_first or best is None or best.latency is None or leader is None or leader.latency is None:
+            return ranked if dead_first else current
+        if leader.latency - best.latency > max(best.latency * self.tolerance, self.min_gain):
+            return ranked
+        return current
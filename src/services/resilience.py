@@ -0,0 +1,112 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
+
+from utils.metrics import REGISTRY
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+BREAKER_STATE = REGISTRY.gauge(
+    "gost_node_upstream_breaker_state", "Circuit breaker of upstream, 0 closed, 1 half-open, 2 open", ("upstream",)
+)
+UPSTREAM_RETRIES = REGISTRY.counter("gost_node_upstream_retries_total", "Retried upstream requests", ("upstream",))
+
+# monotonic time the current job must finish by, upstream requests fail fast after it
+DEADLINE: ContextVar[Optional[float]] = ContextVar("upstream_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """
+    Bound the time upstream requests made within the block may take in total, nested deadlines only shorten it.
+    Calls queued in the executor keep the deadline of the caller.
+    :param seconds: budget, no deadline when 0
+    :return:
+    """
+    if not seconds:
+        yield
+        return
+
+    current = DEADLINE.get()
+    at = time.monotonic() + seconds
+    token = DEADLINE.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left of the current deadline.
+    :return: None without deadline
+    """
+    at = DEADLINE.get()
+    return None if at is None else at - time.monotonic()
+
+
+def bounded_timeout(timeout: httpx.Timeout, left: Optional[float]) -> httpx.Timeout:
+    if left is None:
+        return timeout
+    return httpx.Timeout(
+        connect=min(timeout.connect or left, left),
+        read=min(timeout.read or left, left),
+        write=min(timeout.write or left, left),
+        pool=min(timeout.pool or left, left),
+    )
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Full jitter exponential backoff.
+    :param attempt: retries made so far
+    :param base:
+    :param cap:
+    :return: seconds
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream after `failures` consecutive failures. After `reset_timeout` one request is let
+    through, it closes the circuit on success and opens it again on failure.
+    """
+
+    def __init__(self, name: str, failures: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive = 0
+        # monotonic time the circuit opened or the half-open probe started
+        self.since = 0.0
+
+    def _set(self, state: int):
+        self.state = state
+        self.since = time.monotonic()
+        BREAKER_STATE.set(state, upstream=self.name)
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if time.monotonic() - self.since < self.reset_timeout:
+            return False
+        # open long enough, or the half-open probe never came back
+        self._set(HALF_OPEN)
+        return True
+
+    def record(self, ok: bool):
+        if ok:
+            self.consecutive = 0
+            if self.state != CLOSED:
+                self._set(CLOSED)
+            return
+
+        self.consecutive += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive >= self.failures):
+            self._set(OPEN)
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+from utils import consts
+from utils.gost import parse_object_owner
+from .api import TYZApi, GOSTApi
+from .executor import Executor
+from .gost import load_gost_objects
+from .plan import SyncPlan, apply_sync_plan
+from .state import SyncState
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+
+class Snapshot:
+    """
+    Last verified in-sync rule set and GOST objects on disk, GOST is restored from it at startup without the panel.
+    """
+
+    def __init__(self, path: str, node_id: int = None):
+        self.path = Path(path)
+        # panel node id, only objects of this node are saved and restored
+        self.node_id = node_id
+        # rules fingerprint and mirror revision saved last
+        self.saved: Optional[Tuple[str, int]] = None
+
+    def load(self) -> Optional[dict]:
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"load snapshot {self.path} error: {e}")
+            return None
+        if data.get("format") != SNAPSHOT_FORMAT:
+            logger.warning(f"unsupported snapshot format {data.get('format')}, ignored")
+            return None
+        return data
+
+    def owns(self, name: str) -> bool:
+        owner = parse_object_owner(name=name)
+        return owner is not None and (self.node_id is None or owner[1] == self.node_id)
+
+    def _write(self, data: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        # rules and objects carry relay credentials
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def save(self, state: SyncState, gost_api: GOSTApi) -> bool:
+        """
+        Save rules and GOST objects once verified in sync, atomically.
+        :param state:
+        :param gost_api:
+        :return: whether a snapshot was written
+        """
+        key = (state.rules_fingerprint, gost_api.mirror.revision)
+        if state.synced_fingerprint != key or self.saved == key:
+            return False
+
+        data = {
+            "format": SNAPSHOT_FORMAT,
+            "saved_at": int(time.time()),
+            "rules": state.rules,
+            "rules_etag": state.rules_etag,
+            "rules_version": state.rules_version,
+            "objects": {
+                kind: [obj for name, obj in objs.items() if self.owns(name)]
+                for kind, objs in gost_api.mirror.objects.items()
+            },
+        }
+        # encoding and fsync of a large snapshot would block the event loop
+        await asyncio.to_thread(self._write, data)
+        self.saved = key
+        logger.info(f"snapshot saved, {len(state.rules or [])} rules, {gost_api.mirror.size()} objects")
+        return True
+
+
+async def restore_snapshot(
+    snapshot: Snapshot, panel_api: TYZApi, gost_api: GOSTApi, executor: Executor, state: SyncState
+) -> dict:
+    """
+    Create objects of snapshot missing in GOST, nothing is updated or deleted, the next sync reconciles.
+    Cached rules are seeded from snapshot, so the first fetch can be conditional.
+    :param snapshot:
+    :param panel_api:
+    :param gost_api:
+    :param executor:
+    :param state:
+    :return: applied plan summary and failed object names
+    """
+    data = snapshot.load()
+    if data is None:
+        return {"summary": {}, "failed": []}
+
+    live = await load_gost_objects(gost_api=gost_api, force=True)
+    plan = SyncPlan()
+    for kind in consts.GOSTObjectKind:
+        for obj in data.get("objects", {}).get(kind.value, []):
+            if obj.get("name") not in live[kind.value] and snapshot.owns(obj.get("name", "")):
+                plan.add(kind=kind.value, op=consts.PlanOp.CREATE.value, name=obj.get("name"), data=obj)
+
+    if state.rules is None and data.get("rules") is not None:
+        state.set_rules(
+            rules=data["rules"], etag=data.get("rules_etag", ""), version=data.get("rules_version", "")
+        )
+
+    if not plan:
+        logger.info("gost already has snapshot objects")
+        return {"summary": {}, "failed": []}
+
+    logger.warning(f"restore {len(plan)} gost objects from snapshot saved at {data.get('saved_at')}")
+    return await apply_sync_plan(plan=plan, panel_api=panel_api, gost_api=gost_api, executor=executor)
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from pathlib import Path
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SPOOL_BYTES = REGISTRY.gauge("gost_node_traffic_spool_bytes", "Size of traffic spool file")
+SPOOL_BATCHES = REGISTRY.gauge("gost_node_traffic_spool_batches", "Traffic report batches waiting in spool")
+SPOOL_DROPPED = REGISTRY.counter("gost_node_traffic_spool_dropped_total", "Traffic report batches dropped, spool full")
+
+
+def merge_traffic(dst: dict, src: dict) -> dict:
+    """
+    Merge traffic report data per rule, in place.
+    :param dst: {"raw": {"1": bytes}, "tunnel": {...}, "egress": {...}}
+    :param src:
+    :return:
+    """
+    for rule_type, rules in src.items():
+        merged = dst.setdefault(rule_type, {})
+        for rule_id, used in rules.items():
+            merged[rule_id] = merged.get(rule_id, 0) + used
+    return dst
+
+
+class TrafficSpool:
+    """
+    Append-only on-disk log of traffic report batches the panel has not acknowledged.
+    Batches are merged per rule when replayed, the log is compacted into a single merged batch when it grows.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 16 * 1024 * 1024,
+        compact_batches: int = 100,
+        base_backoff: float = 5,
+        max_backoff: float = 600,
+    ):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.compact_batches = compact_batches
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.next_attempt = 0
+        self.merged = {}
+        self.batches = 0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            self._update_metrics()
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    merge_traffic(self.merged, json.loads(line))
+                    self.batches += 1
+                except json.JSONDecodeError:
+                    # a torn write from a crash, the rest of the log is still valid
+                    logger.error(f"skip broken line in traffic spool {self.path}")
+        if self.batches:
+            logger.warning(f"{self.batches} traffic report batches restored from spool")
+        self._update_metrics()
+
+    def __len__(self) -> int:
+        return self.batches
+
+    def size(self) -> int:
+        return self.path.stat().st_size if self.path.exists() else 0
+
+    def _update_metrics(self):
+        SPOOL_BYTES.set(self.size())
+        SPOOL_BATCHES.set(self.batches)
+
+    @staticmethod
+    def _write(path: Path, line: str, mode: str):
+        with open(path, mode, encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def append(self, data: dict) -> bool:
+        """
+        Spool a traffic report batch.
+        :param data:
+        :return: False if spool is full and batch dropped
+        """
+        line = json.dumps(data, separators=(",", ":")) + "\n"
+        if self.batches >= self.compact_batches or self.size() + len(line) > self.max_bytes:
+            await self.compact()
+        if self.size() + len(line) > self.max_bytes:
+            logger.error(f"traffic spool {self.path} is full, drop batch: {data}")
+            SPOOL_DROPPED.inc()
+            return False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # fsync blocks until the disk acknowledges
+        await asyncio.to_thread(self._write, path=self.path, line=line, mode="a")
+        merge_traffic(self.merged, data)
+        self.batches += 1
+        self._update_metrics()
+        return True
+
+    def _replace(self, line: str):
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        self._write(path=tmp, line=line, mode="w")
+        os.replace(tmp, self.path)
+
+    async def compact(self):
+        """
+        Rewrite spool as a single merged batch, atomically.
+        :return:
+        """
+        if self.batches <= 1:
+            return
+
+        await asyncio.to_thread(self._replace, line=json.dumps(self.merged, separators=(",", ":")) + "\n")
+        self.batches = 1
+        self._update_metrics()
+
+    def ready(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self.batches > 0 and now >= self.next_attempt
+
+    def pending(self) -> dict:
+        return self.merged
+
+    def ack(self):
+        """
+        Drop all spooled batches after panel accepted them.
+        :return:
+        """
+        self.path.unlink(missing_ok=True)
+        self.merged = {}
+        self.batches = 0
+        self.failures = 0
+        self.next_attempt = 0
+        self._update_metrics()
+
+    def backoff(self):
+        """
+        Delay next replay with jittered exponential backoff.
+        :return:
+        """
+        self.failures += 1
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        self.next_attempt = time.monotonic() + random.uniform(delay / 2, delay)
+        logger.warning(f"traffic report failed {self.failures} times, retry spool in {delay:.0f}s")
@@ -0,0 +1,55 @@
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from utils import gost as gost_utils
+from utils.models import RelayRule, parse_rules
+
+
+@dataclass
+class SyncState:
+    """
+    State kept between sync cycles, used to skip cycles when nothing changed.
+    """
+
+    # seconds between forced full syncs, which correct drift regardless of fingerprints
+    full_sync_interval: int = 600
+    rules: Optional[list] = None
+    # cached rules parsed, built once per fetch
+    rule_models: Optional[List[RelayRule]] = None
+    rules_etag: str = ""
+    rules_version: str = ""
+    # fingerprint of cached rules
+    rules_fingerprint: str = ""
+    # rules fingerprint and GOST mirror revision of the last cycle which found nothing to do
+    synced_fingerprint: Optional[Tuple[str, int]] = None
+    last_full_sync: float = 0
+
+    def set_rules(self, rules: list, etag: str = "", version: str = ""):
+        """
+        Cache rules of a fetch.
+        :param rules: panel relay rules
+        :param etag:
+        :param version:
+        :return:
+        """
+        self.rules = rules
+        self.rule_models = parse_rules(rules=rules)
+        self.rules_etag = etag
+        self.rules_version = version
+        self.rules_fingerprint = gost_utils.rules_fingerprint(
+            digests=((r.type, r.id, r.digest) for r in self.rule_models)
+        )
+
+    def full_sync_due(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return not self.last_full_sync or now - self.last_full_sync >= self.full_sync_interval
+
+    def unchanged(self, gost_revision: int) -> bool:
+        return self.synced_fingerprint == (self.rules_fingerprint, gost_revision)
+
+    def mark_in_sync(self, gost_revision: int):
+        self.synced_fingerprint = (self.rules_fingerprint, gost_revision)
+
+    def mark_dirty(self):
+        self.synced_fingerprint = None
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from utils.models import RelayRule
+from utils.metrics import REGISTRY
+from .api import TYZApi
+from .executor import Executor, LANE_STATUS
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = REGISTRY.gauge("gost_node_rule_status_pending", "Rule status updates waiting to be reported")
+STATUS_REPORTED = REGISTRY.counter(
+    "gost_node_rule_status_reported_total", "Rule status updates reported to panel", ("mode",)
+)
+
+
+class StatusCoalescer:
+    """
+    Collect rule status transitions and report them to panel in bulk.
+    Failed updates stay pending for the next flush, a status already reported for the same rule content is not sent
+    again.
+    """
+
+    def __init__(self, panel_api: TYZApi, executor: Executor, batch: bool = True, batch_size: int = 500):
+        self.panel_api = panel_api
+        self.executor = executor
+        # None until the panel answered a batch call
+        self.batch_supported = None if batch else False
+        self.batch_size = batch_size
+        # (rule type, rule id) -> (status, rule fingerprint)
+        self.pending: Dict[Tuple[str, int], Tuple[int, str]] = {}
+        self.reported: Dict[Tuple[str, int], Tuple[int, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def mark(self, rule: RelayRule, status: int):
+        """
+        Record status of a rule, to be reported on next flush.
+        :param rule: panel rule
+        :param status:
+        :return:
+        """
+        key = (rule.type, rule.id)
+        value = (status, rule.digest)
+        if self.reported.get(key) == value:
+            self.pending.pop(key, None)
+        else:
+            self.pending[key] = value
+        STATUS_PENDING.set(len(self.pending))
+
+    def retain(self, rules: List[RelayRule]):
+        """
+        Drop statuses of rules no longer in the panel rule set.
+        :param rules: current panel rules
+        :return:
+        """
+        keys = {(r.type, r.id) for r in rules}
+        self.reported = {k: v for k, v in self.reported.items() if k in keys}
+        self.pending = {k: v for k, v in self.pending.items() if k in keys}
+        STATUS_PENDING.set(len(self.pending))
+
+    def _done(self, keys: list, mode: str):
+        for key in keys:
+            value = self.pending.pop(key, None)
+            if value is not None:
+                self.reported[key] = value
+        STATUS_REPORTED.inc(len(keys), mode=mode)
+
+    async def _flush_batch(self, keys: list) -> bool:
+        """
+        :return: False when panel has no batch endpoint
+        """
+        for i in range(0, len(keys), self.batch_size):
+            chunk = keys[i : i + self.batch_size]
+            statuses = [{"id": k[1], "type": k[0], "status": self.pending[k][0]} for k in chunk]
+            success, msg, _ = await self.executor.run(
+                self.panel_api.upstream, LANE_STATUS, self.panel_api.update_relay_rule_status_batch, statuses=statuses
+            )
+            if success is None:
+                logger.info(f"{msg}, fall back to single status updates")
+                self.batch_supported = False
+                return False
+
+            self.batch_supported = True
+            if not success:
+                logger.error(f"batch update relay rule status error: {msg}")
+                return True
+            self._done(keys=chunk, mode="batch")
+        return True
+
+    async def _flush_single(self, keys: list):
+        async def update(key):
+            success, msg, _ = await self.panel_api.update_relay_rule_status(
+                rule_id=key[1], rule_type=key[0], status=self.pending[key][0]
+            )
+            if success:
+                self._done(keys=[key], mode="single")
+            else:
+                logger.error(f"update relay rule {key} status error: {msg}")
+
+        # concurrency is bounded by the executor limits of panel upstream
+        await asyncio.gather(*[self.executor.run(self.panel_api.upstream, LANE_STATUS, update, key) for key in keys])
+
+    async def flush(self):
+        """
+        Report pending statuses, by batch endpoint when panel supports it.
+        :return:
+        """
+        if not self.pending:
+            return
+        if self.panel_api.retry_after() > 0:
+            logger.info(f"panel in retry after, {len(self.pending)} rule status updates kept")
+            return
+
+        keys = list(self.pending)
+        if self.batch_supported is False or not await self._flush_batch(keys=keys):
+            await self._flush_single(keys=[k for k in keys if k in self.pending])
+        STATUS_PENDING.set(len(self.pending))
+        logger.info(f"rule status updates reported, {len(self.pending)} pending")
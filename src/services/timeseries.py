@@ -0,0 +1,189 @@
+import heapq
+import logging
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# fields of a slot
+CURRENT_CONNS, TOTAL_CONNS, INPUT_BYTES, OUTPUT_BYTES, TOTAL_ERRS = range(5)
+FIELDS = ("current_conns", "total_conns", "input_bytes", "output_bytes", "total_errs")
+# top-N orderings, sums of slot fields
+TOP_BY = {"bytes": (INPUT_BYTES, OUTPUT_BYTES), "conns": (TOTAL_CONNS,), "errors": (TOTAL_ERRS,)}
+
+SERIES_SERVICES = REGISTRY.gauge("gost_node_timeseries_services", "Services kept in time-series store")
+SERIES_EVICTED = REGISTRY.counter("gost_node_timeseries_evicted_total", "Services evicted from time-series store")
+
+
+class Ring:
+    """
+    Fixed-size ring of slots for one service at one resolution, slot fields are stored flat in an int64 array.
+    Current conns is the last value seen in a slot, the other fields are the increase within a slot.
+    """
+
+    __slots__ = ("resolution", "size", "head", "data")
+
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.size = size
+        # number of the latest written slot, -1 before any write
+        self.head = -1
+        self.data = array("q", bytes(8 * size * len(FIELDS)))
+
+    def _clear(self, slot: int):
+        i = (slot % self.size) * len(FIELDS)
+        self.data[i : i + len(FIELDS)] = array("q", bytes(8 * len(FIELDS)))
+
+    def write(self, now: float, current_conns: int, deltas: Tuple[int, int, int, int]):
+        slot = int(now // self.resolution)
+        if slot > self.head:
+            for s in range(max(self.head + 1, slot - self.size + 1), slot + 1):
+                self._clear(s)
+            self.head = slot
+        elif slot <= self.head - self.size:
+            return
+
+        i = (slot % self.size) * len(FIELDS)
+        self.data[i + CURRENT_CONNS] = current_conns
+        for f, d in zip((TOTAL_CONNS, INPUT_BYTES, OUTPUT_BYTES, TOTAL_ERRS), deltas):
+            self.data[i + f] += d
+
+    def slots(self, start: float, end: float):
+        """
+        Slots overlapping [start, end], oldest first.
+        :return: (slot start time, slot offset in data) pairs
+        """
+        first = max(self.head - self.size + 1, int(start // self.resolution), 0)
+        last = min(self.head, int(end // self.resolution))
+        for s in range(first, last + 1):
+            yield s * self.resolution, (s % self.size) * len(FIELDS)
+
+    def sum(self, start: float, end: float, fields: Tuple[int, ...]) -> int:
+        return sum(self.data[i + f] for _, i in self.slots(start=start, end=end) for f in fields)
+
+
+class TimeSeriesStore:
+    """
+    Per-service connection and traffic history from observer stats events, kept at a few resolutions.
+    Memory is fixed per service, `max_services * sum(sizes) * 40` bytes at most, least recently updated services
+    are evicted beyond `max_services`.
+    """
+
+    def __init__(self, resolutions: List[Tuple[int, int]] = ((60, 60), (900, 96)), max_services: int = 10000):
+        # (seconds per slot, slots), finest first
+        self.resolutions = sorted((int(r), int(n)) for r, n in resolutions)
+        self.max_services = max_services
+        self.series: "OrderedDict[str, List[Ring]]" = OrderedDict()
+        # service -> client -> last (current conns, total conns, input bytes, output bytes, total errs)
+        self.last: Dict[str, Dict[str, Tuple[int, int, int, int, int]]] = {}
+        self.current_conns: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.series)
+
+    def _rings(self, service: str) -> List[Ring]:
+        rings = self.series.get(service)
+        if rings is not None:
+            self.series.move_to_end(service)
+            return rings
+
+        while len(self.series) >= self.max_services:
+            evicted, _ = self.series.popitem(last=False)
+            self.forget(service=evicted)
+            SERIES_EVICTED.inc()
+        rings = self.series[service] = [Ring(resolution=r, size=n) for r, n in self.resolutions]
+        SERIES_SERVICES.set(len(self.series))
+        return rings
+
+    def forget(self, service: str):
+        self.series.pop(service, None)
+        self.current_conns.pop(service, None)
+        self.last.pop(service, None)
+        SERIES_SERVICES.set(len(self.series))
+
+    def feed(
+        self,
+        service: str,
+        current_conns: int,
+        total_conns: int,
+        input_bytes: int,
+        output_bytes: int,
+        total_errs: int,
+        client: str = "",
+        reset_traffic: bool = False,
+        now: float = None,
+    ):
+        """
+        Feed one stats event, GOST counters are cumulative except bytes when traffic is reset after each report.
+        :return:
+        """
+        now = time.time() if now is None else now
+        values = (current_conns, total_conns, input_bytes, output_bytes, total_errs)
+        clients = self.last.setdefault(service, {})
+        last = clients.get(client)
+        clients[client] = values
+        if last is None:
+            last = (0, total_conns, input_bytes, output_bytes, total_errs)
+        if reset_traffic:
+            last = (last[0], last[1], 0, 0, last[4])
+
+        # a counter lower than the last one was reset, the new value is all increase
+        deltas = tuple(cur - prev if cur >= prev else cur for cur, prev in zip(values[1:], last[1:]))
+        conns = self.current_conns[service] = self.current_conns.get(service, 0) + current_conns - last[0]
+        for ring in self._rings(service):
+            ring.write(now=now, current_conns=conns, deltas=deltas)
+
+    def _ring_for(self, rings: List[Ring], start: float, now: float) -> Ring:
+        # finest resolution still covering start
+        for ring in rings:
+            if now - ring.resolution * ring.size <= start:
+                return ring
+        return rings[-1]
+
+    def query(self, service: str, window: int = 3600, resolution: int = 0, now: float = None) -> Optional[dict]:
+        """
+        History of a service over the last `window` seconds.
+        :param service:
+        :param window:
+        :param resolution: seconds per point, finest covering window by default
+        :param now:
+        :return: None if service unknown
+        """
+        rings = self.series.get(service)
+        if rings is None:
+            return None
+
+        now = time.time() if now is None else now
+        start = now - window
+        ring = next((r for r in rings if r.resolution == resolution), None) or self._ring_for(rings, start, now)
+        points = [
+            {"time": t, **{name: ring.data[i + f] for f, name in enumerate(FIELDS)}}
+            for t, i in ring.slots(start=start, end=now)
+        ]
+        return {"service": service, "resolution": ring.resolution, "points": points}
+
+    def top(self, n: int = 10, window: int = 300, by: str = "bytes", now: float = None) -> List[dict]:
+        """
+        Busiest services over the last `window` seconds.
+        :param n:
+        :param window:
+        :param by: bytes, conns or errors
+        :param now:
+        :return:
+        """
+        fields = TOP_BY[by]
+        now = time.time() if now is None else now
+        start = now - window
+        totals = (
+            (self._ring_for(rings, start, now).sum(start=start, end=now, fields=fields), service)
+            for service, rings in self.series.items()
+        )
+        return [
+            {"service": service, by: total, "current_conns": self.current_conns.get(service, 0)}
+            for total, service in heapq.nlargest(n, totals)
+            if total > 0
+        ]
@@ -0,0 +1,185 @@
+import logging
+import math
+import time
+from collections import Counter
+from typing import Dict, Tuple
+
+from utils.prom import ServiceTransferParser
+from .api import PrometheusApi, GOSTMetricsApi
+from .executor import Executor, LANE_READ
+from .gost import query_traffic_by_service
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficAccumulator:
+    """
+    Per-service traffic fed by GOST observer stats events.
+    GOST reports cumulative counters by default, deltas are computed against the last seen value.
+    A counter seen the first time, or lower than the last one as GOST restarted or the service was recreated, counts
+    from zero.
+    """
+
+    def __init__(self, reset_traffic: bool = False):
+        # GOST resets counters after each report (service metadata observer.resetTraffic)
+        self.reset_traffic = reset_traffic
+        # (service, client) -> last seen (input bytes, output bytes)
+        self.last: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self.pending: Counter = Counter()
+
+    def feed(self, service: str, input_bytes: int, output_bytes: int, client: str = ""):
+        """
+        Feed one stats event.
+        :param service:
+        :param input_bytes:
+        :param output_bytes:
+        :param client: GOST reports counters per client when configured, they are tracked apart
+        :return:
+        """
+        if self.reset_traffic:
+            delta = input_bytes + output_bytes
+        else:
+            key = (service, client)
+            last = self.last.get(key, (0, 0))
+            self.last[key] = (input_bytes, output_bytes)
+            delta = 0
+            for cur, prev in ((input_bytes, last[0]), (output_bytes, last[1])):
+                delta += cur - prev if cur >= prev else cur
+
+        if delta > 0:
+            self.pending[service] += delta
+
+    def forget(self, services):
+        """
+        Drop last seen counters of deleted services, traffic not drained yet is still reported.
+        :param services:
+        :return:
+        """
+        if services:
+            self.last = {k: v for k, v in self.last.items() if k[0] not in services}
+
+    def retain(self, services):
+        """
+        Drop last seen counters of services no longer exist.
+        :param services:
+        :return:
+        """
+        self.last = {k: v for k, v in self.last.items() if k[0] in services}
+
+    def drain(self) -> Dict[str, int]:
+        """
+        Take traffic accumulated since last drain.
+        :return:
+        """
+        result, self.pending = dict(self.pending), Counter()
+        return result
+
+
+class PrometheusTrafficSource:
+    """
+    Query prometheus once per tick, windows are aligned to step and follow the last reported boundary,
+    so consecutive reports neither overlap nor leave gaps when a job runs late.
+    """
+
+    def __init__(self, prom_api: PrometheusApi, executor: Executor, step: int = 30, delay: int = 15):
+        self.prom_api = prom_api
+        self.executor = executor
+        self.step = step
+        # evaluate a bit in the past, so the latest scrape has landed
+        self.delay = delay
+        self.last_end = 0
+
+    def window(self, now: float = None) -> tuple:
+        now = time.time() if now is None else now
+        end = math.floor((now - self.delay) / self.step) * self.step
+        start = self.last_end or end - self.step
+        return start, end
+
+    async def collect(self) -> Dict[str, float]:
+        """
+        Traffic by service since last reported boundary.
+        :return:
+        """
+        start, end = self.window()
+        if end <= start:
+            return {}
+
+        traffics = await self.executor.run(
+            self.prom_api.upstream, LANE_READ, query_traffic_by_service, prom_api=self.prom_api, start=start, end=end
+        )
+        if traffics is None:
+            # boundary stays, next tick covers this window as well
+            return {}
+
+        self.last_end = end
+        return {service: sum(directions.values()) for service, directions in traffics.items()}
+
+
+class ObserverTrafficSource:
+    def __init__(self, accumulator: TrafficAccumulator):
+        self.accumulator = accumulator
+
+    async def collect(self) -> Dict[str, float]:
+        """
+        Traffic by service since last collect.
+        :return:
+        """
+        return self.accumulator.drain()
+
+
+class GOSTMetricsTrafficSource:
+    """
+    Scrape GOST metrics endpoint directly, exact counter deltas between scrapes without a prometheus server.
+    """
+
+    def __init__(self, metrics_api: GOSTMetricsApi, executor: Executor):
+        self.metrics_api = metrics_api
+        self.executor = executor
+        self.accumulator = TrafficAccumulator()
+
+    async def collect(self) -> Dict[str, float]:
+        """
+        Traffic by service since last scrape.
+        :return:
+        """
+        parser = ServiceTransferParser()
+        success = await self.executor.run(self.metrics_api.upstream, LANE_READ, self.metrics_api.scrape, parser=parser)
+        if not success:
+            # counters keep growing in GOST, the next successful scrape covers this period
+            return {}
+
+        for service, (input_bytes, output_bytes) in parser.result.items():
+            self.accumulator.feed(service=service, input_bytes=input_bytes, output_bytes=output_bytes)
+        self.accumulator.retain(parser.result)
+        return self.accumulator.drain()
+
+
+def build_traffic_source(
+    cfg: dict,
+    prom_api: PrometheusApi,
+    executor: Executor,
+    accumulator: TrafficAccumulator,
+    metrics_api: GOSTMetricsApi = None,
+    step: int = 30,
+):
+    """
+    Build traffic source from `[traffic]` config section.
+    :param cfg:
+    :param prom_api:
+    :param executor:
+    :param accumulator: observer traffic
+    :param metrics_api: GOST metrics endpoint
+    :param step: report interval
+    :return:
+    """
+    source = cfg.get("source", "prometheus")
+    if source == "observer":
+        return ObserverTrafficSource(accumulator=accumulator)
+    elif source == "gost_metrics":
+        if metrics_api is None:
+            raise ValueError("traffic source gost_metrics requires [gost] metrics endpoint")
+        return GOSTMetricsTrafficSource(metrics_api=metrics_api, executor=executor)
+    elif source == "prometheus":
+        return PrometheusTrafficSource(prom_api=prom_api, executor=executor, step=step)
+    else:
+        raise ValueError(f"unsupported traffic source: {source}")
@@ -1,287 +1,266 @@
 import asyncio
 import logging
-from collections import Counter
+import time
+from typing import Dict, List
 
 from exceptions.tyz import TYZApiException
 from utils import consts
-from utils.gost import (
-    extract_key_from_dict_list,
-    collect_key_from_dict_list,
-    GOSTAuth,
-    parse_gost_limits,
-    RelayRuleLimit,
-    gen_service_name,
-    gen_limiter_name,
-    parse_rule_info_from_service,
-)
-from .api import TYZApi, GOSTApi, PrometheusApi
-from .gost import (
-    fetch_all_config,
-    add_ws_egress_service,
-    add_ws_ingress_service,
-    add_raw_redir_service,
-    add_conn_limiter,
-    add_speed_limiter,
-    del_service,
-    del_chain,
-    calc_traffic_by_service,
-)
+from utils.gost import parse_rule_info_from_service
+from utils.metrics import REGISTRY
+from utils.models import RelayRule, parse_rules
+from .api import TYZApi, GOSTApi
+from .executor import Executor, LANE_WRITE
+from .gost import load_gost_objects
+from .bulk import BulkBackend, apply_bulk
+from .prober import TargetProber
+from .plan import SyncPlan, build_sync_plan, build_targeted_plan, apply_sync_plan
+from .spool import TrafficSpool
+from .state import SyncState
+from .status import StatusCoalescer
+from .traffic import TrafficAccumulator
 
 logger = logging.getLogger(__name__)
 
+TRAFFIC_REPORTED_AT = REGISTRY.gauge(
+    "gost_node_traffic_last_report_timestamp_seconds", "Time of the last traffic report accepted by panel", ("node_id",)
+)
+
 
-async def add_or_update_limiters(gost_api: GOSTApi, service_name: str, limit: RelayRuleLimit):
+def raw_targets(rules: List[RelayRule]) -> set:
     """
-    Add or update limiters.
-    :param gost_api: gost endpoint
-    :param service_name:
-    :param limit:
-    :return:
+    Distinct target lists GOST connects to directly, those of raw redirect rules.
+    :param rules:
+    :return: set of target tuples
     """
-    if limit:
-        add_speed_limit_ok = await add_speed_limiter(
-            gost_api=gost_api, name=gen_limiter_name(service=service_name, _type="speed"), values=limit.speed_limits
-        )
-        add_conn_limit_ok = await add_conn_limiter(
-            gost_api=gost_api, name=gen_limiter_name(service=service_name, _type="conn"), values=limit.conn_limits
-        )
-        if add_speed_limit_ok and add_conn_limit_ok:
-            logger.info(f"create speed and conn limiter success")
+    return {
+        tuple(t for t in r.targets if t) for r in rules or [] if r.type == consts.RuleType.RAW.value and any(r.targets)
+    }
 
 
-async def sync_relay_rules(panel_api: TYZApi, gost_api: GOSTApi):
+async def plan_relay_rules(panel_api: TYZApi, gost_api: GOSTApi, prober: TargetProber = None) -> SyncPlan:
     """
-    Sync relay rules.
+    Fetch relay rules and GOST config, plan the changes without applying.
     :param panel_api:
     :param gost_api:
+    :param prober: target prober
     :return:
     """
-    gost_cfg = await fetch_all_config(gost_api=gost_api)
-    gost_service_map = extract_key_from_dict_list(_list=gost_cfg.get("services"), key="name")
-    gost_chain_map = extract_key_from_dict_list(_list=gost_cfg.get("chains"), key="name")
+    live = await load_gost_objects(gost_api=gost_api)
     success, msg, result = await panel_api.fetch_relay_rules()
     if not success:
         raise TYZApiException(f"sync relay rules error: {msg}")
 
-    tasks = []
-    new_service_names = []
-    rules = result.get("data", [])
-    for r in rules:
-        limit = parse_gost_limits(limit=r.get("limit", "{}"))
-        rule_type = r.get("type")
-        if rule_type == consts.RuleType.EGRESS.value:
-            tasks.append(sync_egress_rule(panel_api=panel_api, rule=r, gost_api=gost_api, service_map=gost_service_map))
-        elif rule_type == consts.RuleType.TUNNEL.value:
-            tasks.append(
-                sync_ingress_rule(
-                    panel_api=panel_api,
-                    rule=r,
-                    gost_api=gost_api,
-                    service_map=gost_service_map,
-                    chain_map=gost_chain_map,
-                    limit=limit,
-                )
-            )
-        elif rule_type == consts.RuleType.RAW.value:
-            tasks.append(
-                sync_raw_redirect_rule(
-                    panel_api=panel_api, rule=r, gost_api=gost_api, service_map=gost_service_map, limit=limit
-                )
-            )
-        else:
-            logger.warning(f"unsupported rule type of rule-{r.get('id')}: {r.get('type')}")
+    rules = await asyncio.to_thread(parse_rules, rules=result.get("data", []))
+    return await asyncio.to_thread(build_sync_plan, rules=rules, live=live, prober=prober, node_id=panel_api.node_id)
 
-        new_service_names.append(
-            gen_service_name(rule_id=r.get("id"), rule_type=r.get("type"), node_id=panel_api.node_id)
-        )
 
-    tasks.append(
-        old_gost_service_cleanup(
-            gost_api=gost_api,
-            service_map=gost_service_map,
-            chain_map=gost_chain_map,
-            new_service_names=new_service_names,
-        )
+def forget_deleted(plan: SyncPlan, gost_api: GOSTApi, accumulator: TrafficAccumulator):
+    """
+    Drop observer counters of services the plan deleted from GOST.
+    :param plan:
+    :param gost_api:
+    :param accumulator:
+    :return:
+    """
+    live = gost_api.mirror.objects[consts.GOSTObjectKind.SERVICE.value]
+    accumulator.forget(
+        {
+            a.name
+            for a in plan.select(kinds=(consts.GOSTObjectKind.SERVICE.value,), ops=(consts.PlanOp.DELETE.value,))
+            if a.name not in live
+        }
     )
-    await asyncio.gather(*tasks)
 
 
-async def sync_ingress_rule(
-    panel_api: TYZApi, rule: dict, gost_api: GOSTApi, service_map: dict, chain_map: dict, limit: RelayRuleLimit = None
-) -> bool:
+async def fetch_relay_rules(panel_api: TYZApi, state: SyncState, force: bool = False) -> List[RelayRule]:
     """
-    Sync ingress rule.
+    Fetch relay rules conditionally, cached rules are reused when panel reports not modified.
     :param panel_api:
-    :param rule:
-    :param gost_api: gost endpoint
-    :param service_map: gost service map
-    :param chain_map: gost chain map
-    :param limit:
+    :param state:
+    :param force: fetch unconditionally
     :return:
     """
-    service_name = gen_service_name(
-        rule_id=rule.get("id"), rule_type=rule.get("type"), node_id=rule.get("ingress_node")
+    conditional = not force and state.rules is not None
+    success, msg, result, etag = await panel_api.fetch_relay_rules_if_changed(
+        etag=state.rules_etag if conditional else "", version=state.rules_version if conditional else ""
     )
-    await add_or_update_limiters(gost_api=gost_api, service_name=service_name, limit=limit)
-
-    old_service = service_map.get(service_name)
-    if old_service:
-        old_port = old_service.get("addr", ":").split(":")[1]
-        old_targets = collect_key_from_dict_list(_list=old_service.get("forwarder", {}).get("nodes", []), key="addr")
-        old_relay_name = old_service.get("handler", {}).get("chain", "")
-        old_relay_addr = chain_map.get(old_relay_name, {}).get("hops", [{}])[0].get("nodes", [{}])[0].get("addr")
-        old_speed_limiter = old_service.get("limiter", "")
-        old_conn_limiter = old_service.get("climiter", "")
+    if not success:
+        raise TYZApiException(f"sync relay rules error: {msg}")
 
-        if (
-            old_port == str(rule.get("listen_port"))
-            and old_relay_addr == rule.get("tunnel", {}).get("addr", "")
-            and old_targets == rule.get("targets").split("\n")
-            and old_speed_limiter == gen_limiter_name(service=service_name, _type="speed")
-            and old_conn_limiter == gen_limiter_name(service=service_name, _type="conn")
-        ):
-            logger.info(f"{service_name} already exists")
-            return True
+    if result is None or (conditional and result.get("modified") is False):
+        logger.debug("relay rules not modified")
+        return state.rule_models
 
-    logger.info(f"creating or updating service {service_name}")
-    add_ok = await add_ws_ingress_service(
-        gost_api=gost_api,
-        name=service_name,
-        addr=f":{rule.get('listen_port')}",
-        relay=rule.get("tunnel", {}).get("addr", ""),
-        targets=rule.get("targets").split("\n"),
-        auth=GOSTAuth(username=rule.get("tunnel", {}).get("username"), password=rule.get("tunnel", {}).get("password")),
-        limit=limit,
+    # parsing and fingerprinting a large rule set would block the event loop
+    await asyncio.to_thread(
+        state.set_rules, rules=result.get("data", []), etag=etag, version=str(result.get("version") or "")
     )
-    if add_ok:
-        logger.info(f"ingress rule {service_name} added success")
-        await panel_api.update_relay_rule_status(rule_id=rule.get("id"), rule_type=rule.get("type"), status=3)
-        return True
-    else:
-        logger.error(f"ingress rule {service_name} add error")
-        return False
+    return state.rule_models
 
 
-async def sync_egress_rule(panel_api: TYZApi, rule: dict, gost_api: GOSTApi, service_map: dict) -> bool:
+async def sync_relay_rules(
+    panel_api: TYZApi,
+    gost_api: GOSTApi,
+    executor: Executor,
+    state: SyncState,
+    status: StatusCoalescer = None,
+    prober: TargetProber = None,
+    bulk: BulkBackend = None,
+    accumulator: TrafficAccumulator = None,
+) -> bool:
     """
-    Sync egress rule.
+    Sync relay rules, skipped when neither panel rules nor GOST config changed since last in-sync cycle.
     :param panel_api:
-    :param rule:
-    :param gost_api: gost api client
-    :param service_map: gost service map
-    :return:
+    :param gost_api:
+    :param executor:
+    :param state:
+    :param status: rule status coalescer, statuses failed in earlier cycles are retried
+    :param prober: target prober, orders targets fastest first
+    :param bulk: bulk backend, large plans are applied as one config replacement
+    :param accumulator: observer traffic, counters of deleted services are dropped
+    :return: whether any change was applied
     """
-    service_name = gen_service_name(rule.get("id"), rule_type=rule.get("type"), node_id=rule.get("egress_node"))
-    old_service = service_map.get(service_name)
-    if old_service:
-        old_port = old_service.get("addr", ":").split(":")[1]
-        old_transport_type = old_service.get("listener", {}).get("type", "")
-        new_transport_type = "ws" if rule.get("transport_type", "") == "WebSocket" else "unknown"
-        if old_port == str(rule.get("listen_port")) and old_transport_type == new_transport_type:
-            logger.info(f"{service_name} already exists")
-            return True
+    if status is not None:
+        await status.flush()
 
-    logger.info(f"creating or updating service {service_name}")
+    now = time.monotonic()
+    force = state.full_sync_due(now=now)
+    # a full sync re-reads GOST, objects lost or edited outside of node are repaired
+    live = await load_gost_objects(gost_api=gost_api, force=force)
+    rules = await fetch_relay_rules(panel_api=panel_api, state=state, force=force)
+    gost_revision = gost_api.mirror.revision
+    if not force and state.unchanged(gost_revision=gost_revision):
+        logger.info("relay rules and gost config unchanged, skip sync")
+        return False
 
-    add_ok = await add_ws_egress_service(
-        gost_api=gost_api,
-        name=service_name,
-        addr=f":{rule.get('listen_port')}",
-        auth=GOSTAuth(username=rule.get("tunnel", {}).get("username"), password=rule.get("tunnel", {}).get("password")),
-    )
-    if add_ok:
-        logger.info(f"egress rule {service_name} added success")
-        await panel_api.update_relay_rule_status(rule_id=rule.get("id"), rule_type=rule.get("type"), status=3)
-        return True
-    else:
-        logger.error(f"egress rule {service_name} add error")
+    if force:
+        state.last_full_sync = now
+    if status is not None:
+        status.retain(rules=rules)
+
+    plan = await asyncio.to_thread(build_sync_plan, rules=rules, live=live, prober=prober, node_id=panel_api.node_id)
+    if not plan:
+        state.mark_in_sync(gost_revision=gost_revision)
+        logger.info("relay rules already in sync")
         return False
 
+    state.mark_dirty()
+    result = None
+    if bulk and bulk.wanted(plan):
+        result = await apply_bulk(
+            plan=plan, panel_api=panel_api, gost_api=gost_api, executor=executor, backend=bulk, status=status
+        )
+        if result is None:
+            logger.warning("bulk apply failed, fall back to per-object apply")
 
-async def sync_raw_redirect_rule(
-    panel_api: TYZApi, rule: dict, gost_api: GOSTApi, service_map: dict, limit: RelayRuleLimit = None
-) -> bool:
+    if result is None:
+        await apply_sync_plan(plan=plan, panel_api=panel_api, gost_api=gost_api, executor=executor, status=status)
+    if accumulator is not None:
+        forget_deleted(plan=plan, gost_api=gost_api, accumulator=accumulator)
+    return True
+
+
+async def sync_relay_rules_by_ids(
+    panel_api: TYZApi,
+    gost_api: GOSTApi,
+    executor: Executor,
+    state: SyncState,
+    rule_ids: list,
+    status: StatusCoalescer = None,
+    prober: TargetProber = None,
+    accumulator: TrafficAccumulator = None,
+) -> dict:
     """
-    Sync raw redirect rule.
+    Sync some changed or deleted relay rules only, without diffing the whole rule set.
     :param panel_api:
-    :param rule:
     :param gost_api:
-    :param service_map:
-    :param limit:
-    :return:
+    :param executor:
+    :param state:
+    :param rule_ids:
+    :param status: rule status coalescer
+    :param prober: target prober
+    :param accumulator: observer traffic, counters of deleted services are dropped
+    :return: applied plan summary and failed object names
     """
-    service_name = gen_service_name(rule.get("id"), rule_type=rule.get("type"), node_id=rule.get("ingress_node"))
-    await add_or_update_limiters(gost_api=gost_api, service_name=service_name, limit=limit)
-
-    old_service = service_map.get(service_name)
-    if old_service:
-        old_port = old_service.get("addr", ":").split(":")[1]
-        old_targets = collect_key_from_dict_list(_list=old_service.get("forwarder", {}).get("nodes", []), key="addr")
-        old_speed_limiter = old_service.get("limiter", "")
-        old_conn_limiter = old_service.get("climiter", "")
-        if (
-            old_port == str(rule.get("listen_port"))
-            and old_targets == rule.get("targets").split("\n")
-            and old_speed_limiter == gen_limiter_name(service=service_name, _type="speed")
-            and old_conn_limiter == gen_limiter_name(service=service_name, _type="conn")
-        ):
-            logger.info(f"{service_name} already exists")
-            return True
-
-    logger.info(f"creating or updating service {service_name}")
-    add_ok = await add_raw_redir_service(
-        gost_api=gost_api,
-        name=service_name,
-        addr=f":{rule.get('listen_port')}",
-        targets=rule.get("targets").split("\n"),
-        limit=limit,
+    live = await load_gost_objects(gost_api=gost_api)
+    rules = await fetch_relay_rules(panel_api=panel_api, state=state)
+    if status is not None:
+        status.retain(rules=rules)
+    plan = await asyncio.to_thread(
+        build_targeted_plan, rules=rules, live=live, rule_ids=rule_ids, prober=prober, node_id=panel_api.node_id
     )
-    if add_ok:
-        logger.info(f"ingress rule {service_name} added success")
-        await panel_api.update_relay_rule_status(rule_id=rule.get("id"), rule_type=rule.get("type"), status=3)
-        return True
-    else:
-        logger.error(f"ingress rule {service_name} add error")
-        return False
+    if not plan:
+        logger.info(f"relay rules {rule_ids} already in sync")
+        return {"summary": {}, "failed": []}
 
+    # let next periodic cycle verify the whole rule set
+    state.mark_dirty()
+    result = await apply_sync_plan(plan=plan, panel_api=panel_api, gost_api=gost_api, executor=executor, status=status)
+    if accumulator is not None:
+        forget_deleted(plan=plan, gost_api=gost_api, accumulator=accumulator)
+    return result
 
-async def report_traffic_by_rules(panel_api: TYZApi, prom_api: PrometheusApi):
+
+def traffic_by_rules(traffic: Dict[str, float], node_id: int = None) -> dict:
     """
-    Report used traffic by rules.
-    :param panel_api: panel api client
-    :param prom_api: prometheus api client
-    :return:
+    Group used traffic of services by rule type and id, as reported to panel.
+    :param traffic: {service: used}
+    :param node_id: panel node id, services of other nodes sharing prometheus or GOST are skipped
+    :return: {"raw": {"1": used}, "tunnel": {...}, "egress": {...}}
     """
-    t1 = asyncio.create_task(calc_traffic_by_service(prom_api=prom_api, seconds=30, direction="input"))
-    t2 = asyncio.create_task(calc_traffic_by_service(prom_api=prom_api, seconds=30, direction="output"))
-    inputs = await t1
-    outputs = await t2
-
-    result = Counter(inputs) + Counter(outputs)
     traffic_data = {"raw": {}, "tunnel": {}, "egress": {}}
-    for service_name in result:
-        rule_id, rule_type, node_id = parse_rule_info_from_service(service=service_name)
+    for service_name, used in traffic.items():
+        if used <= 0:
+            continue
+        try:
+            rule_id, rule_type, service_node_id = parse_rule_info_from_service(service=service_name)
+        except (IndexError, ValueError):
+            continue
+        if node_id is not None and service_node_id != node_id:
+            continue
         # Use MB
-        traffic_data[rule_type.lower()][str(rule_id)] = int(result[service_name])
-
-    logger.info(f"report traffic data: {result}")
-    await panel_api.traffic_report(data=traffic_data)
+        traffic_data[rule_type.lower()][str(rule_id)] = int(used)
+    return traffic_data
 
 
-async def old_gost_service_cleanup(gost_api: GOSTApi, service_map: dict, chain_map: dict, new_service_names: list):
+async def report_traffic_by_rules(panel_api: TYZApi, source, executor: Executor, spool: TrafficSpool):
     """
-    Delete useless services and chains.
-    :param gost_api:
-    :param service_map: old services
-    :param chain_map: old chains
-    :param new_service_names:
+    Report used traffic by rules, batches the panel did not accept are spooled and replayed later.
+    :param panel_api: panel api client
+    :param source: traffic source, prometheus or observer
+    :param executor:
+    :param spool: unacknowledged traffic reports
     :return:
     """
-    useless_services = [k for k, _ in service_map.items() if k not in new_service_names]
-    new_chain_names = [f"{s}-chain" for s in new_service_names]
-    useless_chains = [k for k, _ in chain_map.items() if k not in new_chain_names]
-    del_service_tasks = [del_service(gost_api=gost_api, name=s) for s in useless_services]
-    del_chain_tasks = [del_chain(gost_api=gost_api, name=c) for c in useless_chains]
-    tasks = del_service_tasks + del_chain_tasks
-    await asyncio.gather(*tasks)
-    logger.info(f"del {len(useless_services)} services and {len(useless_chains)} chains success")
+    result = await source.collect()
+    traffic_data = await asyncio.to_thread(traffic_by_rules, traffic=result, node_id=panel_api.node_id)
+    logger.info(f"report traffic of {sum(len(v) for v in traffic_data.values())} rules")
+    logger.debug(f"report traffic data: {traffic_data}")
+    if panel_api.retry_after() > 0:
+        if any(traffic_data.values()):
+            await spool.append(data=traffic_data)
+        logger.info(f"panel asked to retry after {panel_api.retry_after():.0f}s, traffic spooled")
+        return
+
+    replay = len(spool) > 0
+    if replay:
+        # keep order, this batch goes behind the spooled ones and all are sent merged
+        if any(traffic_data.values()):
+            await spool.append(data=traffic_data)
+        if not spool.ready():
+            logger.info(f"panel in backoff, {len(spool)} traffic batches spooled")
+            return
+        traffic_data = spool.pending()
+
+    success, msg, _ = await executor.run(panel_api.upstream, LANE_WRITE, panel_api.traffic_report, data=traffic_data)
+    if success:
+        TRAFFIC_REPORTED_AT.set(time.time(), node_id=panel_api.node_id)
+        if replay:
+            logger.info(f"{len(spool)} spooled traffic batches reported")
+            spool.ack()
+        return
+
+    logger.error(f"report traffic error: {msg}")
+    if not replay and any(traffic_data.values()):
+        await spool.append(data=traffic_data)
+    spool.backoff()
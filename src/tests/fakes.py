@@ -0,0 +1,205 @@
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from utils import consts
+
+KINDS = tuple(k.value for k in consts.GOSTObjectKind)
+RULE_TYPES = (consts.RuleType.TUNNEL.value, consts.RuleType.RAW.value, consts.RuleType.EGRESS.value)
+
+
+class FakeUpstream:
+    """
+    In-process stand-in for an upstream HTTP API, served through an httpx mock transport.
+    Latency and error rate are injected per request, requests are counted by method and route.
+    """
+
+    # (method, path regex, handler name)
+    routes: Tuple[Tuple[str, str, str], ...] = ()
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.errors = 0
+        self._routes = [(m, re.compile(f"^{p}$"), getattr(self, h)) for m, p, h in self.routes]
+
+    @property
+    def total(self) -> int:
+        return sum(self.requests.values())
+
+    def attach(self, api):
+        """
+        Point an API client at this stand-in.
+        :param api: BasicApi
+        :return: api
+        """
+        api._client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        return api
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for method, pattern, handler in self._routes:
+            m = pattern.match(request.url.path)
+            if method != request.method or m is None:
+                continue
+            self.requests[f"{method} {pattern.pattern[1:-1]}"] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return httpx.Response(500, json={"msg": "injected error"})
+            return handler(request, *m.groups())
+        self.requests[f"{request.method} unknown"] += 1
+        return httpx.Response(404, json={"msg": "not found"})
+
+    @staticmethod
+    def body(request: httpx.Request) -> dict:
+        return json.loads(request.content or b"{}")
+
+
+class FakeGOST(FakeUpstream):
+    """
+    GOST config API: objects are kept by kind and name, creating an existing object fails with "object duplicated",
+    updating or deleting a missing one with "object not found".
+    """
+
+    routes = (
+        ("GET", "/config", "get_config"),
+        ("POST", "/config/([a-z]+)", "create"),
+        ("PUT", "/config/([a-z]+)/([^/]+)", "update"),
+        ("DELETE", "/config/([a-z]+)/([^/]+)", "delete"),
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.objects: Dict[str, Dict[str, dict]] = {k: {} for k in KINDS}
+
+    def size(self) -> int:
+        return sum(len(objs) for objs in self.objects.values())
+
+    @staticmethod
+    def ok() -> httpx.Response:
+        return httpx.Response(200, json={"msg": "OK"})
+
+    def get_config(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={k: list(objs.values()) for k, objs in self.objects.items()})
+
+    def create(self, request: httpx.Request, kind: str) -> httpx.Response:
+        data = self.body(request)
+        if data.get("name") in self.objects[kind]:
+            return httpx.Response(400, json={"code": 40002, "msg": "object duplicated"})
+        self.objects[kind][data["name"]] = data
+        return self.ok()
+
+    def update(self, request: httpx.Request, kind: str, name: str) -> httpx.Response:
+        if name not in self.objects[kind]:
+            return httpx.Response(404, json={"code": 40004, "msg": "object not found"})
+        self.objects[kind][name] = {**self.body(request), "name": name}
+        return self.ok()
+
+    def delete(self, request: httpx.Request, kind: str, name: str) -> httpx.Response:
+        if self.objects[kind].pop(name, None) is None:
+            return httpx.Response(404, json={"code": 40004, "msg": "object not found"})
+        return self.ok()
+
+
+class FakePanel(FakeUpstream):
+    """
+    Panel relay rule sync and traffic API, rule fetches honour ETag.
+    """
+
+    routes = (
+        ("GET", "/api/relay-rule-sync/", "fetch_rules"),
+        ("PUT", "/api/relay-rule-sync/", "update_status"),
+        ("PUT", "/api/relay-rule-sync/batch/", "update_status_batch"),
+        ("POST", "/api/relay-rule-traffic/", "report_traffic"),
+    )
+
+    def __init__(self, rules: List[dict] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.rules = rules or []
+        self.version = 1
+        # (type, id) -> last reported status
+        self.statuses: Dict[Tuple[str, int], int] = {}
+        self.traffic: List[dict] = []
+
+    def set_rules(self, rules: List[dict]):
+        self.rules = rules
+        self.version += 1
+
+    def fetch_rules(self, request: httpx.Request) -> httpx.Response:
+        etag = f'"{self.version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, json={"msg": "OK", "data": self.rules}, headers={"ETag": etag})
+
+    def update_status(self, request: httpx.Request) -> httpx.Response:
+        data = self.body(request)
+        self.statuses[(data["type"], data["id"])] = data["status"]
+        return httpx.Response(200, json={"msg": "OK"})
+
+    def update_status_batch(self, request: httpx.Request) -> httpx.Response:
+        for r in self.body(request).get("rules", []):
+            self.statuses[(r["type"], r["id"])] = r["status"]
+        return httpx.Response(200, json={"msg": "OK"})
+
+    def report_traffic(self, request: httpx.Request) -> httpx.Response:
+        self.traffic.append(self.body(request).get("data", {}))
+        return httpx.Response(200, json={"msg": "OK"})
+
+
+class FakePrometheus(FakeUpstream):
+    """
+    Prometheus instant query API, every query returns the configured traffic increase of each service.
+    """
+
+    routes = (("GET", "/api/v1/query", "query"),)
+
+    def __init__(self, traffic: Dict[str, Tuple[float, float]] = None, **kwargs):
+        super().__init__(**kwargs)
+        # service -> (input bytes, output bytes) per query window
+        self.traffic = traffic or {}
+
+    def query(self, request: httpx.Request) -> httpx.Response:
+        t = float(request.url.params.get("time", 0))
+        result = [
+            {"metric": {"service": service, "direction": direction}, "value": [t, str(value)]}
+            for service, values in self.traffic.items()
+            for direction, value in zip(("input", "output"), values)
+        ]
+        return httpx.Response(200, json={"status": "success", "data": {"resultType": "vector", "result": result}})
+
+
+def make_rules(n: int, node_id: int = 1, start_id: int = 1, seed: Optional[int] = 0) -> List[dict]:
+    """
+    Panel relay rules of all types for one node.
+    :param n:
+    :param node_id:
+    :param start_id:
+    :param seed: rule types and limits are drawn from it
+    :return:
+    """
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(start_id, start_id + n):
+        rule_type = rnd.choice(RULE_TYPES)
+        rules.append(
+            {
+                "id": i,
+                "type": rule_type,
+                "ingress_node": node_id,
+                "egress_node": node_id,
+                "listen_port": 10000 + i % 50000,
+                "transport_type": "WebSocket",
+                "targets": "\n".join(f"10.{i % 250}.{j}.1:{443 + j}" for j in range(rnd.randint(1, 3))),
+                "tunnel": {"addr": f"172.16.{i % 250}.1:8080", "username": f"u{i}", "password": f"p{i}"},
+                "limit": json.dumps({"speed": rnd.choice((0, 10, 100)), "conn": rnd.choice((0, 50))}),
+            }
+        )
+    return rules
@@ -0,0 +1,73 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from routers import push, sync
+from sched import Scheduler
+from tests.test_services import TUNNEL_RULE, mock_api
+
+
+@pytest.mark.asyncio
+async def test_push_rules(tmp_path):
+    def handler(request: httpx.Request):
+        if request.url.path == "/config":
+            return httpx.Response(200, json={"services": [{"name": "rule-9-raw-node-1"}]})
+        return httpx.Response(200, json={"msg": "OK", "data": [TUNNEL_RULE]})
+
+    cfg = {"tyz": {"endpoint": "http://panel", "node_id": 1}, "gost": {"endpoint": "http://gost"}}
+    scheduler = Scheduler(cfg={**cfg, "traffic": {"spool_path": str(tmp_path / "spool.jsonl")}})
+    node = scheduler.get_node()
+    mock_api(node.panel_api, handler)
+    mock_api(node.gost_api, handler)
+    scheduler.scheduler.start(paused=True)
+    scheduler._add_schedules(node=node)
+    scheduler._reschedule_sync(node=node, seconds=node.sync_interval.idle())
+
+    app = FastAPI()
+    app.include_router(push.router, prefix="/push")
+    app.state.scheduler = scheduler
+    app.state.token = "secret"
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://node") as client:
+        resp = await client.post("/push/rules", json={"rules": [1]}, headers={"Authorization": "Bearer wrong"})
+        assert resp.status_code == 401
+
+        resp = await client.post(
+            "/push/rules", json={"rules": [1], "deleted": [9]}, headers={"Authorization": "Bearer secret"}
+        )
+    body = resp.json()
+    assert body["success"]
+    assert body["data"]["summary"]["services"] == {"create": 1, "delete": 1}
+    assert node.sync_state.synced_fingerprint is None
+    # next full cycle verifies the push soon
+    job = scheduler.scheduler.get_job(job_id="default-sync-relay-rules")
+    assert job.trigger.interval.total_seconds() == node.sync_interval.minimum
+    scheduler.scheduler.shutdown()
+    await scheduler.client_pool.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_plan(tmp_path):
+    def handler(request: httpx.Request):
+        if request.url.path == "/config":
+            return httpx.Response(200, json={})
+        return httpx.Response(200, json={"msg": "OK", "data": [TUNNEL_RULE]})
+
+    cfg = {"tyz": {"endpoint": "http://panel", "node_id": 1}, "gost": {"endpoint": "http://gost"}}
+    scheduler = Scheduler(cfg={**cfg, "traffic": {"spool_path": str(tmp_path / "spool.jsonl")}})
+    node = scheduler.get_node()
+    mock_api(node.panel_api, handler)
+    mock_api(node.gost_api, handler)
+
+    app = FastAPI()
+    app.include_router(sync.router, prefix="/sync")
+    app.state.scheduler = scheduler
+    app.state.token = "secret"
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://node") as client:
+        resp = await client.get("/sync/plan", params={"verbose": True})
+        assert resp.status_code == 401
+
+        resp = await client.get("/sync/plan", params={"verbose": True}, headers={"Authorization": "Bearer secret"})
+    chain = next(a for a in resp.json()["data"]["actions"] if a["kind"] == "chains")
+    # tunnel credentials are masked
+    assert chain["data"]["hops"][0]["nodes"][0]["connector"]["auth"] == {"username": "***", "password": "***"}
+    await scheduler.client_pool.close()
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from apscheduler.events import EVENT_JOB_MISSED, JobEvent
+from httpx import AsyncClient, MockTransport, Response
+
+from exceptions.gost import GOSTApiException
+from sched import (
+    JOB_FAILURES,
+    JOB_LAST_SUCCESS,
+    JOB_MISFIRES,
+    JOB_SECONDS,
+    AdaptiveInterval,
+    Scheduler,
+    node_configs,
+)
+
+CFG = {
+    "tyz": {"endpoint": "https://panel.example.com", "token": "t"},
+    "nodes": [
+        {"name": "edge-1", "tyz": {"node_id": 1}, "gost": {"endpoint": "http://127.0.0.1:18080"}},
+        {"tyz": {"node_id": 2}, "gost": {"endpoint": "http://127.0.0.1:18081"}},
+    ],
+}
+
+
+def test_node_configs():
+    assert node_configs({"tyz": {"node_id": 1}}) == [("default", {"tyz": {"node_id": 1}})]
+    nodes = node_configs(CFG)
+    assert [name for name, _ in nodes] == ["edge-1", "node-2"]
+    assert nodes[1][1]["tyz"] == {"endpoint": "https://panel.example.com", "token": "t", "node_id": 2}
+
+
+@pytest.mark.asyncio
+async def test_nodes_share_client_pool(tmp_path):
+    cfg = {**CFG, "traffic": {"spool_path": str(tmp_path / "spool.jsonl")}}
+    scheduler = Scheduler(cfg=cfg)
+    n1, n2 = scheduler.nodes
+    assert n1.panel_api.client is n2.panel_api.client
+    assert n1.gost_api.client is not n2.gost_api.client
+    assert n1.gost_api.upstream != n2.gost_api.upstream
+    assert scheduler.get_node_by_id(2) is n2
+    assert n1.traffic_spool.path.name == "spool-edge-1.jsonl"
+    await scheduler.client_pool.close()
+
+
+def test_adaptive_interval():
+    interval = AdaptiveInterval(minimum=30, maximum=100, factor=2)
+    assert [interval.idle() for _ in range(3)] == [60, 100, 100]
+    assert interval.busy() == 30
+
+
+@pytest.mark.asyncio
+async def test_sync_skipped_on_retry_after(tmp_path):
+    scheduler = Scheduler(cfg={"traffic": {"spool_path": str(tmp_path / "spool.jsonl")}})
+    node = scheduler.get_node()
+    node.panel_api._throttled(Response(429, headers={"Retry-After": "120"}))
+    assert 110 < node.panel_api.retry_after() <= 120
+
+    scheduler.run_scheduler()
+    await scheduler._sync_job(node=node)
+    job = scheduler.scheduler.get_job(job_id="default-sync-relay-rules")
+    assert job.trigger.interval.total_seconds() >= 110
+    scheduler.scheduler.shutdown()
+    await scheduler.client_pool.close()
+
+
+@pytest.mark.asyncio
+async def test_job_metrics():
+    async def fail():
+        raise ValueError("boom")
+
+    await Scheduler._timed(job="test-ok", func=asyncio.sleep, delay=0)
+    with pytest.raises(ValueError):
+        await Scheduler._timed(job="test-fail", func=fail)
+    Scheduler._on_job_missed(JobEvent(code=EVENT_JOB_MISSED, job_id="test-ok", jobstore="default"))
+
+    assert JOB_SECONDS.data[("test-ok",)][-1] == 1
+    assert JOB_FAILURES.values == {("test-fail",): 1}
+    assert ("test-ok",) in JOB_LAST_SUCCESS.values and ("test-fail",) not in JOB_LAST_SUCCESS.values
+    assert JOB_MISFIRES.values[("test-ok", "missed")] == 1
+
+
+@pytest.mark.asyncio
+async def test_sync_interval_kept_on_failure(tmp_path):
+    gost_cfg = {"endpoint": "http://gost", "pool": {"retries": 0}}
+    scheduler = Scheduler(cfg={"gost": gost_cfg, "traffic": {"spool_path": str(tmp_path / "spool.jsonl")}})
+    node = scheduler.get_node()
+    node.gost_api._client = AsyncClient(transport=MockTransport(lambda r: Response(500, json={"msg": "down"})))
+
+    scheduler.run_scheduler()
+    for _ in range(2):
+        with pytest.raises(GOSTApiException):
+            await scheduler._sync_job(node=node)
+    job = scheduler.scheduler.get_job(job_id="default-sync-relay-rules")
+    assert node.sync_interval.current == node.sync_interval.minimum
+    assert job.trigger.interval.total_seconds() == node.sync_interval.minimum
+    scheduler.scheduler.shutdown()
+    await scheduler.client_pool.close()
@@ -1,31 +1,95 @@
+import asyncio
+import json
+import time
+
+import httpx
 import pytest
 
-from services.api import GOSTApi, PrometheusApi
-from services.gost import add_ws_ingress_service, add_ws_egress_service, fetch_all_config, calc_traffic_by_service
+from exceptions.api import CircuitOpenException, DeadlineExceededException
+from services.api import UPSTREAM_SECONDS, GOSTApi, PrometheusApi, TYZApi, GOSTMetricsApi
+from services.bulk import FileBulkBackend
+from services.executor import Executor, UpstreamLimit
+from services.ingest import ObserverIngest
+from services.loop import LOOP_LAG, monitor_loop_lag
+from services.mirror import GOSTMirror
+from services.gost import (
+    add_object,
+    fetch_all_config,
+    query_traffic_by_service,
+    render_chain,
+    render_service,
+)
+from services.plan import OBJECTS_APPLIED, build_sync_plan, build_targeted_plan, apply_sync_plan
+from services.resilience import deadline
+from services.prober import TargetProber, TargetHealth
+from services.snapshot import Snapshot, restore_snapshot
+from services.spool import TrafficSpool
+from services.state import SyncState
+from services.status import StatusCoalescer
+from services.timeseries import TimeSeriesStore
+from services.traffic import (
+    TrafficAccumulator,
+    ObserverTrafficSource,
+    GOSTMetricsTrafficSource,
+    PrometheusTrafficSource,
+)
+from services.tyz import sync_relay_rules, report_traffic_by_rules
 from utils.gost import extract_key_from_dict_list, GOSTAuth
+from utils import consts
+from utils.models import ChainSpec, ServiceSpec, parse_rules
+from .fakes import FakeGOST, FakePanel, FakePrometheus, make_rules
+
+TUNNEL_RULE = {
+    "id": 1,
+    "type": "Tunnel",
+    "ingress_node": 1,
+    "listen_port": 10001,
+    "targets": "1.1.1.1:443",
+    "tunnel": {"addr": "2.2.2.2:8080", "username": "u", "password": "p"},
+    "limit": '{"speed": 80, "conn": 10}',
+}
+
+
+def live_objects(gost_cfg: dict) -> dict:
+    mirror = GOSTMirror()
+    mirror.load(gost_cfg=gost_cfg)
+    return mirror.objects
+
+
+def mock_api(api, handler):
+    api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return api
 
 
 @pytest.mark.asyncio
 async def test_add_ws_ingress():
     gost_api = GOSTApi(endpoint="http://192.168.135.128:18080")
-    result = await add_ws_ingress_service(
-        gost_api=gost_api,
-        name="ingress-service-0",
-        addr=":8888",
-        relay="127.0.0.1:8899",
-        targets=["127.0.0.1:5201"],
-        auth=GOSTAuth(username="n1", password="n2"),
+    chain = render_chain(ChainSpec(name="ingress-service-0-chain", relay="127.0.0.1:8899", auth=GOSTAuth("n1", "n2")))
+    service = render_service(
+        ServiceSpec(
+            name="ingress-service-0",
+            type=consts.RuleType.TUNNEL.value,
+            addr=":8888",
+            targets=("127.0.0.1:5201",),
+            chain=chain["name"],
+        )
     )
-    assert result
+    assert await add_object(gost_api=gost_api, kind="chains", data=chain)
+    assert await add_object(gost_api=gost_api, kind="services", data=service)
 
 
 @pytest.mark.asyncio
 async def test_add_ws_egress():
     gost_api = GOSTApi(endpoint="http://192.168.135.128:18080")
-    result = await add_ws_egress_service(
-        gost_api=gost_api, name="egress-service-0", addr=":8899", auth=GOSTAuth(username="n1", password="n2")
+    service = render_service(
+        ServiceSpec(
+            name="egress-service-0",
+            type=consts.RuleType.EGRESS.value,
+            addr=":8899",
+            auth=GOSTAuth(username="n1", password="n2"),
+        )
     )
-    assert result
+    assert await add_object(gost_api=gost_api, kind="services", data=service)
 
 
 @pytest.mark.asyncio
@@ -40,5 +104,645 @@ async def test_parse_services():
 @pytest.mark.asyncio
 async def test_calc_traffic():
     prom = PrometheusApi(endpoint="http://192.168.135.128:19090")
-    result = await calc_traffic_by_service(prom_api=prom, seconds=30, direction="output")
+    end = time.time()
+    result = await query_traffic_by_service(prom_api=prom, start=end - 30, end=end)
     assert len(result) > 0
+
+
+@pytest.mark.asyncio
+async def test_pooled_client_reused():
+    gost_api = GOSTApi(endpoint="http://127.0.0.1:18080", max_connections=4, keepalive_expiry=5)
+    await gost_api.open()
+    client = gost_api.client
+    assert gost_api.client is client
+    await gost_api.close()
+    assert client.is_closed
+    assert gost_api.client is not client
+    await gost_api.close()
+
+
+@pytest.mark.asyncio
+async def test_upstream_retry_and_circuit_breaker():
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.method)
+        return httpx.Response(502 if len(calls) < 3 else 200, json={"msg": "OK"})
+
+    gost_api = GOSTApi(endpoint="http://gost", backoff_base=0, breaker_failures=3, breaker_reset=0.05)
+    mock_api(gost_api, handler)
+    # idempotent requests are retried, the success closes the circuit again
+    assert (await gost_api.request(url="/config", method="GET"))[0]
+    assert calls == ["GET"] * 3
+
+    calls.clear()
+    gost_api._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(500, json={})))
+    for _ in range(3):
+        assert not (await gost_api.request(url="/config/services", method="POST", data={}))[0]
+    assert gost_api.breaker.state == 2
+    with pytest.raises(CircuitOpenException):
+        await gost_api.req(url="/config", method="GET")
+
+    # after reset timeout one request probes the upstream
+    await asyncio.sleep(0.06)
+    gost_api._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(200, json={})))
+    assert (await gost_api.request(url="/config", method="GET"))[0]
+    assert gost_api.breaker.state == 0
+
+
+@pytest.mark.asyncio
+async def test_deadline_follows_executor_calls():
+    gost = FakeGOST()
+    gost_api = gost.attach(GOSTApi(endpoint="http://gost"))
+    executor = Executor()
+    with deadline(0.01):
+        await asyncio.sleep(0.02)
+        with pytest.raises(DeadlineExceededException):
+            await executor.run(gost_api.upstream, "read", gost_api.req, url="/config", method="GET")
+    assert gost.total == 0
+    assert (await executor.run(gost_api.upstream, "read", gost_api.request, url="/config", method="GET"))[0]
+
+
+def test_build_sync_plan():
+    gost_cfg = {
+        "services": [{"name": "rule-9-raw-node-1", "addr": ":9999"}],
+        "chains": [{"name": "rule-9-raw-node-1-chain"}],
+        "limiters": [{"name": "rule-1-tunnel-node-1-speed-limiter", "limits": ["$ 5MB 5MB"]}],
+    }
+    plan = build_sync_plan(rules=parse_rules([TUNNEL_RULE]), live=live_objects(gost_cfg))
+    assert plan.summary() == {
+        "limiters": {"update": 1},
+        "climiters": {"create": 1},
+        "chains": {"create": 1, "delete": 1},
+        "services": {"create": 1, "delete": 1},
+    }
+
+
+def test_plan_writes_only_changed_objects():
+    egress = {**TUNNEL_RULE, "id": 2, "type": "Egress", "egress_node": 1, "transport_type": "WebSocket"}
+    plan = build_sync_plan(rules=parse_rules([TUNNEL_RULE, egress]), live=live_objects({}))
+    gost_cfg = {}
+    for a in plan.actions:
+        # GOST fills in defaults not rendered by the node
+        gost_cfg.setdefault(a.kind, []).append({**a.data, "metadata": {}})
+    live = live_objects(gost_cfg)
+    assert not build_sync_plan(rules=parse_rules([TUNNEL_RULE, egress]), live=live)
+
+    tunnel = {**TUNNEL_RULE, "tunnel": {**TUNNEL_RULE["tunnel"], "password": "q"}, "limit": '{"speed": 40, "conn": 10}'}
+    egress["tunnel"] = tunnel["tunnel"]
+    plan = build_sync_plan(rules=parse_rules([tunnel, egress]), live=live)
+    assert [(a.kind, a.op, a.name) for a in plan.actions] == [
+        ("limiters", "update", "rule-1-tunnel-node-1-speed-limiter"),
+        ("chains", "update", "rule-1-tunnel-node-1-chain"),
+        ("services", "update", "rule-2-egress-node-1"),
+    ]
+
+
+def test_gc_only_collects_own_objects():
+    gost_cfg = {
+        "services": [{"name": "rule-5-raw-node-1"}, {"name": "rule-6-raw-node-2"}, {"name": "manual"}],
+        "chains": [{"name": "rule-5-tunnel-node-1-chain"}, {"name": "manual-chain"}],
+        "limiters": [{"name": "rule-1-tunnel-node-1-speed-limiter"}, {"name": "rule-5-raw-node-1-speed-limiter"}],
+        "climiters": [{"name": "rule-6-raw-node-2-conn-limiter"}],
+    }
+    rule = {**TUNNEL_RULE, "limit": '{"conn": 10}'}
+    plan = build_sync_plan(rules=parse_rules([rule]), live=live_objects(gost_cfg), node_id=1)
+    assert sorted((a.kind, a.name) for a in plan.actions if a.op == "delete") == [
+        ("chains", "rule-5-tunnel-node-1-chain"),
+        ("limiters", "rule-1-tunnel-node-1-speed-limiter"),
+        ("limiters", "rule-5-raw-node-1-speed-limiter"),
+        ("services", "rule-5-raw-node-1"),
+    ]
+
+
+def test_build_targeted_plan():
+    gost_cfg = {
+        "services": [{"name": "rule-9-raw-node-1"}, {"name": "rule-5-raw-node-1"}],
+        "chains": [{"name": "rule-7-tunnel-node-1-chain"}],
+        "climiters": [{"name": "rule-9-raw-node-1-conn-limiter"}],
+    }
+    plan = build_targeted_plan(rules=parse_rules([TUNNEL_RULE]), live=live_objects(gost_cfg), rule_ids=[1, 9])
+    assert plan.summary() == {
+        "limiters": {"create": 1},
+        "climiters": {"create": 1, "delete": 1},
+        "chains": {"create": 1},
+        "services": {"create": 1, "delete": 1},
+    }
+    assert "rule-5-raw-node-1" not in [a.name for a in plan.actions]
+
+    # another node sharing the GOST keeps its services of the same rule id
+    gost_cfg["services"].append({"name": "rule-1-raw-node-2"})
+    plan = build_targeted_plan(
+        rules=parse_rules([TUNNEL_RULE]), live=live_objects(gost_cfg), rule_ids=[1, 9], node_id=1
+    )
+    assert [a.name for a in plan.select(kinds=("services",), ops=("delete",))] == ["rule-9-raw-node-1"]
+
+
+@pytest.mark.asyncio
+async def test_target_prober_ordering():
+    server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+    up = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    async with server:
+        prober = TargetProber(timeout=1, max_fails=1)
+        prober.update_targets(groups=[(up, "127.0.0.1:1")])
+        assert await prober.probe_all()
+    assert prober.health[up].latency is not None
+    assert prober.order(targets=["127.0.0.1:1", up]) == [up, "127.0.0.1:1"]
+
+    # a slightly faster target does not take over, a much faster one does
+    prober.health = {"a:1": TargetHealth(latency=0.050), "b:1": TargetHealth(latency=0.045)}
+    assert prober.order(targets=["a:1", "b:1"], current=["a:1", "b:1"]) == ["a:1", "b:1"]
+    prober.health["b:1"].latency = 0.010
+    assert prober.order(targets=["a:1", "b:1"], current=["a:1", "b:1"]) == ["b:1", "a:1"]
+
+    # latency alone reordering the targets of a rule asks for a sync
+    latencies = {"a:1": 0.050, "b:1": 0.045}
+    prober = TargetProber(alpha=1, max_fails=3)
+    prober.probe = lambda target: asyncio.sleep(0, latencies[target])
+    prober.update_targets(groups=[("a:1", "b:1")])
+    assert not await prober.probe_all()
+    latencies["b:1"] = 0.010
+    assert await prober.probe_all()
+    assert prober.orders[("a:1", "b:1")] == ["b:1", "a:1"]
+    assert prober.selector["maxFails"] == 3
+
+    rule = {**TUNNEL_RULE, "type": "Raw", "targets": "a:1\nb:1"}
+    service = render_service(parse_rules([rule])[0].service_spec(targets=("b:1", "a:1")))
+    # without prober targets keep panel order
+    plan = build_sync_plan(rules=parse_rules([rule]), live=live_objects({"services": [service]}))
+    assert plan.summary()["services"] == {"update": 1}
+    service["forwarder"]["selector"] = prober.selector
+    plan = build_sync_plan(rules=parse_rules([rule]), live=live_objects({"services": [service]}), prober=prober)
+    assert "services" not in plan.summary()
+
+    # a single target gets no selector, one left from an earlier prober run is removed
+    single = parse_rules([{**rule, "targets": "a:1"}])
+    service = build_sync_plan(rules=single, live=live_objects({}), prober=prober).select(
+        kinds=("services",), ops=("create",)
+    )[0].data
+    assert "selector" not in service["forwarder"]
+    plan = build_sync_plan(rules=single, live=live_objects({"services": [service]}))
+    assert "services" not in plan.summary()
+    service = {**service, "forwarder": {**service["forwarder"], "selector": prober.selector}}
+    plan = build_sync_plan(rules=single, live=live_objects({"services": [service]}), prober=prober)
+    assert plan.summary()["services"] == {"update": 1}
+    assert "selector" not in plan.actions[-1].data["forwarder"]
+
+
+@pytest.mark.asyncio
+async def test_apply_sync_plan_order():
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append((request.method, request.url.path))
+        return httpx.Response(200, json={"msg": "OK"})
+
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), handler)
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), handler)
+    live = live_objects({"services": [{"name": "rule-9-raw-node-1"}]})
+    plan = build_sync_plan(rules=parse_rules([TUNNEL_RULE]), live=live)
+    result = await apply_sync_plan(plan=plan, panel_api=panel_api, gost_api=gost_api, executor=Executor())
+    assert result["failed"] == []
+    paths = [p for _, p in calls]
+    assert paths.index("/config/services") > paths.index("/config/chains")
+    assert paths.index("/api/relay-rule-sync/batch/") > paths.index("/config/services")
+    assert paths[-1] == "/config/services/rule-9-raw-node-1"
+    assert set(gost_api.mirror.objects["services"]) == {"rule-1-tunnel-node-1"}
+
+
+@pytest.mark.asyncio
+async def test_status_coalescer_fallback_and_dedup():
+    calls, fail = [], {2}
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.path)
+        if request.url.path.endswith("/batch/"):
+            return httpx.Response(404)
+        rule_id = json.loads(request.content)["id"]
+        return httpx.Response(500 if rule_id in fail else 200, json={"msg": "OK"})
+
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), handler)
+    status = StatusCoalescer(panel_api=panel_api, executor=Executor())
+    rules = parse_rules([{**TUNNEL_RULE, "id": i} for i in range(1, 4)])
+    for r in rules:
+        status.mark(rule=r, status=3)
+    await status.flush()
+    assert status.batch_supported is False
+    assert calls.count("/api/relay-rule-sync/") == 3
+    assert list(status.pending) == [("Tunnel", 2)]
+
+    # reported statuses are skipped, the failed one is retried
+    fail.clear()
+    for r in rules:
+        status.mark(rule=r, status=3)
+    await status.flush()
+    assert len(status) == 0
+    assert calls.count("/api/relay-rule-sync/") == 4
+    assert calls.count("/api/relay-rule-sync/batch/") == 1
+
+
+@pytest.mark.asyncio
+async def test_executor_bounded_and_fair():
+    executor = Executor(limits={"gost": UpstreamLimit(concurrency=2, lane_weights={"write": 1, "delete": 1})})
+    running, peak, order = 0, 0, []
+
+    async def call(lane: str):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.001)
+        order.append(lane)
+        running -= 1
+        return lane
+
+    tasks = [executor.run("gost", "write", call, "write") for _ in range(6)]
+    tasks += [executor.run("gost", "delete", call, "delete") for _ in range(2)]
+    result = await asyncio.gather(*tasks)
+    assert result == ["write"] * 6 + ["delete"] * 2
+    assert peak == 2
+    # deletes queued behind six writes still run early
+    assert "delete" in order[:4]
+
+
+@pytest.mark.asyncio
+async def test_sync_skips_unchanged_rules():
+    conditional = []
+
+    def panel(request: httpx.Request):
+        conditional.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == "v1":
+            return httpx.Response(304)
+        return httpx.Response(200, json={"msg": "OK", "data": []}, headers={"ETag": "v1"})
+
+    gost_calls = []
+
+    def gost(request: httpx.Request):
+        gost_calls.append(request.url.path)
+        return httpx.Response(200, json={"services": []})
+
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), gost)
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), panel)
+    state = SyncState(full_sync_interval=3600)
+    for _ in range(2):
+        await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=Executor(), state=state)
+
+    assert conditional == [None, "v1"]
+    # full config is fetched once, later cycles read the mirror
+    assert gost_calls == ["/config"]
+    assert state.synced_fingerprint is not None
+    assert not state.full_sync_due()
+
+
+@pytest.mark.asyncio
+async def test_sync_converges_against_fake_gost():
+    rules = make_rules(n=50)
+    gost, panel = FakeGOST(), FakePanel(rules=rules)
+    gost.objects["services"]["manual"] = {"name": "manual"}
+    gost_api = gost.attach(GOSTApi(endpoint="http://gost"))
+    panel_api = panel.attach(TYZApi(endpoint="http://panel", node_id=1, token="t"))
+    executor, state = Executor(), SyncState()
+    status = StatusCoalescer(panel_api=panel_api, executor=executor)
+
+    assert await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=executor, state=state, status=status)
+    assert set(gost.objects["services"]) == {r.service_name for r in parse_rules(rules)} | {"manual"}
+    assert panel.statuses == {(r["type"], r["id"]): 3 for r in rules}
+    assert UPSTREAM_SECONDS.data[(gost_api.upstream, "POST")][-1] >= gost.requests["POST /config/([a-z]+)"]
+    assert OBJECTS_APPLIED.values[("services", "create", "ok")] >= len(rules)
+
+    # gost restarted with an empty config, a forced full sync re-reads it and repairs
+    fetches = gost.requests["GET /config"]
+    gost.objects = {k: {} for k in gost.objects}
+    state.last_full_sync = 0
+    assert await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=executor, state=state)
+    assert gost.requests["GET /config"] == fetches + 1
+    assert set(gost.objects["services"]) == {r.service_name for r in parse_rules(rules)}
+
+    writes = gost.total
+    state.last_full_sync = 0
+    assert not await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=executor, state=state)
+    assert gost.total == writes + 1
+
+    # observer counters and reported statuses of deleted rules are dropped
+    acc = TrafficAccumulator()
+    gone, kept = (r.service_name for r in parse_rules(rules[:2]))
+    for service in (gone, kept):
+        acc.feed(service=service, input_bytes=1, output_bytes=1)
+    panel.set_rules(rules[1:])
+    assert await sync_relay_rules(
+        panel_api=panel_api, gost_api=gost_api, executor=executor, state=state, status=status, accumulator=acc
+    )
+    assert gone not in gost.objects["services"]
+    assert list(acc.last) == [(kept, "")]
+    assert set(status.reported) == {(r["type"], r["id"]) for r in rules[1:]}
+
+
+@pytest.mark.asyncio
+async def test_apply_falls_back_on_stale_mirror():
+    gost = FakeGOST()
+    gost.objects["services"]["rule-1-raw-node-1"] = {"name": "rule-1-raw-node-1"}
+    gost_api = gost.attach(GOSTApi(endpoint="http://gost"))
+    gost_api.mirror.load({"services": [{"name": "rule-2-raw-node-1"}]})
+    panel_api = FakePanel().attach(TYZApi(endpoint="http://panel", node_id=1, token="t"))
+    plan = build_sync_plan(
+        rules=parse_rules([{**TUNNEL_RULE, "id": i, "type": "Raw", "limit": ""} for i in (1, 2)]),
+        live=gost_api.mirror.objects,
+    )
+    assert [(a.op, a.name) for a in plan.select(kinds=("services",), ops=("create", "update"))] == [
+        ("create", "rule-1-raw-node-1"),
+        ("update", "rule-2-raw-node-1"),
+    ]
+
+    result = await apply_sync_plan(plan=plan, panel_api=panel_api, gost_api=gost_api, executor=Executor())
+    assert result["failed"] == []
+    # duplicated create updated, missing object of an update created
+    assert gost.requests["PUT /config/([a-z]+)/([^/]+)"] == 2
+    assert gost.requests["POST /config/([a-z]+)"] == 2
+    assert gost.objects["services"]["rule-1-raw-node-1"]["addr"] == ":10001"
+    assert "rule-2-raw-node-1" in gost.objects["services"]
+    assert gost_api.mirror.refresh_due()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_warm_start(tmp_path):
+    objects = {
+        "services": [{"name": "rule-1-raw-node-1"}, {"name": "rule-1-raw-node-2"}, {"name": "manual"}],
+        "chains": [{"name": "rule-2-tunnel-node-1-chain"}],
+    }
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), lambda r: httpx.Response(200, json=objects))
+    gost_api.mirror.load(objects)
+    state = SyncState(rules=[TUNNEL_RULE], rules_etag="v1", rules_fingerprint="f")
+    snapshot = Snapshot(path=str(tmp_path / "snapshot.json"), node_id=1)
+    # only verified in-sync state is saved
+    assert not await snapshot.save(state=state, gost_api=gost_api)
+    state.mark_in_sync(gost_revision=gost_api.mirror.revision)
+    assert await snapshot.save(state=state, gost_api=gost_api)
+    assert not await snapshot.save(state=state, gost_api=gost_api)
+    # objects of other nodes or not managed by node are left out, the file is private
+    assert snapshot.load()["objects"]["services"] == [{"name": "rule-1-raw-node-1"}]
+    assert snapshot.path.stat().st_mode & 0o777 == 0o600
+
+    created = []
+
+    def empty_gost(request: httpx.Request):
+        if request.method == "POST":
+            created.append(request.url.path)
+        return httpx.Response(200, json={"msg": "OK"})
+
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), empty_gost)
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), empty_gost)
+    state = SyncState()
+    result = await restore_snapshot(
+        snapshot=snapshot, panel_api=panel_api, gost_api=gost_api, executor=Executor(), state=state
+    )
+    assert result["failed"] == []
+    assert created == ["/config/chains", "/config/services"]
+    assert state.rules == [TUNNEL_RULE] and state.rules_etag == "v1"
+
+
+@pytest.mark.asyncio
+async def test_sync_bulk_apply(tmp_path):
+    path = tmp_path / "gost.json"
+    gost_cfg = {"api": {"addr": ":18080"}, "services": [{"name": "rule-9-raw-node-1"}]}
+    calls = []
+
+    def gost(request: httpx.Request):
+        calls.append((request.method, request.url.path))
+        # gost runs the config file once reloaded
+        return httpx.Response(200, json=json.loads(path.read_text()) if path.exists() else gost_cfg)
+
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), gost)
+    panel_api = mock_api(
+        TYZApi(endpoint="http://panel", node_id=1, token="t"),
+        lambda r: httpx.Response(200, json={"msg": "OK", "data": [TUNNEL_RULE]}),
+    )
+    bulk = FileBulkBackend(
+        path=str(path),
+        reload_command="true",
+        reload_wait=0,
+        threshold=2,
+        observer_addr="http://127.0.0.1:8080/observer",
+    )
+    assert await sync_relay_rules(
+        panel_api=panel_api, gost_api=gost_api, executor=Executor(), state=SyncState(), bulk=bulk
+    )
+    assert [c for c in calls if c[0] != "GET"] == []
+    written = json.loads(path.read_text())
+    assert written["api"] == {"addr": ":18080"}
+    assert written["observers"][0]["name"] == "node-observer"
+    assert set(gost_api.mirror.objects["services"]) == {"rule-1-tunnel-node-1"}
+
+
+@pytest.mark.asyncio
+async def test_sync_bulk_apply_marks_matching_only(tmp_path):
+    path = tmp_path / "gost.json"
+    stale = {"name": "rule-1-tunnel-node-1", "addr": ":1"}
+
+    def gost(request: httpx.Request):
+        # gost took the file but kept the old service
+        cfg = json.loads(path.read_text()) if path.exists() else {"services": []}
+        cfg["services"] = [stale]
+        return httpx.Response(200, json=cfg)
+
+    panel = FakePanel(rules=[TUNNEL_RULE])
+    gost_api = mock_api(GOSTApi(endpoint="http://gost"), gost)
+    panel_api = panel.attach(TYZApi(endpoint="http://panel", node_id=1, token="t"))
+    bulk = FileBulkBackend(path=str(path), reload_command="true", reload_wait=0, threshold=2)
+    await sync_relay_rules(panel_api=panel_api, gost_api=gost_api, executor=Executor(), state=SyncState(), bulk=bulk)
+    assert json.loads(path.read_text())["services"][0]["addr"] == ":10001"
+    assert panel.statuses == {}
+
+def test_traffic_accumulator_counter_reset():
+    acc = TrafficAccumulator()
+    acc.feed(service="rule-1-raw-node-1", input_bytes=100, output_bytes=100)
+    acc.feed(service="rule-1-raw-node-1", input_bytes=150, output_bytes=300)
+    # first sighting counts from zero
+    assert acc.drain() == {"rule-1-raw-node-1": 450}
+    # gost restarted, counters start over
+    acc.feed(service="rule-1-raw-node-1", input_bytes=10, output_bytes=20)
+    assert acc.drain() == {"rule-1-raw-node-1": 30}
+    assert acc.drain() == {}
+
+
+@pytest.mark.asyncio
+async def test_observer_ingest_batches():
+    acc = TrafficAccumulator()
+    ingest = ObserverIngest(route=lambda node, service: acc if service.startswith("rule-") else None, queue_size=3)
+
+    def body(client: str, used: int) -> bytes:
+        stats = {"inputBytes": used, "outputBytes": used, "totalConns": 1, "currentConns": 0, "totalErrs": 0}
+        event = {"kind": "service", "service": "rule-1-raw-node-1", "client": client, "type": "stats", "stats": stats}
+        return json.dumps({"events": [event, {**event, "service": "unknown"}]}).encode()
+
+    for b in (body("a", 10), body("b", 100), body("a", 15)):
+        assert ingest.submit(node="", body=b)
+    assert not ingest.submit(node="", body=b"{}")
+    ingest.drain()
+    assert ingest.submit(node="", body=b"not json")
+    for b in (body("a", 20), body("b", 101)):
+        ingest.submit(node="", body=b)
+    ingest.drain()
+    # counters tracked per client, a batch keeps the last event of each: 2 * 15 + 2 * 100, then 2 * 5 + 2 * 1
+    assert acc.drain() == {"rule-1-raw-node-1": 242}
+
+    # large batches are decoded in a worker thread
+    ingest.offload_bytes = 0
+    task = asyncio.create_task(ingest.run())
+    for b in (body("a", 30), b"not json"):
+        ingest.submit(node="", body=b)
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert acc.drain() == {"rule-1-raw-node-1": 20}
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor():
+    task = asyncio.create_task(monitor_loop_lag(interval=0.01))
+    await asyncio.sleep(0.015)
+    time.sleep(0.05)
+    await asyncio.sleep(0.015)
+    task.cancel()
+    assert LOOP_LAG.data[()][-2] >= 0.03
+
+
+def test_timeseries_store():
+    store = TimeSeriesStore(resolutions=[(10, 6), (60, 10)], max_services=2)
+    for i in range(12):
+        # 10 new conns and 100 bytes each way per 10s
+        store.feed(
+            service="rule-1-raw-node-1",
+            current_conns=i,
+            total_conns=10 * i,
+            input_bytes=100 * i,
+            output_bytes=100 * i,
+            total_errs=0,
+            now=1000 + 10 * i,
+        )
+    store.feed("rule-2-raw-node-1", 1, 5, 10, 10, 1, now=1100)
+    store.feed("rule-2-raw-node-1", 1, 6, 20, 10, 1, now=1110)
+
+    res = store.query(service="rule-1-raw-node-1", window=50, now=1110)
+    assert res["resolution"] == 10
+    assert [p["time"] for p in res["points"]] == [1060, 1070, 1080, 1090, 1100, 1110]
+    assert res["points"][-1] == {
+        "time": 1110,
+        "current_conns": 11,
+        "total_conns": 10,
+        "input_bytes": 100,
+        "output_bytes": 100,
+        "total_errs": 0,
+    }
+    # older than finest ring, served at next resolution
+    assert store.query(service="rule-1-raw-node-1", window=300, now=1110)["resolution"] == 60
+
+    assert [t["service"] for t in store.top(n=2, window=30, now=1110)] == ["rule-1-raw-node-1", "rule-2-raw-node-1"]
+    assert store.top(window=30, by="errors", now=1110) == []
+
+    store.feed("rule-3-raw-node-1", 0, 0, 0, 0, 0, now=1110)
+    assert store.query(service="rule-1-raw-node-1") is None
+    assert set(store.last) == {"rule-2-raw-node-1", "rule-3-raw-node-1"}
+    assert len(store) == 2
+
+
+@pytest.mark.asyncio
+async def test_report_traffic_from_observer(tmp_path):
+    reports = []
+
+    def panel(request: httpx.Request):
+        reports.append(json.loads(request.content)["data"])
+        return httpx.Response(200, json={"msg": "OK"})
+
+    acc = TrafficAccumulator(reset_traffic=True)
+    acc.feed(service="rule-3-tunnel-node-1", input_bytes=1, output_bytes=2)
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), panel)
+    spool = TrafficSpool(path=str(tmp_path / "spool.jsonl"))
+    await report_traffic_by_rules(
+        panel_api=panel_api, source=ObserverTrafficSource(acc), executor=Executor(), spool=spool
+    )
+    assert reports == [{"raw": {}, "tunnel": {"3": 3}, "egress": {}}]
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_traffic_spool_replay(tmp_path):
+    panel_up = False
+    reports = []
+
+    def panel(request: httpx.Request):
+        if not panel_up:
+            return httpx.Response(502, json={"msg": "bad gateway"})
+        reports.append(json.loads(request.content)["data"])
+        return httpx.Response(200, json={"msg": "OK"})
+
+    acc = TrafficAccumulator(reset_traffic=True)
+    panel_api = mock_api(TYZApi(endpoint="http://panel", node_id=1, token="t"), panel)
+    spool = TrafficSpool(path=str(tmp_path / "spool.jsonl"), base_backoff=0)
+    kwargs = {"panel_api": panel_api, "source": ObserverTrafficSource(acc), "executor": Executor(), "spool": spool}
+    for used in (1, 2):
+        acc.feed(service="rule-3-raw-node-1", input_bytes=used, output_bytes=0)
+        await report_traffic_by_rules(**kwargs)
+    # survives restart
+    assert len(TrafficSpool(path=str(tmp_path / "spool.jsonl"))) == 2
+
+    panel_up = True
+    await report_traffic_by_rules(**kwargs)
+    assert reports == [{"raw": {"3": 3}, "tunnel": {}, "egress": {}}]
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_gost_metrics_traffic_deltas():
+    scrapes = iter([100, 160, 40])
+
+    def gost(request: httpx.Request):
+        line = f'gost_service_transfer_input_bytes_total{{service="rule-1-raw-node-1"}} {next(scrapes)}\n'
+        return httpx.Response(200, text=line)
+
+    metrics_api = mock_api(GOSTMetricsApi(endpoint="http://gost-metrics", breaker_failures=1), gost)
+    source = GOSTMetricsTrafficSource(metrics_api=metrics_api, executor=Executor())
+    assert await source.collect() == {"rule-1-raw-node-1": 100}
+    assert await source.collect() == {"rule-1-raw-node-1": 60}
+    # counter reset
+    assert await source.collect() == {"rule-1-raw-node-1": 40}
+    # scrapes go through the shared request path
+    assert UPSTREAM_SECONDS.data[(metrics_api.upstream, "GET")][-1] == 3
+    metrics_api.breaker.record(ok=False)
+    assert await source.collect() == {}
+    assert UPSTREAM_SECONDS.data[(metrics_api.upstream, "GET")][-1] == 3
+
+
+@pytest.mark.asyncio
+async def test_prometheus_traffic_aligned_windows():
+    queries = []
+
+    def prom(request: httpx.Request):
+        queries.append(dict(request.url.params))
+        result = [
+            {"metric": {"service": "rule-1-raw-node-1", "direction": "input"}, "value": [0, "10"]},
+            {"metric": {"service": "rule-1-raw-node-1", "direction": "output"}, "value": [0, "5"]},
+        ]
+        return httpx.Response(200, json={"status": "success", "data": {"result": result}})
+
+    prom_api = mock_api(PrometheusApi(endpoint="http://prom"), prom)
+    source = PrometheusTrafficSource(prom_api=prom_api, executor=Executor())
+    source.last_end = source.window()[1] - 90
+    assert await source.collect() == {"rule-1-raw-node-1": 15}
+    assert len(queries) == 1
+    assert "[90s]" in queries[0]["query"]
+    assert float(queries[0]["time"]) % 30 == 0
+    # nothing new until next aligned boundary
+    assert await source.collect() == {}
+
+
+@pytest.mark.asyncio
+async def test_report_traffic_of_own_node_only(tmp_path):
+    # two nodes sharing one prometheus, rule ids overlap
+    prom = FakePrometheus(traffic={"rule-1-raw-node-1": (60, 40), "rule-1-raw-node-2": (150, 50), "manual": (1, 1)})
+    prom_api = prom.attach(PrometheusApi(endpoint="http://prom"))
+    executor = Executor()
+    for node_id, used in ((1, 100), (2, 200)):
+        panel = FakePanel()
+        panel_api = panel.attach(TYZApi(endpoint="http://panel", node_id=node_id, token="t"))
+        source = PrometheusTrafficSource(prom_api=prom_api, executor=executor)
+        spool = TrafficSpool(path=str(tmp_path / f"spool-{node_id}.jsonl"))
+        await report_traffic_by_rules(panel_api=panel_api, source=source, executor=executor, spool=spool)
+        assert panel.traffic == [{"raw": {"1": used}, "tunnel": {}, "egress": {}}]
@@ -1,4 +1,7 @@
 from utils.gost import parse_rule_info_from_service
+from utils.metrics import Registry
+from utils.models import parse_rules
+from utils.prom import ServiceTransferParser
 
 
 def test_parse_rule_info_from_service():
@@ -7,3 +10,47 @@ def test_parse_rule_info_from_service():
     assert rule_id == 2
     assert rule_type == "egress"
     assert node_id == 1
+
+
+def test_metrics_render():
+    registry = Registry()
+    registry.counter("calls_total", "Calls", ("upstream",)).inc(upstream="gost")
+    registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1)).observe(0.5)
+    text = registry.render()
+    assert 'calls_total{upstream="gost"} 1' in text
+    assert 'latency_seconds_bucket{le="0.1"} 0' in text
+    assert 'latency_seconds_bucket{le="1"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 1' in text
+    assert "latency_seconds_count 1" in text
+
+    registry.counter("errors_total", "Errors", ("error",)).inc(error='bad "x"\\y\nz')
+    assert 'errors_total{error="bad \\"x\\"\\\\y\\nz"} 1' in registry.render()
+
+
+def test_parse_service_transfer():
+    parser = ServiceTransferParser()
+    parser.feed_text(
+        """# HELP gost_service_transfer_input_bytes_total Total service input data transfer size in bytes
+# TYPE gost_service_transfer_input_bytes_total counter
+gost_service_transfer_input_bytes_total{host="h",service="rule-1-raw-node-1"} 100
+gost_service_transfer_input_bytes_total{host="h2",service="rule-1-raw-node-1"} 50
+gost_service_transfer_output_bytes_total{host="h",service="rule-1-raw-node-1"} 2.5e+03 1712000000000
+gost_service_requests_total{host="h",service="rule-1-raw-node-1"} 9
+go_goroutines 12
+"""
+    )
+    assert parser.result == {"rule-1-raw-node-1": [150, 2500]}
+
+
+def test_parse_rules():
+    raw = {"id": 3, "type": "Raw", "ingress_node": 1, "listen_port": 1000, "targets": "a:1\nb:2"}
+    raw["limit"] = '{"conn": 5}'
+    r1, r2 = parse_rules([raw, {**raw, "id": 4}])
+    assert r1.service_name == "rule-3-raw-node-1"
+    assert r1.targets == ("a:1", "b:2")
+    # limits parsed once per distinct limit string
+    assert r1.limit is r2.limit
+    assert [(s.kind, s.name, s.limits) for s in r1.limiter_specs()] == [
+        ("climiters", "rule-3-raw-node-1-conn-limiter", ["$ 5"])
+    ]
+    assert r1.digest != r2.digest
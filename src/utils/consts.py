@@ -5,3 +5,16 @@ class RuleType(Enum):
     EGRESS = "Egress"
     RAW = "Raw"
     TUNNEL = "Tunnel"
+
+
+class GOSTObjectKind(Enum):
+    LIMITER = "limiters"
+    CLIMITER = "climiters"
+    CHAIN = "chains"
+    SERVICE = "services"
+
+
+class PlanOp(Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
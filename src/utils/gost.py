@@ -1,12 +1,18 @@
+import hashlib
 import json
 import logging
 import math
+import re
 from dataclasses import dataclass, field
 from json import JSONDecodeError
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# names of services created by the node, chains and limiters append a suffix
+SERVICE_NAME_RE = re.compile(r"^rule-(\d+)-([a-z]+)-node-(\d+)$")
+OBJECT_SUFFIXES = ("-chain", "-speed-limiter", "-conn-limiter")
+
 
 @dataclass
 class GOSTAuth:
@@ -108,3 +114,107 @@ def parse_rule_info_from_service(service: str) -> Tuple[int, str, int]:
     rule_type = data[2]
     node_id = int(data[4])
     return rule_id, rule_type, node_id
+
+
+def parse_object_owner(name: str) -> Optional[Tuple[str, int]]:
+    """
+    Service and node owning a GOST object named by the node.
+    :param name: service, chain or limiter name
+    :return: (service name, node id), None for objects not named by the node
+    """
+    for suffix in OBJECT_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    m = SERVICE_NAME_RE.match(name)
+    if m is None:
+        return None
+    return name, int(m.group(3))
+
+
+def fingerprint(obj) -> str:
+    """
+    Stable hash of a JSON-serializable object.
+    :param obj:
+    :return:
+    """
+    raw = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+# live fields kept even when the desired object has none, GOST does not default them and dropping one is a change
+PROJECTED_KEYS = ("selector",)
+
+
+def project(obj, shape):
+    """
+    Part of obj present in shape, recursively. Lists are projected item by item, None values are dropped.
+    GOST fills defaults into live objects, projected onto the desired object they compare like for like.
+    :param obj: live object
+    :param shape: desired object
+    :return:
+    """
+    if isinstance(shape, dict) and isinstance(obj, dict):
+        keys = list(shape) + [k for k in PROJECTED_KEYS if k in obj and k not in shape]
+        return {k: project(obj[k], shape.get(k)) for k in keys if obj.get(k) is not None}
+    if isinstance(shape, list) and isinstance(obj, list) and len(shape) == len(obj):
+        return [project(o, s) for o, s in zip(obj, shape)]
+    return obj
+
+
+def canonical(obj):
+    """
+    Canonical form of a rendered GOST object, None values are dropped.
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, dict):
+        return {k: canonical(v) for k, v in obj.items() if v is not None}
+    if isinstance(obj, list):
+        return [canonical(v) for v in obj]
+    return obj
+
+
+def redact(obj):
+    """
+    Copy of a rendered GOST object with auth credentials masked, safe to show.
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, dict):
+        return {k: {a: "***" for a in v} if k == "auth" and isinstance(v, dict) else redact(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact(v) for v in obj]
+    return obj
+
+
+def spec_digest(desired: dict) -> str:
+    """
+    Content hash of a desired GOST object.
+    :param desired:
+    :return:
+    """
+    return fingerprint(canonical(desired))
+
+
+def live_digest(live: dict, desired: dict) -> str:
+    """
+    Content hash of a live GOST object normalized to the shape of the desired one, equal to `spec_digest` of the
+    desired object exactly when GOST already has it.
+    :param live:
+    :param desired:
+    :return:
+    """
+    return fingerprint(project(live, canonical(desired)))
+
+
+def rules_fingerprint(digests) -> str:
+    """
+    Fingerprint of panel relay rules from their (type, id, fingerprint) triples, independent of rule order.
+    :param digests:
+    :return:
+    """
+    h = hashlib.sha256()
+    for rule_type, rule_id, digest in sorted(digests, key=lambda d: (str(d[0]), d[1] or 0)):
+        h.update(f"{rule_type}:{rule_id}:{digest};".encode())
+    return h.hexdigest()
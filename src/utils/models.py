@@ -0,0 +1,177 @@
+import sys
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from utils import consts
+from utils.gost import (
+    GOSTAuth,
+    RelayRuleLimit,
+    fingerprint,
+    gen_limiter_name,
+    gen_service_name,
+    parse_gost_limits,
+)
+
+RULE_TYPES = {t.value for t in consts.RuleType}
+
+
+@lru_cache(maxsize=4096)
+def cached_gost_limits(limit: str) -> RelayRuleLimit:
+    """
+    Parse gost limits once per distinct limit string, the result is shared and must not be modified.
+    :param limit:
+    :return:
+    """
+    return parse_gost_limits(limit=limit)
+
+
+class LimiterSpec:
+    __slots__ = ("kind", "name", "limits")
+
+    def __init__(self, kind: str, name: str, limits: List[str]):
+        self.kind = kind
+        self.name = name
+        self.limits = limits
+
+
+class ChainSpec:
+    __slots__ = ("name", "relay", "auth")
+
+    def __init__(self, name: str, relay: str, auth: GOSTAuth):
+        self.name = name
+        self.relay = relay
+        self.auth = auth
+
+
+class ServiceSpec:
+    __slots__ = ("name", "type", "addr", "targets", "chain", "auth", "limiter", "climiter", "selector")
+
+    def __init__(
+        self,
+        name: str,
+        type: str,
+        addr: str,
+        targets: Tuple[str, ...] = (),
+        chain: str = "",
+        auth: GOSTAuth = None,
+        limiter: str = "",
+        climiter: str = "",
+        selector: dict = None,
+    ):
+        self.name = name
+        # rule type the service serves
+        self.type = type
+        self.addr = addr
+        self.targets = targets
+        self.chain = chain
+        self.auth = auth
+        self.limiter = limiter
+        self.climiter = climiter
+        self.selector = selector
+
+
+class RelayRule:
+    """
+    Panel relay rule parsed once per fetch, names are built and interned up front.
+    """
+
+    __slots__ = (
+        "id",
+        "type",
+        "node_id",
+        "listen_port",
+        "addr",
+        "targets",
+        "transport_type",
+        "tunnel_addr",
+        "auth",
+        "limit",
+        "service_name",
+        "chain_name",
+        "speed_limiter_name",
+        "conn_limiter_name",
+        "digest",
+        "raw",
+    )
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+        self.id = raw.get("id")
+        self.type = sys.intern(str(raw.get("type")))
+        # node the service runs on, egress rules live on the egress node
+        self.node_id = raw.get("egress_node") if self.type == consts.RuleType.EGRESS.value else raw.get("ingress_node")
+        self.listen_port = raw.get("listen_port")
+        self.addr = f":{self.listen_port}"
+        self.targets = tuple(sys.intern(t) for t in (raw.get("targets") or "").split("\n"))
+        self.transport_type = raw.get("transport_type", "")
+        tunnel = raw.get("tunnel") or {}
+        self.tunnel_addr = tunnel.get("addr", "")
+        self.auth = GOSTAuth(username=tunnel.get("username"), password=tunnel.get("password"))
+        self.limit = cached_gost_limits(raw.get("limit", "{}"))
+        self.service_name = sys.intern(gen_service_name(rule_id=self.id, rule_type=self.type, node_id=self.node_id))
+        self.chain_name = sys.intern(f"{self.service_name}-chain")
+        self.speed_limiter_name = sys.intern(gen_limiter_name(service=self.service_name, _type="speed"))
+        self.conn_limiter_name = sys.intern(gen_limiter_name(service=self.service_name, _type="conn"))
+        # content hash, tells whether a reported status still matches the rule
+        self.digest = fingerprint(raw)
+
+    @property
+    def supported(self) -> bool:
+        return self.type in RULE_TYPES
+
+    def limiter_specs(self) -> List[LimiterSpec]:
+        """
+        Speed and conn limiters of the rule, limits left empty by the panel are skipped.
+        :return:
+        """
+        return [
+            LimiterSpec(kind=kind, name=name, limits=values)
+            for kind, name, values in (
+                (consts.GOSTObjectKind.LIMITER.value, self.speed_limiter_name, self.limit.speed_limits),
+                (consts.GOSTObjectKind.CLIMITER.value, self.conn_limiter_name, self.limit.conn_limits),
+            )
+            if values
+        ]
+
+    def object_names(self) -> List[Tuple[str, str]]:
+        """
+        GOST objects the rule needs.
+        :return: (kind, name) pairs
+        """
+        names = [(consts.GOSTObjectKind.SERVICE.value, self.service_name)]
+        if self.type == consts.RuleType.TUNNEL.value:
+            names.append((consts.GOSTObjectKind.CHAIN.value, self.chain_name))
+        return names + [(spec.kind, spec.name) for spec in self.limiter_specs()]
+
+    def chain_spec(self) -> ChainSpec:
+        return ChainSpec(name=self.chain_name, relay=self.tunnel_addr, auth=self.auth)
+
+    def service_spec(self, targets: Tuple[str, ...] = None, selector: dict = None) -> ServiceSpec:
+        """
+        GOST service of the rule.
+        :param targets: targets in the order tried, panel order by default
+        :param selector: forwarder node selector
+        :return:
+        """
+        if self.type == consts.RuleType.EGRESS.value:
+            return ServiceSpec(name=self.service_name, type=self.type, addr=self.addr, auth=self.auth)
+
+        return ServiceSpec(
+            name=self.service_name,
+            type=self.type,
+            addr=self.addr,
+            targets=tuple(targets or self.targets),
+            chain=self.chain_name if self.type == consts.RuleType.TUNNEL.value else "",
+            limiter=self.speed_limiter_name,
+            climiter=self.conn_limiter_name,
+            selector=selector,
+        )
+
+
+def parse_rules(rules: Optional[list]) -> List[RelayRule]:
+    """
+    Parse panel relay rules.
+    :param rules:
+    :return:
+    """
+    return [RelayRule(raw=r) for r in rules or []]
@@ -0,0 +1,81 @@
+from typing import Dict, List, Optional
+
+SERVICE_TRANSFER_METRICS = {
+    "gost_service_transfer_input_bytes_total": 0,
+    "gost_service_transfer_output_bytes_total": 1,
+}
+
+
+def _label_value(labels: str, name: str) -> Optional[str]:
+    """
+    Read one label value from a label block, without parsing the others.
+    :param labels: text between braces
+    :param name: label name
+    :return:
+    """
+    start = 0
+    key = f'{name}="'
+    while True:
+        i = labels.find(key, start)
+        if i < 0:
+            return None
+        if i == 0 or labels[i - 1] in ", {":
+            break
+        start = i + 1
+
+    i += len(key)
+    j = i
+    while True:
+        j = labels.find('"', j)
+        if j < 0:
+            return None
+        if labels[j - 1] != "\\":
+            break
+        j += 1
+    value = labels[i:j]
+    if "\\" in value:
+        value = value.replace('\\"', '"').replace("\\n", "\n").replace("\\\\", "\\")
+    return value
+
+
+class ServiceTransferParser:
+    """
+    Incremental parser of prometheus text exposition format.
+    Only `gost_service_transfer_*_bytes_total` samples are decoded, other lines are skipped by a prefix check.
+    """
+
+    def __init__(self, metrics: Dict[str, int] = None):
+        self.metrics = metrics or SERVICE_TRANSFER_METRICS
+        # service -> [input bytes, output bytes]
+        self.result: Dict[str, List[float]] = {}
+
+    def feed(self, line: str):
+        if not line.startswith("gost_service_transfer_"):
+            return
+
+        brace = line.find("{")
+        if brace < 0:
+            return
+        direction = self.metrics.get(line[:brace])
+        if direction is None:
+            return
+
+        end = line.rfind("}")
+        service = _label_value(line[brace + 1 : end], "service")
+        if service is None:
+            return
+
+        try:
+            value = float(line[end + 1 :].split()[0])
+        except (IndexError, ValueError):
+            return
+
+        counters = self.result.get(service)
+        if counters is None:
+            counters = self.result[service] = [0, 0]
+        # series of one service with other labels are summed up
+        counters[direction] += value
+
+    def feed_text(self, text: str):
+        for line in text.splitlines():
+            self.feed(line)